@@ -0,0 +1,438 @@
+import asyncio
+import hashlib
+import math
+import os
+import threading
+import time
+from itertools import count
+
+from metrics import admission_wait_seconds
+
+REJECTIONS = ('client_queue_full', 'queue_full', 'timeout')
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_client_keys(value):
+    # "key1:4,key2" -> {client id: weight}; a key without a weight counts as 1
+    weights = {}
+    for item in (value or '').split(','):
+        key, _, weight = item.strip().partition(':')
+        if not key:
+            continue
+        try:
+            weights[api_key_client(key)] = max(0.1, float(weight)) if weight else 1.0
+        except ValueError:
+            weights[api_key_client(key)] = 1.0
+    return weights
+
+
+def api_key_client(api_key):
+    # Keys never appear in /stats or /metrics, only a digest of them
+    return f"key:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]}"
+
+
+def download_client(api_key, address, weights):
+    # Only configured keys identify a client; anything else falls back to the address,
+    # so minting keys does not buy more slots
+    if api_key:
+        client = api_key_client(api_key)
+        if client in weights:
+            return client
+    return address
+
+
+class Ticket:
+    def __init__(self, controller, client):
+        self.controller = controller
+        self.client = client
+        self.admitted = time.monotonic()
+        self.released = False
+
+    def release(self):
+        self.controller.release(self)
+
+
+class AdmittedBody:
+    # WSGI body that releases a ticket when the server closes it; Response.call_on_close
+    # callbacks never run for direct_passthrough responses
+
+    def __init__(self, body, ticket):
+        self.body = body
+        self.ticket = ticket
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            close = getattr(self.body, 'close', None)
+            if close:
+                close()
+        finally:
+            self.ticket.release()
+
+
+class _Waiter:
+    def __init__(self, client, wake):
+        self.client = client
+        self.wake = wake
+        self.enqueued = time.monotonic()
+        self.ticket = None
+
+
+class AdmissionController:
+    # At most `max_active` downloads stream at once, and `per_client` per client.
+    # Requests over either cap wait up to `queue_timeout` seconds; a freed slot goes to
+    # the waiting client with the fewest active downloads for its weight, then to the
+    # oldest request. A client may have `per_client_queued` requests waiting and the
+    # queue holds `max_queued`; beyond that requests are refused at once. Refusals
+    # carry a Retry-After estimated from how long downloads have been holding a slot.
+    # State is per process: each gunicorn worker enforces its own caps.
+
+    def __init__(self, max_active=32, per_client=4, max_queued=64, per_client_queued=None, queue_timeout=30,
+                 weights=None):
+        self.max_active = max_active
+        self.per_client = per_client
+        self.max_queued = max_queued
+        self.per_client_queued = per_client if per_client_queued is None else per_client_queued
+        self.queue_timeout = queue_timeout
+        self.weights = weights or {}
+        self._lock = threading.Lock()
+        self._active = {}
+        self._total_active = 0
+        self._waiters = []
+        self._hold_seconds = None
+        self._wait_seconds = 0.0
+        self._counts = dict.fromkeys(('admitted', 'enqueued', 'abandoned') + REJECTIONS, 0)
+
+    @property
+    def enabled(self):
+        return self.max_active > 0
+
+    def weight(self, client):
+        return self.weights.get(client, 1.0)
+
+    def _eligible(self, client):
+        return self._total_active < self.max_active and self._active.get(client, 0) < self.per_client
+
+    def _admit(self, client):
+        self._active[client] = self._active.get(client, 0) + 1
+        self._total_active += 1
+        self._counts['admitted'] += 1
+        return Ticket(self, client)
+
+    def _retry_after(self, client):
+        # Seconds until a slot is likely to free up for `client`
+        hold = self._hold_seconds or self.queue_timeout
+        if self._active.get(client, 0) >= self.per_client:
+            estimate = hold / self.per_client
+        else:
+            estimate = hold * (len(self._waiters) + 1) / self.max_active
+        return max(1, min(300, math.ceil(estimate)))
+
+    def _reject(self, reason, client):
+        self._counts[reason] += 1
+        return AdmissionRejected(reason, self._retry_after(client))
+
+    def _enter(self, client, wake):
+        # (ticket, None) when admitted now, (None, waiter) when queued
+        with self._lock:
+            if self._eligible(client):
+                return self._admit(client), None
+            if sum(1 for waiter in self._waiters if waiter.client == client) >= self.per_client_queued:
+                raise self._reject('client_queue_full', client)
+            if len(self._waiters) >= self.max_queued:
+                raise self._reject('queue_full', client)
+            waiter = _Waiter(client, wake)
+            self._waiters.append(waiter)
+            self._counts['enqueued'] += 1
+            return None, waiter
+
+    def _leave(self, waiter, abandoned=False):
+        # The waiter's ticket if it was granted in the meantime; otherwise removes it
+        # from the queue and raises AdmissionRejected (or returns None if abandoned)
+        waited = time.monotonic() - waiter.enqueued
+        with self._lock:
+            if waiter.ticket is not None:
+                self._wait_seconds += waited
+                admission_wait_seconds.labels('admitted').observe(waited)
+                return waiter.ticket
+            self._waiters.remove(waiter)
+            if abandoned:
+                self._counts['abandoned'] += 1
+                return None
+            admission_wait_seconds.labels('timeout').observe(waited)
+            raise self._reject('timeout', waiter.client)
+
+    def acquire(self, client):
+        # Blocks until `client` may start a download; raises AdmissionRejected
+        if not self.enabled:
+            return None
+        event = threading.Event()
+        ticket, waiter = self._enter(client, event.set)
+        if ticket is not None:
+            admission_wait_seconds.labels('admitted').observe(0.0)
+            return ticket
+        event.wait(self.queue_timeout)
+        return self._leave(waiter)
+
+    async def acquire_async(self, client):
+        if not self.enabled:
+            return None
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant():
+            if not granted.done():
+                granted.set_result(None)
+
+        ticket, waiter = self._enter(client, lambda: loop.call_soon_threadsafe(grant))
+        if ticket is not None:
+            admission_wait_seconds.labels('admitted').observe(0.0)
+            return ticket
+        try:
+            await asyncio.wait_for(granted, self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The client went away while queued; hand back a slot granted meanwhile
+            ticket = self._leave(waiter, abandoned=True)
+            if ticket is not None:
+                ticket.release()
+            raise
+        return self._leave(waiter)
+
+    def release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            held = time.monotonic() - ticket.admitted
+            self._hold_seconds = held if self._hold_seconds is None else 0.8 * self._hold_seconds + 0.2 * held
+            remaining = self._active[ticket.client] - 1
+            if remaining:
+                self._active[ticket.client] = remaining
+            else:
+                del self._active[ticket.client]
+            self._total_active -= 1
+            woken = self._grant()
+        for waiter in woken:
+            waiter.wake()
+
+    def _grant(self):
+        woken = []
+        while self._waiters:
+            eligible = [waiter for waiter in self._waiters if self._eligible(waiter.client)]
+            if not eligible:
+                break
+            waiter = min(eligible, key=lambda w: (self._active.get(w.client, 0) / self.weight(w.client), w.enqueued))
+            self._waiters.remove(waiter)
+            waiter.ticket = self._admit(waiter.client)
+            woken.append(waiter)
+        return woken
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            queued = {}
+            for waiter in self._waiters:
+                queued[waiter.client] = queued.get(waiter.client, 0) + 1
+            return {
+                "max_active": self.max_active,
+                "per_client": self.per_client,
+                "max_queued": self.max_queued,
+                "queue_timeout": self.queue_timeout,
+                "active": self._total_active,
+                "queued": len(self._waiters),
+                "oldest_wait_seconds": round(now - self._waiters[0].enqueued, 3) if self._waiters else 0.0,
+                "hold_seconds_avg": round(self._hold_seconds or 0.0, 3),
+                "wait_seconds_total": round(self._wait_seconds, 3),
+                **self._counts,
+                "clients": {
+                    client: {"active": self._active.get(client, 0), "queued": queued.get(client, 0)}
+                    for client in sorted(set(self._active) | set(queued))
+                },
+            }
+
+
+class _Flow:
+    def __init__(self, flow_id, client, now):
+        self.id = flow_id
+        self.client = client
+        self.started = now
+        self.last = now
+        self.next_send = now
+        self.recent = 0.0
+
+
+class FairBandwidth:
+    # Shares `rate` bytes/s of download egress between the streams in flight. Each
+    # client's share is proportional to its weight and split evenly between its own
+    # streams, so fifty parallel downloads from one client weigh as much as one. A
+    # stream held back elsewhere (slow reader, slow upstream, ffmpeg) keeps the rate it
+    # actually uses and the remainder goes to the others (weighted max-min fairness).
+    # Each stream is paced against its own clock, like TokenBucket.reserve. With a
+    # rate of 0 streams are not paced, but per-client shares are still measured.
+
+    def __init__(self, rate=0, weights=None, window=2.0, reallocate=0.1, headroom=1.25):
+        self.rate = rate
+        self.weights = weights or {}
+        self.window = window
+        self.reallocate = reallocate
+        self.headroom = headroom
+        self._lock = threading.Lock()
+        self._ids = count()
+        self._flows = {}
+        self._clients = {}
+        self._rates = {}
+        self._allocated = None
+        self._paced = 0
+        self._paced_seconds = 0.0
+
+    def _decay(self, value, elapsed):
+        return value * math.exp(-elapsed / self.window)
+
+    def open(self, client):
+        with self._lock:
+            now = time.monotonic()
+            flow = _Flow(next(self._ids), client, now)
+            self._flows[flow.id] = flow
+            self._clients.setdefault(client, {"recent": 0.0, "updated": now, "bytes": 0})
+            self._allocated = None
+            return flow
+
+    def close(self, flow):
+        with self._lock:
+            self._flows.pop(flow.id, None)
+            self._rates.pop(flow.id, None)
+            self._allocated = None
+
+    def _measured_rate(self, flow, now):
+        # The decayed byte count, corrected for streams that started less than a few
+        # windows ago, over the window
+        weight = self.window * (1 - math.exp(-(now - flow.started) / self.window))
+        return self._decay(flow.recent, now - flow.last) / weight
+
+    def _allocate(self, now):
+        # Water-filling: streams using less than their weighted share are capped a
+        # little above what they use, and the rest is divided again among the others
+        streams_per_client = {}
+        for flow in self._flows.values():
+            streams_per_client[flow.client] = streams_per_client.get(flow.client, 0) + 1
+        weights = {
+            flow.id: self.weights.get(flow.client, 1.0) / streams_per_client[flow.client]
+            for flow in self._flows.values()
+        }
+        pending = list(self._flows.values())
+        capacity = float(self.rate)
+        rates = {}
+        while pending:
+            unit = capacity / sum(weights[flow.id] for flow in pending)
+            limited = []
+            for flow in pending:
+                # Streams younger than the window have no meaningful rate yet
+                if now - flow.started < self.window:
+                    continue
+                demand = self._measured_rate(flow, now) * self.headroom
+                if demand < weights[flow.id] * unit:
+                    limited.append((flow, demand))
+            if not limited:
+                for flow in pending:
+                    rates[flow.id] = weights[flow.id] * unit
+                break
+            for flow, demand in limited:
+                rates[flow.id] = demand
+                capacity -= demand
+                pending.remove(flow)
+        self._rates = rates
+        self._allocated = now
+
+    def reserve(self, flow, size):
+        # Seconds to wait before sending `size` bytes of `flow`
+        with self._lock:
+            now = time.monotonic()
+            flow.recent = self._decay(flow.recent, now - flow.last) + size
+            flow.last = now
+            client = self._clients[flow.client]
+            client["recent"] = self._decay(client["recent"], now - client["updated"]) + size
+            client["updated"] = now
+            client["bytes"] += size
+            if self.rate <= 0:
+                return 0.0
+            if self._allocated is None or now - self._allocated > self.reallocate:
+                self._allocate(now)
+            rate = max(self._rates.get(flow.id) or self.rate, 1.0)
+            start = max(now, flow.next_send)
+            flow.next_send = start + size / rate
+            delay = start - now
+            if delay > 0:
+                self._paced += 1
+                self._paced_seconds += delay
+            return delay
+
+    def paced(self, chunks, client):
+        flow = self.open(client)
+        try:
+            for chunk in chunks:
+                delay = self.reserve(flow, len(chunk))
+                if delay > 0:
+                    time.sleep(delay)
+                yield chunk
+        finally:
+            self.close(flow)
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            streams = {}
+            for flow in self._flows.values():
+                streams[flow.client] = streams.get(flow.client, 0) + 1
+            recent = {
+                client: self._decay(entry["recent"], now - entry["updated"])
+                for client, entry in self._clients.items()
+            }
+            # Clients that finished long ago have decayed to nothing
+            for client, value in recent.items():
+                if client not in streams and value < 1:
+                    del self._clients[client]
+            total = sum(recent.values())
+            return {
+                "bytes_per_second": self.rate or None,
+                "streams": len(self._flows),
+                "paced_chunks": self._paced,
+                "paced_seconds_total": round(self._paced_seconds, 3),
+                "clients": {
+                    client: {
+                        "streams": streams.get(client, 0),
+                        "weight": self.weights.get(client, 1.0),
+                        "bytes": entry["bytes"],
+                        "bytes_per_second": round(recent[client] / self.window),
+                        "share": round(recent[client] / total, 4) if total else 0.0,
+                    }
+                    for client, entry in sorted(self._clients.items())
+                },
+            }
+
+
+def admission_from_env():
+    weights = parse_client_keys(os.environ.get('DOWNLOAD_API_KEYS'))
+    per_client = int(os.environ.get('DOWNLOAD_PER_CLIENT', 4))
+    controller = AdmissionController(
+        max_active=int(os.environ.get('DOWNLOAD_MAX_ACTIVE', 32)),
+        per_client=per_client,
+        max_queued=int(os.environ.get('DOWNLOAD_MAX_QUEUED', 64)),
+        per_client_queued=int(os.environ.get('DOWNLOAD_PER_CLIENT_QUEUED', per_client)),
+        queue_timeout=float(os.environ.get('DOWNLOAD_QUEUE_TIMEOUT', 30)),
+        weights=weights,
+    )
+    bandwidth = FairBandwidth(rate=int(os.environ.get('DOWNLOAD_BANDWIDTH', 0)), weights=weights)
+    return controller, bandwidth
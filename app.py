@@ -1,6 +1,4 @@
-from flask import Flask, request, send_file, jsonify, Response, render_template, redirect
-from pytubefix import YouTube
-from googleapiclient.discovery import build
+from flask import Blueprint, Flask, request, send_file, jsonify, Response, render_template, redirect
 import os
 import tempfile
 import shutil
@@ -9,82 +7,405 @@ import time
 import random
 import requests
 import re
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import wraps
 from urllib.parse import quote
 
-logging.basicConfig(level=logging.DEBUG)
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import FileWrapper
+
+from admission import REJECTIONS, AdmissionRejected, AdmittedBody, admission_from_env, download_client
+from archive import iter_zip
+from clip import ClipError, RangeReader, clip_bounds, clip_stats, locate_clip, parse_timestamp, record_clip, write_clip
+from fetcher import fetcher_from_env
+from jobs import JobQueue, QueueFull
+from manifest import (
+    ManifestCache,
+    adaptive_resolutions,
+    build_manifest,
+    extract_video_id,
+    progressive_streams,
+    select_adaptive,
+    select_audio,
+    select_progressive,
+)
+from media_cache import MediaCache
+from metrics import directory_bytes, observe_stream, registry, resolve_retries, stage_seconds
+from ranges import (
+    MultipleRangesNotSupported,
+    RangeNotSatisfiable,
+    apply_range_headers,
+    http_date,
+    if_range_matches,
+    parse_range_header,
+    stream_etag,
+)
+from player_cache import player_cache_from_env
+from playlist import (
+    archive_name,
+    bandwidth_stats,
+    iter_pipelined,
+    iter_playlist_entries,
+    playlist_source,
+    read_ahead,
+    source_title,
+    throttled,
+)
+from prefetch import OUTCOMES as PREFETCH_OUTCOMES, prefetcher_from_env
+from ratelimit import error_status, get_limiter, limiter_stats
+from relay import limit_client_send, relay_from_env, relay_stats
+from resolver import ClientPreferences, ClientStats, hedged_resolve
+from search import iter_search_ndjson, quota, search_cache, search_youtube
+from thumbs import ThumbnailNotFound, etag_matches, negotiate_format, parse_width, proxied_thumbnails, thumbnails_from_env
+from transcode import MP3_BITRATES, extract_clip, ffmpeg_available, parse_bitrate, remux_fmp4, transcode_mp3
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# Reverse proxies in front of the service whose X-Forwarded-For entry is trusted for
+# the client address (Vercel's edge and Replit's deployment proxy, which sets REPL_ID,
+# add one); any other X-Forwarded-For is ignored, since clients can send whatever
+# they like. Behind an untrusted proxy every user shares the proxy's address.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 1 if os.environ.get('VERCEL') or os.environ.get('REPL_ID') else 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Job priorities are clamped to ±JOBS_MAX_PRIORITY; only callers with a configured API
+# key may go above the default of 0
+JOBS_MAX_PRIORITY = int(os.environ.get('JOBS_MAX_PRIORITY', 10))
+
 DOWNLOAD_FOLDER = tempfile.mkdtemp()
 
-CLIENT_TYPES = ['WEB', 'ANDROID', 'IOS', 'WEB_EMBED', 'WEB_MUSIC']
+# WEB needs the player script and a botGuard run before its first resolution, which
+# a long-lived server pays once but every cold serverless instance would pay again;
+# IOS needs neither, so serverless instances try it first
+CLIENT_TYPES = os.environ.get(
+    'RESOLVE_CLIENTS',
+    'IOS,WEB,ANDROID,WEB_EMBED,WEB_MUSIC' if os.environ.get('VERCEL') else 'WEB,ANDROID,IOS,WEB_EMBED,WEB_MUSIC'
+).split(',')
+
+# Number of client types resolved concurrently; 1 keeps the sequential fallback order
+HEDGE_WIDTH = int(os.environ.get('RESOLVE_HEDGE_WIDTH', 1))
+HEDGE_TIMEOUT = float(os.environ.get('RESOLVE_HEDGE_TIMEOUT', 30))
+
+INFO_BATCH_MAX = int(os.environ.get('INFO_BATCH_MAX', 50))
+
+# Videos fetched concurrently per playlist archive, and the largest archive allowed
+PLAYLIST_CONCURRENCY = int(os.environ.get('PLAYLIST_CONCURRENCY', 3))
+PLAYLIST_MAX_ITEMS = int(os.environ.get('PLAYLIST_MAX_ITEMS', 200))
+
+# Separate from the resolver pool: batch items run hedged resolutions on that pool
+# and would deadlock waiting on it if they were queued there themselves.
+info_batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('INFO_BATCH_WORKERS', 4)),
+    thread_name_prefix='info-batch'
+)
+
+client_stats = ClientStats()
+client_preferences = ClientPreferences()
+
+fetcher = fetcher_from_env()
+
+# Player scripts and their parsed signature transforms, shared with the other workers
+player_cache = player_cache_from_env()
+
+# Serverless instances (Vercel sets VERCEL=1) only get a small writable /tmp: they
+# stream every download instead of staging whole files there
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 0 if os.environ.get('VERCEL') else 2 * 1024 ** 3))
+media_cache = MediaCache(
+    os.environ.get('MEDIA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'youtube-media-cache')),
+    max_bytes=MEDIA_CACHE_MAX_BYTES,
+    max_entry_bytes=int(os.environ.get('MEDIA_CACHE_MAX_ENTRY_BYTES', MEDIA_CACHE_MAX_BYTES // 4))
+)
 
-def retry_with_backoff(max_retries=3, base_delay=2, max_delay=30):
+thumbnails = thumbnails_from_env()
+THUMB_MAX_AGE = int(os.environ.get('THUMB_MAX_AGE', 86400))
+
+admission, download_bandwidth = admission_from_env()
+
+manifest_cache = ManifestCache(
+    max_entries=int(os.environ.get('MANIFEST_CACHE_SIZE', 256)),
+    default_ttl=int(os.environ.get('MANIFEST_CACHE_TTL', 3600))
+)
+
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'youtube-jobs'))
+
+# Background jobs need a process that outlives the request and a database shared by
+# every instance; serverless has neither, so /jobs is not served there
+JOBS_ENABLED = os.environ.get('JOBS_ENABLED', '0' if os.environ.get('VERCEL') else '1') in ('1', 'true')
+
+job_queue = JobQueue(
+    os.environ.get('JOBS_DB', os.path.join(JOBS_DIR, 'jobs.sqlite3')),
+    JOBS_DIR,
+    runner=lambda params: run_download_job(params),
+    workers=int(os.environ.get('JOBS_WORKERS', 2)),
+    max_queued=int(os.environ.get('JOBS_MAX_QUEUED', 100)),
+    per_client=int(os.environ.get('JOBS_PER_CLIENT', 1)),
+    ttl=int(os.environ.get('JOBS_TTL', 24 * 3600))
+)
+
+prefetcher = prefetcher_from_env(
+    resolve=lambda video_id: prefetch_manifest(video_id),
+    is_cached=lambda video_id: video_id in manifest_cache,
+    limiter=get_limiter('player')
+)
+
+@registry.collector
+def collect_service_metrics():
+    clients = client_stats.stats()
+    yield 'ytdl_client_attempts_total', 'counter', "YouTube object creation attempts per client type", [
+        ({"client_type": client_type, "result": result}, entry[key])
+        for client_type, entry in clients.items()
+        for result, key in (("success", "successes"), ("failure", "failures"))
+    ]
+    yield 'ytdl_client_errors_total', 'counter', "Rate-limited (429) and forbidden (403) responses per client type", [
+        ({"client_type": client_type, "status": status}, entry[key])
+        for client_type, entry in clients.items()
+        for status, key in (("429", "rate_limited"), ("403", "forbidden"))
+    ]
+    yield 'ytdl_client_latency_seconds', 'histogram', "YouTube object creation latency per client type", [
+        ({"client_type": client_type}, entry["latency_seconds"]) for client_type, entry in clients.items()
+    ]
+    limiters = limiter_stats()
+    yield 'ytdl_rate_limiter_wait_seconds_total', 'counter', "Time spent waiting for an upstream budget", [
+        ({"limiter": name}, entry["wait_seconds_total"]) for name, entry in limiters.items()
+    ]
+    yield 'ytdl_rate_limiter_penalties_total', 'counter', "Backoffs applied after 429/403 responses", [
+        ({"limiter": name}, entry["penalties"]) for name, entry in limiters.items()
+    ]
+    yield 'ytdl_rate_limiter_rate', 'gauge', "Current requests per second allowed by each limiter", [
+        ({"limiter": name}, entry["rate"]) for name, entry in limiters.items()
+    ]
+    relays = relay_stats()
+    yield 'ytdl_relay_buffered_bytes', 'gauge', "Bytes held in relay ring buffers", [({}, relays["buffered_bytes"])]
+    yield 'ytdl_relay_capacity_bytes', 'gauge', "Ring buffer capacity allocated to active relays", [({}, relays["capacity_bytes"])]
+    yield 'ytdl_relay_aborts_total', 'counter', "Relays ended early, by reason", [
+        ({"reason": reason}, count) for reason, count in relays["aborts"].items()
+    ]
+    clips = clip_stats()
+    yield 'ytdl_clip_upstream_bytes_total', 'counter', "Upstream bytes fetched for clips, and the stream bytes skipped", [
+        ({"part": "index"}, clips["index_bytes"]),
+        ({"part": "media"}, clips["media_bytes"]),
+        ({"part": "avoided"}, clips["bytes_avoided"]),
+    ]
+    thumbs = thumbnails.stats()
+    yield 'ytdl_thumbnail_requests_total', 'counter', "Thumbnail requests, by result", [
+        ({"result": "served"}, thumbs["served"]),
+        ({"result": "not_modified"}, thumbs["not_modified"]),
+    ]
+    yield 'ytdl_thumbnail_upstream_bytes_total', 'counter', "Bytes of original thumbnails fetched upstream", [
+        ({}, thumbs["upstream_bytes"])
+    ]
+    admitted = admission.stats()
+    yield 'ytdl_admission_active', 'gauge', "Downloads holding an admission slot", [({}, admitted["active"])]
+    yield 'ytdl_admission_queue_depth', 'gauge', "Downloads waiting for an admission slot", [({}, admitted["queued"])]
+    yield 'ytdl_admission_requests_total', 'counter', "Download admission decisions, by result", [
+        ({"result": result}, admitted[result]) for result in ('admitted', 'abandoned') + REJECTIONS
+    ]
+    shares = download_bandwidth.stats()
+    yield 'ytdl_download_client_share', 'gauge', "Fraction of recent download egress used by each client", [
+        ({"client": client}, entry["share"]) for client, entry in shares["clients"].items()
+    ]
+    yield 'ytdl_download_client_bytes_per_second', 'gauge', "Recent download egress of each client", [
+        ({"client": client}, entry["bytes_per_second"]) for client, entry in shares["clients"].items()
+    ]
+    yield 'ytdl_download_paced_seconds_total', 'counter', "Time download streams were held back by the bandwidth scheduler", [
+        ({}, shares["paced_seconds_total"])
+    ]
+    prefetch = prefetcher.stats()
+    yield 'ytdl_prefetch_total', 'counter', "Search-result manifest prefetches, by outcome", [
+        ({"result": result}, prefetch[result]) for result in PREFETCH_OUTCOMES
+    ]
+    yield 'ytdl_temp_disk_bytes', 'gauge', "Bytes used on temporary disk", [
+        ({"path": "media_cache"}, directory_bytes(media_cache.root)),
+        ({"path": "thumbnails"}, directory_bytes(os.path.dirname(thumbnails.originals.root))),
+        ({"path": "downloads"}, directory_bytes(DOWNLOAD_FOLDER)),
+        ({"path": "jobs"}, directory_bytes(JOBS_DIR)),
+    ]
+    yield 'ytdl_temp_disk_free_bytes', 'gauge', "Free space on the media cache filesystem", [
+        ({}, shutil.disk_usage(media_cache.root).free)
+    ]
+
+def retry_with_backoff(max_retries=3, base_delay=2, max_delay=30, limiter=None):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             last_exception: Exception = Exception("Unknown error")
             for attempt in range(max_retries):
                 try:
-                    time.sleep(random.uniform(0.5, 1.5))
-                    return func(*args, **kwargs)
+                    if limiter:
+                        limiter.acquire()
+                    result = func(*args, **kwargs)
+                    if limiter:
+                        limiter.record_success()
+                    return result
                 except Exception as e:
                     last_exception = e
                     error_str = str(e).lower()
                     if '429' in error_str or 'too many requests' in error_str:
                         delay = min(base_delay * (2 ** attempt) + random.uniform(0, 1), max_delay)
-                        logger.warning(f"Rate limited (429). Attempt {attempt + 1}/{max_retries}. Waiting {delay:.1f}s...")
-                        time.sleep(delay)
+                        logger.warning(f"Rate limited (429). Attempt {attempt + 1}/{max_retries}. Backing off {delay:.1f}s...")
                     elif '403' in error_str:
                         delay = random.uniform(2, 5)
-                        logger.warning(f"Access denied (403). Attempt {attempt + 1}/{max_retries}. Waiting {delay:.1f}s...")
-                        time.sleep(delay)
+                        logger.warning(f"Access denied (403). Attempt {attempt + 1}/{max_retries}. Backing off {delay:.1f}s...")
                     else:
                         raise e
+                    if limiter:
+                        limiter.penalize(delay)
+                    else:
+                        time.sleep(delay)
             raise last_exception
         return wrapper
     return decorator
 
-def create_youtube_with_retry(video_url, max_retries=3):
+def _attempt_client(video_url, client_type, require_streams=False):
+    limiter = get_limiter('player')
+    limiter.acquire()
+    logger.debug("Trying client type: %s", client_type)
+    start = time.monotonic()
+    try:
+        yt = player_cache.youtube(video_url, client_type)
+        _ = yt.title
+        if require_streams and not yt.streams:
+            raise Exception(f"No streams returned for client {client_type}")
+    except Exception as e:
+        status = error_status(e)
+        client_stats.record(client_type, time.monotonic() - start, success=False, status=status)
+        if status == 429:
+            delay = random.uniform(3, 8)
+            logger.warning(f"Rate limited with {client_type}. Backing off {delay:.1f}s...")
+            limiter.penalize(delay)
+        elif status == 403:
+            logger.warning(f"Access denied with {client_type}. Trying next client...")
+            limiter.penalize(random.uniform(1, 3))
+        else:
+            logger.error(f"Error with {client_type}: {e}")
+        raise
+    client_stats.record(client_type, time.monotonic() - start, success=True)
+    limiter.record_success()
+    return yt
+
+def create_youtube_with_retry(video_url, max_retries=3, video_id=None):
     last_exception: Exception = Exception("Failed to connect to YouTube")
-    for client_type in CLIENT_TYPES[:max_retries]:
+    client_types = client_preferences.order(CLIENT_TYPES, video_id)[:max(max_retries, HEDGE_WIDTH)]
+    
+    if HEDGE_WIDTH > 1:
         try:
-            time.sleep(random.uniform(0.3, 1.0))
-            logger.debug(f"Trying client type: {client_type}")
-            yt = YouTube(video_url, client_type)
-            _ = yt.title
+            client_type, yt = hedged_resolve(
+                lambda ct: _attempt_client(video_url, ct, require_streams=True),
+                client_types,
+                width=HEDGE_WIDTH,
+                timeout=HEDGE_TIMEOUT
+            )
+            client_preferences.remember(video_id, client_type)
             return yt
         except Exception as e:
             last_exception = e
-            error_str = str(e).lower()
-            if '429' in error_str or 'too many requests' in error_str:
-                delay = random.uniform(3, 8)
-                logger.warning(f"Rate limited with {client_type}. Waiting {delay:.1f}s before trying next client...")
-                time.sleep(delay)
-            elif '403' in error_str:
-                delay = random.uniform(1, 3)
-                logger.warning(f"Access denied with {client_type}. Trying next client...")
-                time.sleep(delay)
-            else:
-                logger.error(f"Error with {client_type}: {e}")
-                continue
+    else:
+        for index, client_type in enumerate(client_types):
+            if index:
+                resolve_retries.labels(client_type).inc()
+            try:
+                yt = _attempt_client(video_url, client_type)
+                client_preferences.remember(video_id, client_type)
+                return yt
+            except Exception as e:
+                last_exception = e
     
     for attempt in range(2):
         try:
-            delay = random.uniform(5, 15)
-            logger.info(f"Final retry attempt {attempt + 1}. Waiting {delay:.1f}s...")
-            time.sleep(delay)
-            yt = YouTube(video_url, 'ANDROID')
-            _ = yt.title
+            logger.info("Final retry attempt %d", attempt + 1)
+            resolve_retries.labels('ANDROID').inc()
+            yt = _attempt_client(video_url, 'ANDROID')
+            client_preferences.remember(video_id, 'ANDROID')
             return yt
         except Exception as e:
             last_exception = e
-            continue
     
     raise last_exception
 
+def get_video_manifest(video_url):
+    video_id = extract_video_id(video_url)
+    if video_id:
+        manifest = manifest_cache.get(video_id)
+        if manifest is not None:
+            logger.debug("Manifest cache hit for %s", video_id)
+            prefetcher.used(video_id)
+            return manifest
+        manifest = prefetcher.join(video_id, timeout=HEDGE_TIMEOUT)
+        if manifest is not None:
+            return manifest
+    
+    start = time.monotonic()
+    yt = create_youtube_with_retry(video_url, video_id=video_id)
+    created = time.monotonic()
+    manifest = build_manifest(yt)
+    resolved = time.monotonic()
+    stage_seconds.labels('youtube_create').observe(created - start)
+    stage_seconds.labels('stream_resolution').observe(resolved - created)
+    manifest_cache.record_resolution(resolved - start)
+    
+    video_id = video_id or manifest["video_id"]
+    manifest_cache.put(video_id, manifest)
+    return manifest
+
+def prefetch_manifest(video_id):
+    # Single attempt with the preferred client: unlike a foreground request, a
+    # prefetch that fails is not retried with other clients.
+    video_url = f"https://www.youtube.com/watch?v={video_id}"
+    client_type = client_preferences.order(CLIENT_TYPES, video_id)[0]
+    start = time.monotonic()
+    yt = _attempt_client(video_url, client_type, require_streams=True)
+    manifest = build_manifest(yt)
+    manifest_cache.record_resolution(time.monotonic() - start)
+    client_preferences.remember(video_id, client_type)
+    manifest_cache.put(video_id, manifest)
+    return manifest
+
+def prefetch_search_results(videos):
+    prefetcher.submit(extract_video_id(video["lien"]) for video in videos)
+
+def video_info(manifest):
+    available_resolutions = []
+    for stream in progressive_streams(manifest):
+        size_mb = round(stream["filesize"] / (1024 * 1024), 2) if stream["filesize"] else "inconnu"
+        available_resolutions.append({
+            "resolution": stream["resolution"],
+            "fps": stream["fps"],
+            "size_mb": size_mb
+        })
+    
+    adaptive_streams = []
+    for video, audio, size in adaptive_resolutions(manifest):
+        adaptive_streams.append({
+            "resolution": video["resolution"],
+            "fps": video["fps"],
+            "video_codec": video["codecs"][0] if video["codecs"] else video["subtype"],
+            "size_mb": round(size / (1024 * 1024), 2) if size else "inconnu"
+        })
+    
+    return {
+        "title": manifest["title"],
+        "author": manifest["author"],
+        "length_seconds": manifest["length_seconds"],
+        "views": manifest["views"],
+        "thumbnail_url": manifest["thumbnail_url"],
+        "available_streams": available_resolutions,
+        "adaptive_streams": adaptive_streams
+    }
+
+def youtube_error_payload(e):
+    if error_status(e) == 429:
+        return {
+            "error": "YouTube limite temporairement les requêtes. Veuillez réessayer dans 30 secondes.",
+            "retry_after": 30,
+            "code": 429
+        }, 429
+    return {"error": str(e)}, 500
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -97,43 +418,62 @@ def get_video_info():
         return jsonify({"error": "Paramètre 'video_url' requis"}), 400
     
     try:
-        logger.debug(f"Getting info for video: {video_url}")
-        yt = create_youtube_with_retry(video_url)
-        logger.debug(f"YouTube object created, getting title...")
-        title = yt.title
-        logger.debug(f"Title: {title}")
-        streams = yt.streams.filter(progressive=True, file_extension='mp4')
-        logger.debug(f"Streams filtered")
-        
-        available_resolutions = []
-        for stream in streams:
-            try:
-                size_mb = round(stream.filesize / (1024 * 1024), 2) if stream.filesize else "inconnu"
-            except Exception:
-                size_mb = "inconnu"
-            available_resolutions.append({
-                "resolution": stream.resolution,
-                "fps": stream.fps,
-                "size_mb": size_mb
-            })
+        manifest = get_video_manifest(video_url)
         
-        return jsonify({
-            "title": title,
-            "author": yt.author,
-            "length_seconds": yt.length,
-            "views": yt.views,
-            "thumbnail_url": yt.thumbnail_url,
-            "available_streams": available_resolutions
-        })
+        return jsonify(video_info(manifest))
     except Exception as e:
-        error_str = str(e).lower()
-        if '429' in error_str or 'too many requests' in error_str:
-            return jsonify({
-                "error": "YouTube limite temporairement les requêtes. Veuillez réessayer dans 30 secondes.",
-                "retry_after": 30,
-                "code": 429
-            }), 429
-        return jsonify({"error": str(e)}), 500
+        payload, status = youtube_error_payload(e)
+        return jsonify(payload), status
+
+def parse_info_batch(payload):
+    # Accepts a JSON list, or an object with a "videos" list, of URLs or bare IDs.
+    # Returns the requested items deduplicated by video ID, in request order.
+    videos = payload.get('videos') if isinstance(payload, dict) else payload
+    if not isinstance(videos, list) or not all(isinstance(v, str) for v in videos):
+        return None
+    unique = {}
+    for video in videos:
+        video = video.strip()
+        if video:
+            unique.setdefault(extract_video_id(video) or video, video)
+    return unique
+
+def resolve_info_item(video_id, video):
+    video_url = f"https://www.youtube.com/watch?v={video_id}" if extract_video_id(video) else video
+    try:
+        info = video_info(get_video_manifest(video_url))
+        return {"video": video, "video_id": video_id, **info}
+    except Exception as e:
+        payload, status = youtube_error_payload(e)
+        return {"video": video, "video_id": video_id, "code": status, **payload}
+
+def iter_info_batch(items):
+    futures = [info_batch_executor.submit(resolve_info_item, video_id, video) for video_id, video in items.items()]
+    errors = 0
+    try:
+        for future in as_completed(futures):
+            result = future.result()
+            if "error" in result:
+                errors += 1
+            yield json.dumps(result) + '\n'
+    finally:
+        for future in futures:
+            future.cancel()
+    yield json.dumps({"nombre_videos": len(futures), "erreurs": errors, "termine": True}) + '\n'
+
+@app.route('/info/batch', methods=['POST'])
+def get_video_info_batch():
+    items = parse_info_batch(request.get_json(silent=True))
+    if items is None:
+        return jsonify({"error": "Corps JSON requis: une liste d'URLs ou d'IDs vidéo, ou {\"videos\": [...]}"}), 400
+    if len(items) > INFO_BATCH_MAX:
+        return jsonify({"error": f"Trop de vidéos: {INFO_BATCH_MAX} au maximum par requête"}), 400
+    
+    return Response(
+        iter_info_batch(items),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'}
+    )
 
 @app.route('/recherche', methods=['GET'])
 def search_videos():
@@ -148,85 +488,63 @@ def search_videos():
         return jsonify({"error": "Clé API YouTube non configurée. Veuillez définir YOUTUBE_API_KEY dans les variables d'environnement."}), 500
     
     try:
-        youtube = build('youtube', 'v3', developerKey=youtube_api_key)
-        
-        all_video_ids = []
-        next_page_token = None
-        
-        while len(all_video_ids) < max_results:
-            remaining = max_results - len(all_video_ids)
-            fetch_count = min(50, remaining)
-            
-            search_params = {
-                'q': query,
-                'part': 'id,snippet',
-                'type': 'video',
-                'maxResults': fetch_count
-            }
-            if next_page_token:
-                search_params['pageToken'] = next_page_token
-            
-            search_response = youtube.search().list(**search_params).execute()
-            
-            video_ids = [item['id']['videoId'] for item in search_response.get('items', [])]
-            all_video_ids.extend(video_ids)
-            
-            next_page_token = search_response.get('nextPageToken')
-            if not next_page_token:
-                break
-            
-            time.sleep(random.uniform(0.1, 0.3))
-        
-        all_video_ids = all_video_ids[:max_results]
-        
-        videos = []
-        
-        for i in range(0, len(all_video_ids), 50):
-            batch_ids = all_video_ids[i:i+50]
-            
-            if batch_ids:
-                videos_response = youtube.videos().list(
-                    id=','.join(batch_ids),
-                    part='snippet,contentDetails,statistics'
-                ).execute()
-                
-                for video in videos_response.get('items', []):
-                    video_id = video['id']
-                    snippet = video['snippet']
-                    content_details = video['contentDetails']
-                    
-                    duration_iso = content_details.get('duration', 'PT0S')
-                    duration_str = duration_iso.replace('PT', '').replace('H', 'h ').replace('M', 'm ').replace('S', 's')
-                    
-                    video_url = f"https://www.youtube.com/watch?v={video_id}"
-                    
-                    definition = content_details.get('definition', 'sd').upper()
-                    
-                    thumbnails = snippet.get('thumbnails', {})
-                    image_url = thumbnails.get('maxres', thumbnails.get('high', thumbnails.get('medium', {}))).get('url', '')
-                    
-                    videos.append({
-                        "titre": snippet.get('title', ''),
-                        "duree": duration_str.strip(),
-                        "qualite": definition,
-                        "lien": video_url,
-                        "image_url": image_url,
-                        "auteur": snippet.get('channelTitle', ''),
-                        "vues": video.get('statistics', {}).get('viewCount', 'N/A')
-                    })
-                
-                time.sleep(random.uniform(0.1, 0.2))
+        rewrite = thumbnail_rewriter(request.args, request.host_url)
+    except ValueError:
+        return jsonify({"error": "Largeur de miniature invalide"}), 400
+    
+    if request.args.get('stream') in ('1', 'true', 'ndjson'):
+        return Response(
+            iter_search_ndjson(query, max_results, youtube_api_key, on_videos=prefetch_search_results, rewrite=rewrite),
+            mimetype='application/x-ndjson',
+            headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'}
+        )
+    
+    try:
+        videos = search_youtube(query, max_results, youtube_api_key)
+        prefetch_search_results(videos)
         
         return jsonify({
             "recherche": query,
             "nombre_resultats": len(videos),
             "max_demande": max_results,
-            "videos": videos
+            "videos": rewrite(videos) if rewrite else videos
         })
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def thumbnail_rewriter(args, base_url):
+    # thumbs=1 points the results' image_url at /thumb (optionally thumb_width=...)
+    if args.get('thumbs') not in ('1', 'true'):
+        return None
+    width = parse_width(args.get('thumb_width'))
+    return lambda videos: proxied_thumbnails(videos, base_url, width)
+
+@app.route('/thumb/<video_id>', methods=['GET'])
+def get_thumbnail(video_id):
+    try:
+        width = parse_width(request.args.get('width'))
+    except ValueError:
+        return jsonify({"error": "Largeur invalide"}), 400
+    
+    try:
+        thumbnail = thumbnails.get(video_id, width, negotiate_format(request.headers.get('Accept')))
+    except ThumbnailNotFound:
+        return jsonify({"error": "Miniature introuvable"}), 404
+    except Exception as e:
+        logger.error(f"Thumbnail error: {e}")
+        return jsonify({"error": str(e)}), 502
+    
+    headers = {
+        'ETag': thumbnail["etag"],
+        'Cache-Control': f"public, max-age={THUMB_MAX_AGE}",
+        'Vary': 'Accept',
+    }
+    if etag_matches(request.headers.get('If-None-Match'), thumbnail["etag"]):
+        thumbnails.record_not_modified()
+        return Response(status=304, headers=headers)
+    return Response(thumbnail["data"], mimetype=thumbnail["mime_type"], headers=headers)
+
 def sanitize_filename(filename):
     filename = re.sub(r'[<>:"/\\|?*]', '', filename)
     filename = filename.strip()
@@ -234,153 +552,647 @@ def sanitize_filename(filename):
         filename = filename[:100]
     return filename if filename else "video"
 
-def generate_stream(stream_url, chunk_size=8192):
+def open_upstream(stream_url, byte_range=None, video_id=None):
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Encoding': 'identity',
-            'Connection': 'keep-alive',
-        }
-        with requests.get(stream_url, headers=headers, stream=True, timeout=300) as r:
-            r.raise_for_status()
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    yield chunk
-    except Exception as e:
-        logger.error(f"Stream error: {e}")
+        return fetcher.open(stream_url, byte_range)
+    except requests.HTTPError as e:
+        if video_id and e.response is not None and e.response.status_code == 403:
+            manifest_cache.invalidate(video_id)
         raise
 
-def download_audio_to_file(stream, output_path, filename):
+def generate_stream(stream_url, video_id=None, byte_range=None, size=None):
     try:
-        logger.debug(f"Downloading audio to {output_path}/{filename}")
-        downloaded_file = stream.download(output_path=output_path, filename=filename)
-        logger.debug(f"Audio downloaded: {downloaded_file}")
-        return downloaded_file
+        yield from fetcher.stream(stream_url, byte_range=byte_range, size=size)
     except Exception as e:
-        logger.error(f"Audio download error: {e}")
+        logger.error(f"Stream error: {e}")
+        if video_id and isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code == 403:
+            manifest_cache.invalidate(video_id)
         raise
 
-@app.route('/download', methods=['GET'])
-def download_video():
-    video_url = request.args.get('video_url')
-    qualite = request.args.get('qualite', '360p')
-    file_type = request.args.get('type', 'mp4').lower()
+def upstream_chunks(stream, video_id=None):
+    # Segmented fetches open their connections on first read; otherwise the connection
+    # is opened now so upstream errors surface before any response is sent.
+    if fetcher.segment_span(None, stream["filesize"]):
+        return generate_stream(stream["url"], video_id=video_id, size=stream["filesize"])
+    return fetcher.relay(open_upstream(stream["url"], video_id=video_id))
+
+def download_headers(filename, mime_type):
+    return {
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}",
+        'Content-Type': mime_type,
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    }
+
+def plan_download(manifest, file_type, qualite, bitrate):
+    video_id = manifest["video_id"]
+    title = sanitize_filename(manifest["title"])
+    
+    if file_type == 'mp3':
+        stream = select_audio(manifest)
+        if not stream:
+            return None
+        logger.debug("Audio stream found: itag %s", stream["itag"])
+        if not ffmpeg_available():
+            logger.warning("ffmpeg not found, serving the original audio stream without transcoding")
+            extension = 'm4a' if stream["subtype"] == 'mp4' else stream["subtype"]
+            return {
+                "kind": "passthrough",
+                "stream": stream,
+                "filename": f"{title}.{extension}",
+                "mime_type": f"audio/{stream['subtype']}",
+                "cache_key": None,
+            }
+        return {
+            "kind": "mp3",
+            "stream": stream,
+            "bitrate": bitrate,
+            "filename": f"{title}.mp3",
+            "mime_type": 'audio/mpeg',
+            "cache_key": f"{video_id}:mp3-{bitrate}",
+        }
+    
+    logger.debug("Looking for stream with resolution: %s", qualite)
+    stream = select_progressive(manifest, qualite)
+    
+    if (not stream or stream["resolution"] != qualite) and ffmpeg_available():
+        video_stream = select_adaptive(manifest, qualite)
+        audio_stream = select_audio(manifest, subtype='mp4')
+        if video_stream and audio_stream:
+            logger.debug("Muxing adaptive streams: video itag %s, audio itag %s", video_stream["itag"], audio_stream["itag"])
+            return {
+                "kind": "muxed",
+                "video_stream": video_stream,
+                "audio_stream": audio_stream,
+                "filename": f"{title}.mp4",
+                "mime_type": 'video/mp4',
+                "cache_key": f"{video_id}:{video_stream['itag']}+{audio_stream['itag']}",
+            }
+    
+    if not stream:
+        return None
+    if stream["resolution"] != qualite:
+        logger.debug("Exact resolution not found, using %s", stream["resolution"])
+    logger.debug("Stream found: itag %s", stream["itag"])
+    return {
+        "kind": "progressive",
+        "stream": stream,
+        "filename": f"{title}.mp4",
+        "mime_type": 'video/mp4',
+        "cache_key": f"{video_id}:{stream['itag']}",
+    }
+
+def plan_clip(manifest, plan, start, end):
+    # Narrows a download plan to [start, end) seconds; raises ClipError
+    start, end = clip_bounds(start, end, manifest["length_seconds"])
+    if plan["kind"] == 'muxed':
+        streams = [plan["video_stream"], plan["audio_stream"]]
+    else:
+        streams = [plan["stream"]]
+    name, extension = os.path.splitext(plan["filename"])
+    return {
+        "kind": "clip",
+        "streams": streams,
+        "start": start,
+        "end": end,
+        "bitrate": plan.get("bitrate") if plan["kind"] == 'mp3' else None,
+        "filename": f"{name} ({start:g}-{end:g}s){extension}",
+        "mime_type": plan["mime_type"],
+        "cache_key": f"{plan['cache_key']}:clip-{start:g}-{end:g}" if plan["cache_key"] else None,
+    }
+
+def produce_clip(plan, video_id):
+    # Reads the index of each stream, fetches only the byte ranges covering the clip
+    # into temporary files, then has ffmpeg cut them.
+    with tempfile.TemporaryDirectory(dir=DOWNLOAD_FOLDER) as tmp:
+        paths = []
+        for index, stream in enumerate(plan["streams"]):
+            url, size = stream["url"], stream["filesize"]
+            reader = RangeReader(lambda byte_range: open_upstream(url, byte_range, video_id), size)
+            located = locate_clip(reader, plan["start"], plan["end"])
+            record_clip(located)
+            logger.debug("Clip of itag %s: %s layout, ranges %s", stream["itag"], located["layout"], located["ranges"])
+            path = os.path.join(tmp, f"{index}-{stream['itag']}")
+            write_clip(path, located, lambda byte_range: generate_stream(url, video_id=video_id, byte_range=byte_range, size=size))
+            paths.append(path)
+        yield from extract_clip(paths, plan["start"], plan["end"] - plan["start"], bitrate=plan["bitrate"])
+
+def produce_download(plan, video_id):
+    if plan["kind"] == 'clip':
+        return produce_clip(plan, video_id)
+    if plan["kind"] == 'mp3':
+        return transcode_mp3(upstream_chunks(plan["stream"], video_id), bitrate=plan["bitrate"])
+    if plan["kind"] == 'muxed':
+        return remux_fmp4(
+            upstream_chunks(plan["video_stream"], video_id),
+            upstream_chunks(plan["audio_stream"], video_id)
+        )
+    return upstream_chunks(plan["stream"], video_id)
+
+def cached_or_produced(plan, manifest, wrap=None, uncached=None):
+    # `wrap` applies to the produced chunks, cached or not; `uncached` only to those
+    # that bypass the media cache
+    video_id = manifest["video_id"]
+    def produce():
+        chunks = produce_download(plan, video_id)
+        return wrap(chunks) if wrap else chunks
+    if plan["cache_key"] and media_cache.admits(estimated_size(plan, manifest)):
+        return media_cache.stream(plan["cache_key"], produce)
+    return uncached(produce()) if uncached else produce()
+
+def send_cached(path, filename, mimetype, etag=None):
+    response = send_file(
+        path,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=filename,
+        conditional=True,
+        etag=etag.strip('"') if etag else True
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def estimated_size(plan, manifest):
+    if plan["kind"] == 'clip':
+        duration = plan["end"] - plan["start"]
+        if plan["bitrate"]:
+            return duration * plan["bitrate"] * 125
+        sizes = [stream["filesize"] for stream in plan["streams"]]
+        if not all(sizes) or not manifest["length_seconds"]:
+            return None
+        return int(sum(sizes) * duration / manifest["length_seconds"])
+    if plan["kind"] == 'mp3':
+        return manifest["length_seconds"] * plan["bitrate"] * 125 if manifest["length_seconds"] else None
+    if plan["kind"] == 'muxed':
+        sizes = (plan["video_stream"]["filesize"], plan["audio_stream"]["filesize"])
+        return sum(sizes) if all(sizes) else None
+    return plan["stream"]["filesize"]
+
+def run_download_job(params):
+    manifest = get_video_manifest(params["video_url"])
+    plan = plan_download(manifest, params["type"], params["qualite"], params["bitrate"])
+    if not plan:
+        raise LookupError("Aucun flux audio disponible" if params["type"] == 'mp3' else "Aucun flux vidéo disponible")
+    return {
+        "filename": plan["filename"],
+        "mime_type": plan["mime_type"],
+        "chunks": cached_or_produced(plan, manifest),
+        "total": estimated_size(plan, manifest),
+    }
+
+def range_not_satisfiable(message, file_size=None):
+    return jsonify({"error": message}), 416, {
+        'Content-Range': f"bytes */{file_size if file_size else '*'}",
+        'Accept-Ranges': 'bytes',
+    }
+
+def no_stream_error(file_type):
+    if file_type == 'mp3':
+        return jsonify({"error": "Aucun flux audio disponible"}), 404
+    return jsonify({"error": "Aucun flux vidéo disponible"}), 404
+
+def admission_refused(e):
+    if e.reason == 'client_queue_full':
+        message, status = "Trop de téléchargements simultanés pour ce client", 429
+    else:
+        message, status = "Serveur saturé", 503
+    payload = {"error": f"{message}. Réessayez dans {e.retry_after} secondes.", "retry_after": e.retry_after, "code": status}
+    return payload, status, {'Retry-After': str(e.retry_after)}
+
+def parse_download_request(args):
+    # Returns (download params, None) or (None, (error message, status))
+    video_url = args.get('video_url')
+    file_type = args.get('type', 'mp4').lower()
     
     if not video_url:
-        return jsonify({"error": "Paramètre 'video_url' requis"}), 400
+        return None, ("Paramètre 'video_url' requis", 400)
     
     if file_type not in ['mp3', 'mp4']:
-        return jsonify({"error": "Type invalide. Utilisez 'mp3' ou 'mp4'"}), 400
+        return None, ("Type invalide. Utilisez 'mp3' ou 'mp4'", 400)
+    
+    bitrate = parse_bitrate(args.get('bitrate'))
+    if bitrate is None:
+        return None, (f"Débit invalide. Valeurs possibles: {', '.join(str(b) for b in MP3_BITRATES)}", 400)
+    
+    try:
+        clip_start = parse_timestamp(args.get('start'))
+        clip_end = parse_timestamp(args.get('end'))
+    except ValueError:
+        return None, ("Horodatage invalide. Utilisez des secondes ou hh:mm:ss", 400)
+    if (clip_start is not None or clip_end is not None) and not ffmpeg_available():
+        return None, ("ffmpeg est nécessaire pour extraire un extrait", 501)
+    
+    return {
+        "video_url": video_url,
+        "type": file_type,
+        "qualite": args.get('qualite', '360p'),
+        "bitrate": bitrate,
+        "start": clip_start,
+        "end": clip_end,
+    }, None
+
+@app.route('/download', methods=['GET'])
+def download_video():
+    # Invalid requests are refused before they can wait for a slot; admission then
+    # comes before resolving the manifest, which is what draws upstream 429s
+    params, error = parse_download_request(request.args)
+    if error:
+        message, status = error
+        return jsonify({"error": message}), status
+    client = request_client()
+    try:
+        ticket = admission.acquire(client)
+    except AdmissionRejected as e:
+        payload, status, headers = admission_refused(e)
+        return jsonify(payload), status, headers
+    try:
+        response = app.make_response(serve_download(client, params))
+    except BaseException:
+        if ticket:
+            ticket.release()
+        raise
+    if ticket:
+        if isinstance(response.response, request.environ.get('wsgi.file_wrapper', FileWrapper)):
+            # Cache hits: the server only uses sendfile for its own file_wrapper, so the
+            # body must not be wrapped. They no longer touch the upstream; free the slot
+            # now, as the async app does when it returns a FileResponse
+            ticket.release()
+        elif response.direct_passthrough:
+            response.response = AdmittedBody(response.response, ticket)
+        else:
+            response.call_on_close(ticket.release)
+    return response
+
+def serve_download(client, params):
+    def paced(chunks):
+        return download_bandwidth.paced(chunks, client)
+    
+    video_url = params["video_url"]
+    qualite = params["qualite"]
+    file_type = params["type"]
+    bitrate = params["bitrate"]
+    clip_start, clip_end = params["start"], params["end"]
+    clipping = clip_start is not None or clip_end is not None
     
+    started = time.monotonic()
     try:
-        logger.debug(f"Download request for: {video_url}, type: {file_type}, quality: {qualite}")
-        yt = create_youtube_with_retry(video_url)
-        title = sanitize_filename(yt.title)
-        logger.debug(f"YouTube object created for download, title: {title}")
+        manifest = get_video_manifest(video_url)
+        video_id = manifest["video_id"]
+        plan = plan_download(manifest, file_type, qualite, bitrate)
         
-        if file_type == 'mp3':
-            stream = yt.streams.filter(only_audio=True).order_by('abr').desc().first()
-            
-            if not stream:
-                return jsonify({"error": "Aucun flux audio disponible"}), 404
-            
-            logger.debug(f"Audio stream found: {stream}")
-            
-            temp_filename = f"{title}_{int(time.time())}"
-            downloaded_file = download_audio_to_file(stream, DOWNLOAD_FOLDER, temp_filename)
-            
-            if not downloaded_file or not os.path.exists(downloaded_file):
-                return jsonify({"error": "Échec du téléchargement audio"}), 500
-            
-            final_filename = f"{title}.mp3"
-            encoded_filename = quote(final_filename)
-            audio_file_path = downloaded_file
-            
-            def generate_and_cleanup():
-                try:
-                    with open(audio_file_path, 'rb') as f:
-                        while True:
-                            chunk = f.read(8192)
-                            if not chunk:
-                                break
-                            yield chunk
-                finally:
-                    try:
-                        if os.path.exists(audio_file_path):
-                            os.remove(audio_file_path)
-                            logger.debug(f"Cleaned up temp file: {audio_file_path}")
-                    except Exception as cleanup_error:
-                        logger.error(f"Cleanup error: {cleanup_error}")
-            
-            file_size = os.path.getsize(audio_file_path)
-            
-            response_headers = {
-                'Content-Disposition': f"attachment; filename*=UTF-8''{encoded_filename}",
-                'Content-Type': 'audio/mpeg',
-                'Content-Length': str(file_size),
-                'Cache-Control': 'no-cache',
-            }
-            
+        if not plan:
+            return no_stream_error(file_type)
+        
+        if clipping:
+            try:
+                plan = plan_clip(manifest, plan, clip_start, clip_end)
+            except ClipError as e:
+                return jsonify({"error": str(e)}), 400
+        
+        headers = download_headers(plan["filename"], plan["mime_type"])
+        
+        if plan["kind"] != 'progressive':
+            if plan["kind"] == 'passthrough' and plan["stream"]["filesize"]:
+                headers['Content-Length'] = str(plan["stream"]["filesize"])
+            # Produced on the fly, or relayed from the start for passthrough: Range is
+            # ignored here, only media cache hits serve byte ranges
+            headers['Accept-Ranges'] = 'none'
+            if media_cache.enabled and plan["cache_key"]:
+                cached_path = media_cache.get(plan["cache_key"])
+                if cached_path:
+                    return send_cached(cached_path, plan["filename"], plan["mime_type"])
             return Response(
-                generate_and_cleanup(),
-                headers=response_headers,
-                mimetype='audio/mpeg',
+                observe_stream(relay_from_env(paced(cached_or_produced(plan, manifest))), plan["kind"], started),
+                headers=headers,
+                mimetype=plan["mime_type"],
                 direct_passthrough=True
             )
-        else:
-            logger.debug(f"Looking for stream with resolution: {qualite}")
-            stream = yt.streams.filter(progressive=True, file_extension='mp4', resolution=qualite).first()
-            
-            if not stream:
-                logger.debug("Exact resolution not found, getting best available")
-                stream = yt.streams.filter(progressive=True, file_extension='mp4').order_by('resolution').desc().first()
-            
-            if not stream:
-                return jsonify({"error": "Aucun flux vidéo disponible"}), 404
-            
-            mime_type = 'video/mp4'
-            extension = 'mp4'
-            
-            logger.debug(f"Stream found: {stream}")
-            stream_url = stream.url
-            logger.debug(f"Stream URL obtained, starting proxy download")
-            
-            try:
-                file_size = stream.filesize
-            except Exception:
-                file_size = None
-            
-            filename = f"{title}.{extension}"
-            encoded_filename = quote(filename)
-            
-            headers = {
-                'Content-Disposition': f"attachment; filename*=UTF-8''{encoded_filename}",
-                'Content-Type': mime_type,
-                'Cache-Control': 'no-cache',
-                'X-Accel-Buffering': 'no',
-            }
-            
-            if file_size:
-                headers['Content-Length'] = str(file_size)
-            
+        
+        stream = plan["stream"]
+        stream_url = stream["url"]
+        file_size = stream["filesize"]
+        etag = stream_etag(video_id, stream)
+        last_modified = http_date(stream["last_modified"])
+        
+        headers['Accept-Ranges'] = 'bytes'
+        headers['ETag'] = etag
+        if last_modified:
+            headers['Last-Modified'] = last_modified
+        
+        if media_cache.enabled:
+            cached_path = media_cache.get(plan["cache_key"])
+            if cached_path:
+                return send_cached(cached_path, plan["filename"], plan["mime_type"], etag=etag)
+            if not request.headers.get('Range'):
+                if file_size:
+                    headers['Content-Length'] = str(file_size)
+                return Response(
+                    observe_stream(relay_from_env(paced(cached_or_produced(plan, manifest))), plan["kind"], started),
+                    headers=headers,
+                    mimetype=plan["mime_type"],
+                    direct_passthrough=True
+                )
+        
+        try:
+            byte_range = parse_range_header(request.headers.get('Range'), file_size)
+        except MultipleRangesNotSupported:
+            return range_not_satisfiable("Les plages multiples ne sont pas prises en charge", file_size)
+        except RangeNotSatisfiable:
+            return range_not_satisfiable("Plage demandée invalide", file_size)
+        
+        if byte_range and not if_range_matches(request.headers.get('If-Range'), etag, last_modified):
+            logger.debug("If-Range validator mismatch, sending full content")
+            byte_range = None
+        
+        if fetcher.segment_span(byte_range, file_size):
+            status = apply_range_headers(headers, byte_range, file_size, 206 if byte_range else 200)
             return Response(
-                generate_stream(stream_url),
+                observe_stream(
+                    relay_from_env(paced(generate_stream(stream_url, video_id=video_id, byte_range=byte_range, size=file_size))),
+                    plan["kind"],
+                    started
+                ),
+                status=status,
                 headers=headers,
-                mimetype=mime_type,
+                mimetype=plan["mime_type"],
                 direct_passthrough=True
             )
         
+        try:
+            upstream = open_upstream(stream_url, byte_range=byte_range, video_id=video_id)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 416:
+                return range_not_satisfiable("Plage demandée invalide", file_size)
+            raise
+        
+        status = apply_range_headers(headers, byte_range, file_size, upstream.status_code, upstream.headers)
+        return Response(
+            observe_stream(relay_from_env(paced(fetcher.relay(upstream)), closer=upstream.close), plan["kind"], started),
+            status=status,
+            headers=headers,
+            mimetype=plan["mime_type"],
+            direct_passthrough=True
+        )
+        
     except Exception as e:
         logger.error(f"Download error: {e}")
-        error_str = str(e).lower()
-        if '429' in error_str or 'too many requests' in error_str:
-            return jsonify({
-                "error": "YouTube limite temporairement les requêtes. Veuillez réessayer dans 30 secondes.",
-                "retry_after": 30,
-                "code": 429
-            }), 429
-        return jsonify({"error": str(e)}), 500
+        payload, status = youtube_error_payload(e)
+        return jsonify(payload), status
+
+def forwarded_address(forwarded, remote):
+    # The address added by the outermost trusted proxy, as ProxyFix(x_for=N) picks it
+    hops = [hop.strip() for hop in (forwarded or '').split(',') if hop.strip()]
+    if TRUSTED_PROXIES and len(hops) >= TRUSTED_PROXIES:
+        return hops[-TRUSTED_PROXIES]
+    return remote or 'unknown'
+
+def request_client():
+    # ProxyFix has already resolved remote_addr when proxies are trusted
+    return download_client(request.headers.get('X-API-Key'), request.remote_addr or 'unknown', admission.weights)
+
+def job_payload(job):
+    total = job["bytes_total"]
+    if job["status"] == 'done':
+        percent = 100.0
+    elif total:
+        # The total is an estimate for transcoded and muxed output
+        percent = round(min(99.0, job["bytes_done"] * 100 / total), 1)
+    else:
+        percent = None
+    payload = {
+        "id": job["id"],
+        "status": job["status"],
+        "video_url": job["params"]["video_url"],
+        "type": job["params"]["type"],
+        "priority": job["priority"],
+        "progress": {"bytes": job["bytes_done"], "total": total, "percent": percent},
+        "filename": job["filename"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "status_url": f"/jobs/{job['id']}",
+    }
+    if job["status"] == 'queued':
+        payload["position"] = job["position"]
+    if job["status"] == 'done':
+        payload["artifact_url"] = f"/jobs/{job['id']}/fichier"
+    if job["error"]:
+        payload["error"] = job["error"]
+    return payload
+
+def parse_job_request(params, client=None):
+    # Returns (job params, priority, None) or (None, None, error message)
+    if not isinstance(params, dict):
+        return None, None, "Corps de requête invalide: objet JSON ou formulaire attendu"
+    
+    video_url = params.get('video_url')
+    file_type = str(params.get('type', 'mp4')).lower()
+    
+    if not video_url:
+        return None, None, "Paramètre 'video_url' requis"
+    
+    if file_type not in ['mp3', 'mp4']:
+        return None, None, "Type invalide. Utilisez 'mp3' ou 'mp4'"
+    
+    bitrate = parse_bitrate(params.get('bitrate'))
+    if bitrate is None:
+        return None, None, f"Débit invalide. Valeurs possibles: {', '.join(str(b) for b in MP3_BITRATES)}"
+    
+    try:
+        priority = int(params.get('priorite', 0))
+    except (TypeError, ValueError):
+        return None, None, "Priorité invalide: un entier est attendu"
+    highest = JOBS_MAX_PRIORITY if client in admission.weights else 0
+    priority = max(-JOBS_MAX_PRIORITY, min(highest, priority))
+    
+    return {
+        "video_url": video_url,
+        "type": file_type,
+        "qualite": params.get('qualite', '360p'),
+        "bitrate": bitrate,
+    }, priority, None
+
+QUEUE_FULL_PAYLOAD = {
+    "error": "File d'attente pleine. Veuillez réessayer plus tard.",
+    "retry_after": 30,
+    "code": 503
+}
+
+@app.before_request
+def bound_client_send():
+    limit_client_send(request.environ)
+
+jobs_routes = Blueprint('jobs', __name__)
+
+@jobs_routes.before_app_request
+def start_job_workers():
+    job_queue.start()
+
+@jobs_routes.route('/jobs', methods=['POST'])
+def create_job():
+    client = request_client()
+    params, priority, error = parse_job_request(request.get_json(silent=True) or request.form, client)
+    if error:
+        return jsonify({"error": error}), 400
+    
+    try:
+        job = job_queue.submit(client, params, priority=priority)
+    except QueueFull:
+        return jsonify(QUEUE_FULL_PAYLOAD), 503, {'Retry-After': '30'}
+    
+    return jsonify(job_payload(job)), 202, {'Location': f"/jobs/{job['id']}"}
+
+@jobs_routes.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": "Tâche introuvable"}), 404
+    return jsonify(job_payload(job))
+
+@jobs_routes.route('/jobs/<job_id>/fichier', methods=['GET'])
+def get_job_artifact(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": "Tâche introuvable"}), 404
+    if job["status"] == 'expired':
+        return jsonify({"error": "Le fichier a expiré"}), 410
+    if job["status"] != 'done' or not job["artifact"] or not os.path.exists(job["artifact"]):
+        return jsonify({"error": "Le fichier n'est pas encore prêt", **job_payload(job)}), 409
+    return send_cached(job["artifact"], job["filename"], job["mime_type"], etag=f'"{job_id}"')
+
+if JOBS_ENABLED:
+    app.register_blueprint(jobs_routes)
+
+def parse_playlist_limit(value):
+    try:
+        limit = int(value) if value else PLAYLIST_MAX_ITEMS
+    except ValueError:
+        return None
+    return limit if 0 < limit <= PLAYLIST_MAX_ITEMS else None
+
+def start_playlist_item(entry, file_type, qualite, bitrate):
+    # Runs ahead of the archive writer: resolves the video and starts its download
+    # so it proceeds in the background, as a cache fill or else read ahead in memory.
+    manifest = get_video_manifest(entry["video_url"])
+    plan = plan_download(manifest, file_type, qualite, bitrate)
+    if not plan:
+        raise LookupError("Aucun flux audio disponible" if file_type == 'mp3' else "Aucun flux vidéo disponible")
+    return plan["filename"], cached_or_produced(plan, manifest, wrap=throttled, uncached=read_ahead)
+
+def discard_playlist_item(result):
+    close = getattr(result[1], 'close', None)
+    if close:
+        close()
+
+def guarded_chunks(chunks, entry, failures):
+    # An error mid-transfer truncates this member but keeps the archive valid
+    try:
+        yield from chunks
+    except Exception as e:
+        logger.error(f"Playlist item {entry['video_url']} failed: {e}")
+        failures.append(f"{entry['index']:03d} {entry['video_url']}: transfert interrompu ({e})")
+
+def iter_playlist_members(source, file_type, qualite, bitrate, limit):
+    used = set()
+    failures = []
+    items = iter_pipelined(
+        iter_playlist_entries(source, limit),
+        lambda entry: start_playlist_item(entry, file_type, qualite, bitrate),
+        PLAYLIST_CONCURRENCY,
+        discard=discard_playlist_item
+    )
+    for entry, result, error in items:
+        if error:
+            failures.append(f"{entry['index']:03d} {entry['video_url']}: {error}")
+            continue
+        filename, chunks = result
+        yield archive_name(entry["index"], filename, used), guarded_chunks(chunks, entry, failures)
+    if failures:
+        yield 'erreurs.txt', ['\n'.join(failures).encode('utf-8') + b'\n']
+
+@app.route('/playlist', methods=['GET'])
+def download_playlist():
+    playlist_url = request.args.get('url')
+    qualite = request.args.get('qualite', '360p')
+    file_type = request.args.get('type', 'mp4').lower()
+    
+    if not playlist_url:
+        return jsonify({"error": "Paramètre 'url' requis"}), 400
+    
+    if file_type not in ['mp3', 'mp4']:
+        return jsonify({"error": "Type invalide. Utilisez 'mp3' ou 'mp4'"}), 400
+    
+    bitrate = parse_bitrate(request.args.get('bitrate'))
+    if bitrate is None:
+        return jsonify({"error": f"Débit invalide. Valeurs possibles: {', '.join(str(b) for b in MP3_BITRATES)}"}), 400
+    
+    limit = parse_playlist_limit(request.args.get('max'))
+    if limit is None:
+        return jsonify({"error": f"Paramètre 'max' invalide: entre 1 et {PLAYLIST_MAX_ITEMS}"}), 400
+    
+    try:
+        source = playlist_source(playlist_url)
+        title = sanitize_filename(source_title(source) or 'playlist')
+    except Exception as e:
+        logger.error(f"Playlist error: {e}")
+        payload, status = youtube_error_payload(e)
+        return jsonify(payload), status
+    
+    return Response(
+        observe_stream(relay_from_env(iter_zip(iter_playlist_members(source, file_type, qualite, bitrate, limit))), 'playlist'),
+        headers=download_headers(f"{title}.zip", 'application/zip'),
+        mimetype='application/zip',
+        direct_passthrough=True
+    )
+
+@app.route('/playlist/entries', methods=['GET'])
+def list_playlist_entries():
+    playlist_url = request.args.get('url')
+    if not playlist_url:
+        return jsonify({"error": "Paramètre 'url' requis"}), 400
+    
+    limit = parse_playlist_limit(request.args.get('max'))
+    if limit is None:
+        return jsonify({"error": f"Paramètre 'max' invalide: entre 1 et {PLAYLIST_MAX_ITEMS}"}), 400
+    
+    def generate():
+        try:
+            for entry in iter_playlist_entries(playlist_source(playlist_url), limit):
+                yield json.dumps(entry) + '\n'
+        except Exception as e:
+            logger.error(f"Playlist error: {e}")
+            yield json.dumps({"error": str(e)}) + '\n'
+    
+    return Response(
+        generate(),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'}
+    )
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        "manifest_cache": manifest_cache.stats(),
+        "rate_limiters": limiter_stats(),
+        "clients": client_stats.stats(),
+        "fetcher": fetcher.stats(),
+        "media_cache": media_cache.stats(),
+        "search_cache": search_cache.stats(),
+        "data_api_quota": quota.stats(),
+        "jobs": job_queue.stats() if JOBS_ENABLED else None,
+        "playlist_bandwidth": bandwidth_stats(),
+        "relays": relay_stats(),
+        "prefetch": prefetcher.stats(),
+        "player_cache": player_cache.stats(),
+        "clips": clip_stats(),
+        "thumbnails": thumbnails.stats(),
+        "admission": admission.stats(),
+        "download_bandwidth": download_bandwidth.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)
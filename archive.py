@@ -0,0 +1,45 @@
+import time
+import zipfile
+
+
+class _Sink:
+    # Write-only file object. It has no tell()/seek(), so ZipFile treats it as
+    # unseekable and writes each entry with a data descriptor after its contents.
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def iter_zip(entries):
+    # Streams a ZIP archive of `entries`, an iterable of (name, chunks) pairs. Members
+    # are stored uncompressed (media is already compressed) and written as they are
+    # read, so memory use is one chunk plus the central directory.
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, chunks in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with archive.open(info, 'w', force_zip64=True) as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data
@@ -0,0 +1,523 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+import app as core
+from admission import AdmissionRejected, download_client
+from clip import ClipError
+from fetcher import UPSTREAM_HEADERS
+from metrics import StreamTimer, observe_stream, registry, stage_seconds
+from ranges import (
+    MultipleRangesNotSupported,
+    RangeNotSatisfiable,
+    apply_range_headers,
+    format_range_header,
+    http_date,
+    if_range_matches,
+    parse_range_header,
+    stream_etag,
+)
+from ratelimit import get_limiter, parse_retry_after
+from thumbs import ThumbnailNotFound, etag_matches, negotiate_format, parse_width
+from transcode import MP3_BITRATES, parse_bitrate
+
+logger = logging.getLogger(__name__)
+
+# pytubefix resolution, the Data API client and other short blocking calls run here
+# so the event loop only ever waits on sockets.
+blocking_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASYNC_EXECUTOR_WORKERS', 16)),
+    thread_name_prefix='async-blocking'
+)
+
+# Reads from streamed bodies (ffmpeg pipes, media cache tails, playlist archives) can
+# block for as long as their producer takes; they get their own threads so a batch of
+# transcodes cannot starve resolution in blocking_executor.
+stream_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASYNC_STREAM_WORKERS', 64)),
+    thread_name_prefix='async-stream'
+)
+
+_END = object()
+
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+
+
+async def iterate_blocking(iterator):
+    loop = asyncio.get_running_loop()
+    pending = None
+    try:
+        while True:
+            pending = stream_executor.submit(next, iterator, _END)
+            chunk = await asyncio.wrap_future(pending)
+            if chunk is _END:
+                break
+            yield chunk
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close:
+            await loop.run_in_executor(stream_executor, _close_after, pending, close)
+
+
+def _close_after(pending, close):
+    # When the handler is cancelled mid-read, next() may still be running on another
+    # thread; closing a generator while it executes raises instead of closing it
+    if pending is not None:
+        try:
+            pending.result()
+        except BaseException:
+            pass
+    close()
+
+
+def json_error(message, status, headers=None):
+    return web.json_response({"error": message}, status=status, headers=headers)
+
+
+def youtube_error(e):
+    payload, status = core.youtube_error_payload(e)
+    return web.json_response(payload, status=status)
+
+
+def range_not_satisfiable(message, file_size=None):
+    return json_error(message, 416, {
+        'Content-Range': f"bytes */{file_size if file_size else '*'}",
+        'Accept-Ranges': 'bytes',
+    })
+
+
+async def home(request):
+    return web.FileResponse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'index.html'))
+
+
+async def get_video_info(request):
+    video_url = request.query.get('video_url')
+
+    if not video_url:
+        return json_error("Paramètre 'video_url' requis", 400)
+
+    try:
+        manifest = await run_blocking(core.get_video_manifest, video_url)
+        return web.json_response(core.video_info(manifest))
+    except Exception as e:
+        return youtube_error(e)
+
+
+async def get_video_info_batch(request):
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    items = core.parse_info_batch(payload)
+    if items is None:
+        return json_error("Corps JSON requis: une liste d'URLs ou d'IDs vidéo, ou {\"videos\": [...]}", 400)
+    if len(items) > core.INFO_BATCH_MAX:
+        return json_error(f"Trop de vidéos: {core.INFO_BATCH_MAX} au maximum par requête", 400)
+
+    headers = {'Content-Type': 'application/x-ndjson', 'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'}
+    lines = (line.encode('utf-8') for line in core.iter_info_batch(items))
+    return await stream_blocking(request, lines, headers)
+
+
+async def search_videos(request):
+    query = request.query.get('video')
+    try:
+        max_results = int(request.query.get('max_results', 200))
+    except ValueError:
+        max_results = 200
+
+    if not query:
+        return json_error("Paramètre 'video' requis", 400)
+
+    youtube_api_key = os.environ.get("YOUTUBE_API_KEY")
+    if not youtube_api_key:
+        return json_error("Clé API YouTube non configurée. Veuillez définir YOUTUBE_API_KEY dans les variables d'environnement.", 500)
+
+    try:
+        rewrite = core.thumbnail_rewriter(request.query, f"{request.url.origin()}/")
+    except ValueError:
+        return json_error("Largeur de miniature invalide", 400)
+
+    if request.query.get('stream') in ('1', 'true', 'ndjson'):
+        headers = {'Content-Type': 'application/x-ndjson', 'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'}
+        lines = (line.encode('utf-8') for line in core.iter_search_ndjson(
+            query, max_results, youtube_api_key, on_videos=core.prefetch_search_results, rewrite=rewrite
+        ))
+        return await stream_blocking(request, lines, headers)
+
+    try:
+        videos = await run_blocking(core.search_youtube, query, max_results, youtube_api_key)
+        core.prefetch_search_results(videos)
+        return web.json_response({
+            "recherche": query,
+            "nombre_resultats": len(videos),
+            "max_demande": max_results,
+            "videos": rewrite(videos) if rewrite else videos
+        })
+    except Exception as e:
+        return json_error(str(e), 500)
+
+
+async def get_thumbnail(request):
+    video_id = request.match_info['video_id']
+    try:
+        width = parse_width(request.query.get('width'))
+    except ValueError:
+        return json_error("Largeur invalide", 400)
+
+    try:
+        thumbnail = await run_blocking(core.thumbnails.get, video_id, width, negotiate_format(request.headers.get('Accept')))
+    except ThumbnailNotFound:
+        return json_error("Miniature introuvable", 404)
+    except Exception as e:
+        logger.error(f"Thumbnail error: {e}")
+        return json_error(str(e), 502)
+
+    headers = {
+        'ETag': thumbnail["etag"],
+        'Cache-Control': f"public, max-age={core.THUMB_MAX_AGE}",
+        'Vary': 'Accept',
+    }
+    if etag_matches(request.headers.get('If-None-Match'), thumbnail["etag"]):
+        core.thumbnails.record_not_modified()
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=thumbnail["data"], content_type=thumbnail["mime_type"], headers=headers)
+
+
+async def stream_blocking(request, iterator, headers, status=200, client=None):
+    # With a client, chunks are paced by the shared bandwidth scheduler on the loop
+    # rather than by sleeping in an executor thread
+    response = web.StreamResponse(status=status, headers=headers)
+    await response.prepare(request)
+    flow = core.download_bandwidth.open(client) if client is not None else None
+    try:
+        async for chunk in iterate_blocking(iterator):
+            if flow:
+                delay = core.download_bandwidth.reserve(flow, len(chunk))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await response.write(chunk)
+    finally:
+        if flow:
+            core.download_bandwidth.close(flow)
+    await response.write_eof()
+    return response
+
+
+async def proxy_progressive(request, plan, video_id, headers, started, client):
+    stream = plan["stream"]
+    file_size = stream["filesize"]
+    etag = stream_etag(video_id, stream)
+    last_modified = http_date(stream["last_modified"])
+    headers['Accept-Ranges'] = 'bytes'
+    headers['ETag'] = etag
+    if last_modified:
+        headers['Last-Modified'] = last_modified
+
+    try:
+        byte_range = parse_range_header(request.headers.get('Range'), file_size)
+    except MultipleRangesNotSupported:
+        return range_not_satisfiable("Les plages multiples ne sont pas prises en charge", file_size)
+    except RangeNotSatisfiable:
+        return range_not_satisfiable("Plage demandée invalide", file_size)
+
+    if byte_range and not if_range_matches(request.headers.get('If-Range'), etag, last_modified):
+        byte_range = None
+
+    limiter = get_limiter('cdn')
+    delay = limiter.reserve()
+    if delay:
+        await asyncio.sleep(delay)
+
+    upstream_headers = {}
+    if byte_range:
+        upstream_headers['Range'] = format_range_header(byte_range)
+
+    session = request.app['http']
+    connect_started = time.monotonic()
+    async with session.get(stream["url"], headers=upstream_headers) as upstream:
+        stage_seconds.labels('upstream_connect').observe(time.monotonic() - connect_started)
+        if upstream.status in (403, 429):
+            limiter.penalize(parse_retry_after(upstream.headers.get('Retry-After')))
+            if upstream.status == 403:
+                core.manifest_cache.invalidate(video_id)
+        if upstream.status == 416:
+            return range_not_satisfiable("Plage demandée invalide", file_size)
+        if upstream.status >= 400:
+            return json_error(f"{upstream.status} Error for url: {upstream.url}", 500)
+        limiter.record_success()
+
+        status = apply_range_headers(headers, byte_range, file_size, upstream.status, upstream.headers)
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        timer = StreamTimer(plan["kind"], started)
+        flow = core.download_bandwidth.open(client)
+        try:
+            async for chunk in upstream.content.iter_chunked(core.fetcher.chunk_size):
+                delay = core.download_bandwidth.reserve(flow, len(chunk))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                timer.chunk(len(chunk))
+                await response.write(chunk)
+        finally:
+            core.download_bandwidth.close(flow)
+            timer.finish()
+        await response.write_eof()
+        return response
+
+
+async def download_video(request):
+    params, error = core.parse_download_request(request.query)
+    if error:
+        return json_error(*error)
+    client = request_client(request)
+    try:
+        ticket = await core.admission.acquire_async(client)
+    except AdmissionRejected as e:
+        payload, status, headers = core.admission_refused(e)
+        return web.json_response(payload, status=status, headers=headers)
+    try:
+        return await serve_download(request, client, params)
+    finally:
+        if ticket:
+            ticket.release()
+
+
+async def serve_download(request, client, params):
+    video_url = params["video_url"]
+    qualite = params["qualite"]
+    file_type = params["type"]
+    bitrate = params["bitrate"]
+    clip_start, clip_end = params["start"], params["end"]
+    clipping = clip_start is not None or clip_end is not None
+
+    started = time.monotonic()
+    try:
+        manifest = await run_blocking(core.get_video_manifest, video_url)
+        video_id = manifest["video_id"]
+        plan = core.plan_download(manifest, file_type, qualite, bitrate)
+
+        if not plan:
+            if file_type == 'mp3':
+                return json_error("Aucun flux audio disponible", 404)
+            return json_error("Aucun flux vidéo disponible", 404)
+
+        if clipping:
+            try:
+                plan = core.plan_clip(manifest, plan, clip_start, clip_end)
+            except ClipError as e:
+                return json_error(str(e), 400)
+
+        headers = core.download_headers(plan["filename"], plan["mime_type"])
+
+        if core.media_cache.enabled and plan["cache_key"]:
+            cached_path = core.media_cache.get(plan["cache_key"])
+            if cached_path:
+                headers.pop('Content-Type')
+                headers.pop('X-Accel-Buffering')
+                response = web.FileResponse(cached_path, headers=headers)
+                response.content_type = plan["mime_type"]
+                return response
+
+        if plan["kind"] == 'progressive':
+            # Progressive streams are relayed natively on the event loop; cache hits are
+            # served above, but filling the cache is left to the threaded server.
+            return await proxy_progressive(request, plan, video_id, headers, started, client)
+
+        if plan["kind"] == 'passthrough' and plan["stream"]["filesize"]:
+            headers['Content-Length'] = str(plan["stream"]["filesize"])
+        # Produced on the fly, or relayed from the start for passthrough: Range is
+        # ignored here, only media cache hits serve byte ranges
+        headers['Accept-Ranges'] = 'none'
+        iterator = await run_blocking(core.cached_or_produced, plan, manifest)
+        return await stream_blocking(request, observe_stream(iterator, plan["kind"], started), headers, client=client)
+
+    except (ConnectionResetError, asyncio.CancelledError):
+        raise
+    except Exception as e:
+        logger.error(f"Download error: {e}")
+        return youtube_error(e)
+
+
+async def download_playlist(request):
+    playlist_url = request.query.get('url')
+    qualite = request.query.get('qualite', '360p')
+    file_type = request.query.get('type', 'mp4').lower()
+
+    if not playlist_url:
+        return json_error("Paramètre 'url' requis", 400)
+
+    if file_type not in ['mp3', 'mp4']:
+        return json_error("Type invalide. Utilisez 'mp3' ou 'mp4'", 400)
+
+    bitrate = parse_bitrate(request.query.get('bitrate'))
+    if bitrate is None:
+        return json_error(f"Débit invalide. Valeurs possibles: {', '.join(str(b) for b in MP3_BITRATES)}", 400)
+
+    limit = core.parse_playlist_limit(request.query.get('max'))
+    if limit is None:
+        return json_error(f"Paramètre 'max' invalide: entre 1 et {core.PLAYLIST_MAX_ITEMS}", 400)
+
+    try:
+        source = core.playlist_source(playlist_url)
+        title = core.sanitize_filename(await run_blocking(core.source_title, source) or 'playlist')
+    except Exception as e:
+        logger.error(f"Playlist error: {e}")
+        return youtube_error(e)
+
+    members = core.iter_playlist_members(source, file_type, qualite, bitrate, limit)
+    chunks = observe_stream(core.iter_zip(members), 'playlist')
+    return await stream_blocking(request, chunks, core.download_headers(f"{title}.zip", 'application/zip'))
+
+
+async def list_playlist_entries(request):
+    playlist_url = request.query.get('url')
+    if not playlist_url:
+        return json_error("Paramètre 'url' requis", 400)
+
+    limit = core.parse_playlist_limit(request.query.get('max'))
+    if limit is None:
+        return json_error(f"Paramètre 'max' invalide: entre 1 et {core.PLAYLIST_MAX_ITEMS}", 400)
+
+    def generate():
+        try:
+            for entry in core.iter_playlist_entries(core.playlist_source(playlist_url), limit):
+                yield (json.dumps(entry) + '\n').encode('utf-8')
+        except Exception as e:
+            logger.error(f"Playlist error: {e}")
+            yield (json.dumps({"error": str(e)}) + '\n').encode('utf-8')
+
+    headers = {'Content-Type': 'application/x-ndjson', 'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'}
+    return await stream_blocking(request, generate(), headers)
+
+
+def request_client(request):
+    # Same rule as the Flask app: X-Forwarded-For only counts behind TRUSTED_PROXIES
+    address = core.forwarded_address(request.headers.get('X-Forwarded-For'), request.remote)
+    return download_client(request.headers.get('X-API-Key'), address, core.admission.weights)
+
+
+async def create_job(request):
+    if request.content_type == 'application/json':
+        try:
+            params = await request.json()
+        except ValueError:
+            params = None
+    else:
+        params = dict(await request.post())
+    client = request_client(request)
+    params, priority, error = core.parse_job_request(params, client)
+    if error:
+        return json_error(error, 400)
+
+    try:
+        job = await run_blocking(core.job_queue.submit, client, params, priority=priority)
+    except core.QueueFull:
+        return web.json_response(core.QUEUE_FULL_PAYLOAD, status=503, headers={'Retry-After': '30'})
+
+    return web.json_response(core.job_payload(job), status=202, headers={'Location': f"/jobs/{job['id']}"})
+
+
+async def get_job(request):
+    job = await run_blocking(core.job_queue.get, request.match_info['job_id'])
+    if not job:
+        return json_error("Tâche introuvable", 404)
+    return web.json_response(core.job_payload(job))
+
+
+async def get_job_artifact(request):
+    job_id = request.match_info['job_id']
+    job = await run_blocking(core.job_queue.get, job_id)
+    if not job:
+        return json_error("Tâche introuvable", 404)
+    if job["status"] == 'expired':
+        return json_error("Le fichier a expiré", 410)
+    if job["status"] != 'done' or not job["artifact"] or not os.path.exists(job["artifact"]):
+        return web.json_response({"error": "Le fichier n'est pas encore prêt", **core.job_payload(job)}, status=409)
+    headers = core.download_headers(job["filename"], job["mime_type"])
+    headers.pop('Content-Type')
+    headers.pop('X-Accel-Buffering')
+    headers['ETag'] = f'"{job_id}"'
+    response = web.FileResponse(job["artifact"], headers=headers)
+    response.content_type = job["mime_type"]
+    return response
+
+
+async def stats(request):
+    return web.json_response({
+        "manifest_cache": core.manifest_cache.stats(),
+        "rate_limiters": core.limiter_stats(),
+        "clients": core.client_stats.stats(),
+        "fetcher": core.fetcher.stats(),
+        "media_cache": core.media_cache.stats(),
+        "search_cache": core.search_cache.stats(),
+        "data_api_quota": core.quota.stats(),
+        "jobs": await run_blocking(core.job_queue.stats) if core.JOBS_ENABLED else None,
+        "playlist_bandwidth": core.bandwidth_stats(),
+        "relays": core.relay_stats(),
+        "prefetch": core.prefetcher.stats(),
+        "player_cache": await run_blocking(core.player_cache.stats),
+        "clips": core.clip_stats(),
+        "thumbnails": await run_blocking(core.thumbnails.stats),
+        "admission": core.admission.stats(),
+        "download_bandwidth": core.download_bandwidth.stats()
+    })
+
+
+async def metrics(request):
+    # Rendering walks the cache directories, so it stays off the event loop
+    body = await run_blocking(registry.render)
+    return web.Response(body=body.encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def _open_http_client(application):
+    if core.JOBS_ENABLED:
+        core.job_queue.start()
+    pool_size = int(os.environ.get('FETCH_POOL_SIZE', 32))
+    application['http'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size * 4, limit_per_host=pool_size),
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=core.fetcher.timeout),
+        headers=UPSTREAM_HEADERS,
+        auto_decompress=False,
+    )
+
+
+async def _close_http_client(application):
+    await application['http'].close()
+
+
+def create_app():
+    application = web.Application()
+    application.router.add_get('/', home)
+    application.router.add_get('/info', get_video_info)
+    application.router.add_post('/info/batch', get_video_info_batch)
+    application.router.add_get('/recherche', search_videos)
+    application.router.add_get('/thumb/{video_id}', get_thumbnail)
+    application.router.add_get('/download', download_video)
+    application.router.add_get('/playlist', download_playlist)
+    application.router.add_get('/playlist/entries', list_playlist_entries)
+    if core.JOBS_ENABLED:
+        application.router.add_post('/jobs', create_job)
+        application.router.add_get('/jobs/{job_id}', get_job)
+        application.router.add_get('/jobs/{job_id}/fichier', get_job_artifact)
+    application.router.add_get('/stats', stats)
+    application.router.add_get('/metrics', metrics)
+    application.on_startup.append(_open_http_client)
+    application.on_cleanup.append(_close_http_client)
+    return application
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    web.run_app(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,129 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from urllib.parse import quote
+
+from bench.fake_upstream import FakeUpstream, fake_video_id, install_youtube_redirect
+from bench.suite import SERVER_ENV
+from ratelimit import TokenBucket
+
+
+def download(client, url, address, link, results):
+    started = time.perf_counter()
+    response = client.get(url, environ_base={'REMOTE_ADDR': address}, buffered=False)
+    size = 0
+    for chunk in response.response:
+        link.acquire(len(chunk))
+        size += len(chunk)
+    response.close()
+    results.append({
+        "client": address,
+        "status": response.status_code,
+        "bytes": size,
+        "seconds": time.perf_counter() - started,
+        "retry_after": response.headers.get('Retry-After'),
+    })
+
+
+def run_scenario(core, client, link_rate, heavy_streams, light_clients, stagger):
+    # One client opens `heavy_streams` downloads at once; each light client starts a
+    # single download `stagger` seconds later, while the heavy ones are in flight. All
+    # responses cross one `link_rate` bytes/s link, standing in for the server's uplink.
+    link = TokenBucket('link', rate=link_rate, burst=64 * 1024)
+    results = []
+    threads = []
+    for index in range(heavy_streams):
+        url = f"/download?video_url={quote(f'https://www.youtube.com/watch?v={fake_video_id(index)}', safe='')}"
+        threads.append(threading.Thread(target=download, args=(client, url, '10.0.0.1', link, results)))
+    for index in range(light_clients):
+        url = f"/download?video_url={quote(f'https://www.youtube.com/watch?v={fake_video_id(1000 + index)}', safe='')}"
+        threads.append(threading.Thread(target=download, args=(client, url, f'10.0.1.{index + 1}', link, results)))
+    started = time.perf_counter()
+    for index, thread in enumerate(threads):
+        if index == heavy_streams:
+            time.sleep(stagger)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    def summary(entries):
+        ok = [entry for entry in entries if entry["status"] == 200]
+        return {
+            "requests": len(entries),
+            "ok": len(ok),
+            "rejected": {str(status): sum(1 for entry in entries if entry["status"] == status)
+                         for status in sorted({entry["status"] for entry in entries} - {200})},
+            "bytes": sum(entry["bytes"] for entry in ok),
+            "max_seconds": round(max((entry["seconds"] for entry in ok), default=0.0), 3),
+        }
+
+    heavy = [entry for entry in results if entry["client"] == '10.0.0.1']
+    light = [entry for entry in results if entry["client"] != '10.0.0.1']
+    return {
+        "seconds": round(elapsed, 3),
+        "heavy": summary(heavy),
+        "shares": core.download_bandwidth.stats()["clients"],
+        "light": summary(light),
+        "admission": core.admission.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/download admission and fair bandwidth: one greedy client vs light clients")
+    parser.add_argument('--heavy-streams', type=int, default=20)
+    parser.add_argument('--light-clients', type=int, default=3)
+    parser.add_argument('--stagger', type=float, default=0.5, help="delay before the light clients start")
+    parser.add_argument('--size-mib', type=float, default=16, help="size of each video")
+    parser.add_argument('--upstream-mib', type=float, default=4, help="per-connection cap of the fake upstream")
+    parser.add_argument('--egress-mib', type=float, default=24, help="uplink capacity, and DOWNLOAD_BANDWIDTH of the fair scenario")
+    parser.add_argument('--max-active', type=int, default=12)
+    parser.add_argument('--per-client', type=int, default=4)
+    parser.add_argument('--queue-timeout', type=float, default=10)
+    parser.add_argument('--output', help="also write the results as JSON")
+    args = parser.parse_args()
+
+    for key, value in SERVER_ENV.items():
+        os.environ.setdefault(key, value)
+    with FakeUpstream(default_size=int(args.size_mib * 1024 * 1024),
+                      bandwidth=int(args.upstream_mib * 1024 * 1024)) as upstream:
+        install_youtube_redirect(upstream.base_url)
+        import app as core
+        from admission import AdmissionController, FairBandwidth
+        logging.getLogger().setLevel(logging.WARNING)
+        core.client_preferences.remember(None, 'IOS')
+        client = core.app.test_client()
+
+        scenarios = {
+            "unlimited": (AdmissionController(max_active=0), FairBandwidth()),
+            "fair": (
+                AdmissionController(max_active=args.max_active, per_client=args.per_client,
+                                    queue_timeout=args.queue_timeout),
+                FairBandwidth(rate=int(args.egress_mib * 1024 * 1024)),
+            ),
+        }
+        results = {}
+        print(f"{'scenario':>10} {'who':>5} {'ok':>4} {'rejected':>16} {'MiB':>7} {'max_s':>7}")
+        for name, (controller, bandwidth) in scenarios.items():
+            core.admission, core.download_bandwidth = controller, bandwidth
+            result = run_scenario(core, client, int(args.egress_mib * 1024 * 1024), args.heavy_streams,
+                                  args.light_clients, args.stagger)
+            results[name] = result
+            for who in ('heavy', 'light'):
+                entry = result[who]
+                rejected = ','.join(f"{status}x{n}" for status, n in entry["rejected"].items()) or '-'
+                print(f"{name:>10} {who:>5} {entry['ok']:>4} {rejected:>16} {entry['bytes'] / 1024 ** 2:>7.1f} "
+                      f"{entry['max_seconds']:>7.2f}")
+        print(json.dumps({name: result["admission"] for name, result in results.items()}), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != 'output'}, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# The benchmark measures the serving layer only: no disk cache, no CDN budget.
+os.environ.setdefault('MEDIA_CACHE_MAX_BYTES', '0')
+os.environ.setdefault('CDN_RATE', '100000')
+os.environ.setdefault('CDN_BURST', '100000')
+
+import aiohttp
+from aiohttp import web
+from werkzeug.serving import BaseWSGIServer
+
+import app as core
+import async_app
+from bench.fake_upstream import FakeUpstream
+from bench.stats import percentile
+
+VIDEO_ID = 'BenchVideo1'
+
+
+class BoundedWSGIServer(BaseWSGIServer):
+    # Emulates a fixed pool of synchronous workers (e.g. gunicorn sync workers):
+    # connections beyond the pool size wait in the accept queue.
+    def __init__(self, host, port, app, workers):
+        super().__init__(host, port, app)
+        self.request_queue_size = 1024
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def seed_manifest(upstream, size):
+    url = upstream.media_url(size)
+    core.manifest_cache.put(VIDEO_ID, {
+        "video_id": VIDEO_ID,
+        "title": "Bench video",
+        "author": "bench",
+        "length_seconds": 60,
+        "views": 0,
+        "thumbnail_url": "",
+        "expire": None,
+        "streams": [{
+            "itag": 18, "mime_type": "video/mp4", "subtype": "mp4", "codecs": ["avc1.42001E", "mp4a.40.2"],
+            "progressive": True, "only_audio": False, "only_video": False,
+            "resolution": "360p", "fps": 30, "abr": "96kbps", "filesize": size,
+            "duration_ms": "60000", "last_modified": "1700000000000000",
+            "url": url, "expire": None,
+        }],
+    })
+
+
+def start_sync_server(workers):
+    server = BoundedWSGIServer('127.0.0.1', 0, core.app, workers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def start_async_server():
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    state = {}
+
+    async def start():
+        runner = web.AppRunner(async_app.create_app())
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0, backlog=1024)
+        await site.start()
+        state['runner'] = runner
+        state['port'] = runner.addresses[0][1]
+        ready.set()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(start())
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(state['runner'].cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    return stop, f"http://127.0.0.1:{state['port']}"
+
+
+async def run_load(base_url, concurrency, timeout):
+    url = f"{base_url}/download?video_url={VIDEO_ID}&qualite=360p"
+    active = 0
+    peak = 0
+    results = []
+
+    async def client(session):
+        nonlocal active, peak
+        start = time.perf_counter()
+        ttfb = None
+        received = 0
+        try:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    results.append({"ok": False})
+                    return
+                async for chunk in response.content.iter_chunked(65536):
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - start
+                        active += 1
+                        peak = max(peak, active)
+                    received += len(chunk)
+            results.append({"ok": True, "ttfb": ttfb, "seconds": time.perf_counter() - start, "bytes": received})
+        except Exception:
+            results.append({"ok": False})
+        finally:
+            if ttfb is not None:
+                active -= 1
+
+    connector = aiohttp.TCPConnector(limit=0)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        began = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        wall = time.perf_counter() - began
+
+    ok = [r for r in results if r["ok"]]
+    ttfbs = [r["ttfb"] for r in ok]
+    total_bytes = sum(r["bytes"] for r in ok)
+    return {
+        "completed": len(ok),
+        "errors": len(results) - len(ok),
+        "peak_concurrent_streams": peak,
+        "ttfb_p50": percentile(ttfbs, 50),
+        "ttfb_p99": percentile(ttfbs, 99),
+        "wall_seconds": wall,
+        "mib_per_s": total_bytes / wall / (1024 * 1024) if wall else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent /download capacity: threaded Flask vs asyncio server")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument('--sync-workers', type=int, default=4, help="size of the emulated sync worker pool")
+    parser.add_argument('--size-kib', type=int, default=1024)
+    parser.add_argument('--bandwidth-kib', type=int, default=512, help="per-connection cap of the fake upstream")
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with FakeUpstream(bandwidth=args.bandwidth_kib * 1024) as upstream:
+        seed_manifest(upstream, args.size_kib * 1024)
+        sync_server, sync_url = start_sync_server(args.sync_workers)
+        stop_async, async_url = start_async_server()
+        try:
+            print(f"{'server':>6} {'clients':>7} {'done':>5} {'err':>4} {'peak':>5} "
+                  f"{'ttfb_p50':>9} {'ttfb_p99':>9} {'wall_s':>7} {'MiB/s':>7}")
+            for concurrency in args.concurrency:
+                for name, base_url in (('sync', sync_url), ('async', async_url)):
+                    r = asyncio.run(run_load(base_url, concurrency, args.timeout))
+                    print(f"{name:>6} {concurrency:>7} {r['completed']:>5} {r['errors']:>4} "
+                          f"{r['peak_concurrent_streams']:>5} {r['ttfb_p50']:>9.3f} {r['ttfb_p99']:>9.3f} "
+                          f"{r['wall_seconds']:>7.2f} {r['mib_per_s']:>7.2f}")
+        finally:
+            stop_async()
+            sync_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
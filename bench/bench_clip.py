@@ -0,0 +1,121 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+from bench.fake_upstream import FakeUpstream, fake_video_id, install_youtube_redirect
+from bench.suite import SERVER_ENV
+
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+
+# Test media shaped like YouTube's: a progressive MP4 with its index in front (18),
+# DASH fragmented MP4 with a global sidx (137, 140) and DASH WebM with front cues (251).
+MEDIA = {
+    18: ('p18.mp4', ['-f', 'lavfi', '-i', 'testsrc2=s=320x180:r=24', '-f', 'lavfi', '-i', 'sine=f=440:r=44100',
+                     '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '48', '-c:a', 'aac', '-b:a', '96k',
+                     '-movflags', '+faststart']),
+    137: ('v137.mp4', ['-f', 'lavfi', '-i', 'testsrc2=s=640x360:r=24', '-c:v', 'libx264', '-preset', 'ultrafast',
+                       '-g', '48', '-f', 'mp4', '-movflags', '+frag_keyframe+empty_moov+default_base_moof+global_sidx',
+                       '-frag_duration', '5000000']),
+    140: ('a140.m4a', ['-f', 'lavfi', '-i', 'sine=f=440:r=44100', '-c:a', 'aac', '-b:a', '128k', '-f', 'mp4',
+                       '-movflags', '+frag_keyframe+empty_moov+default_base_moof+global_sidx',
+                       '-frag_duration', '5000000']),
+    251: ('a251.webm', ['-f', 'lavfi', '-i', 'sine=f=440:r=48000', '-c:a', 'libopus', '-b:a', '128k', '-f', 'webm',
+                        '-dash', '1', '-cluster_time_limit', '5000', '-cues_to_front', '1']),
+}
+
+SCENARIOS = {
+    '360p': 'qualite=360p',
+    '1080p': 'qualite=1080p',
+    'mp3': 'type=mp3&bitrate=128',
+}
+
+
+def generate_media(directory, length):
+    # Encoded once per length and kept in `directory`
+    media = {}
+    for itag, (name, args) in MEDIA.items():
+        path = os.path.join(directory, f"{length}-{name}")
+        if not os.path.exists(path):
+            print(f"Encoding {name} ({length}s)", file=sys.stderr)
+            partial = os.path.join(directory, f"partial-{length}-{name}")
+            subprocess.run([FFMPEG_BIN, '-y', '-hide_banner', '-loglevel', 'error', *args, '-t', str(length), partial],
+                           check=True)
+            os.replace(partial, path)
+        with open(path, 'rb') as f:
+            media[itag] = f.read()
+    return media
+
+
+def run_once(client, upstream, url):
+    sent = upstream.bytes_sent
+    started = time.perf_counter()
+    response = client.get(url, buffered=False)
+    first_byte = None
+    size = 0
+    for chunk in response.response:
+        if first_byte is None:
+            first_byte = time.perf_counter() - started
+        size += len(chunk)
+    response.close()
+    return {
+        "status": response.status_code,
+        "seconds": time.perf_counter() - started,
+        "ttfb_seconds": first_byte,
+        "bytes": size,
+        "upstream_bytes": upstream.bytes_sent - sent,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clip extraction (start/end) vs full download: upstream bytes and latency")
+    parser.add_argument('--length', type=int, default=3600, help="video length in seconds")
+    parser.add_argument('--start', type=float, default=1800)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--bandwidth-mib', type=float, default=8, help="per-connection cap of the fake upstream")
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--media-dir', default=os.path.join(tempfile.gettempdir(), 'bench-clip-media'))
+    parser.add_argument('--output', help="also write the results as JSON")
+    args = parser.parse_args()
+
+    os.makedirs(args.media_dir, exist_ok=True)
+    media = generate_media(args.media_dir, args.length)
+
+    for key, value in SERVER_ENV.items():
+        os.environ.setdefault(key, value)
+    with FakeUpstream(media=media, length_seconds=args.length, latency=args.latency,
+                      bandwidth=int(args.bandwidth_mib * 1024 * 1024)) as upstream:
+        install_youtube_redirect(upstream.base_url)
+        import app as core
+        logging.getLogger().setLevel(logging.WARNING)
+        core.client_preferences.remember(None, 'IOS')
+        client = core.app.test_client()
+
+        results = []
+        print(f"{'scenario':>8} {'mode':>5} {'status':>6} {'upstream_MiB':>12} {'out_MiB':>8} {'ttfb_s':>7} {'seconds':>8}")
+        for index, scenario in enumerate(args.scenarios):
+            watch = quote(f"https://www.youtube.com/watch?v={fake_video_id(index)}", safe='')
+            base = f"/download?video_url={watch}&{SCENARIOS[scenario]}"
+            clip = f"{base}&start={args.start:g}&end={args.start + args.duration:g}"
+            # The first request resolves the manifest, so both modes are measured warm
+            client.get(f"/info?video_url={watch}")
+            for mode, url in (('full', base), ('clip', clip)):
+                result = {"scenario": scenario, "mode": mode, **run_once(client, upstream, url)}
+                results.append(result)
+                print(f"{scenario:>8} {mode:>5} {result['status']:>6} {result['upstream_bytes'] / 1024 ** 2:>12.2f} "
+                      f"{result['bytes'] / 1024 ** 2:>8.2f} {result['ttfb_seconds'] or 0:>7.3f} {result['seconds']:>8.3f}")
+        print(json.dumps({"clips": core.clip_stats()}), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != 'output'}, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
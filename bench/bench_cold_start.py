@@ -0,0 +1,130 @@
+import argparse
+import importlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from statistics import median
+
+from bench.fake_upstream import FakeUpstream, fake_video_id, install_youtube_redirect
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WATCH_URL = 'https%3A%2F%2Fwww.youtube.com%2Fwatch%3Fv%3D' + fake_video_id(1)
+
+ROUTES = {
+    'home': '/',
+    'info': f"/info?video_url={WATCH_URL}",
+    'download': f"/download?video_url={WATCH_URL}&qualite=360p",
+    'recherche': '/recherche?video=bench&max_results=10',
+}
+
+# Modules whose import dominates start-up; reported per route to show which ones
+# each request actually needed.
+HEAVY_MODULES = ('flask', 'requests', 'pytubefix', 'googleapiclient.discovery', 'aiohttp')
+
+
+def child(args):
+    # A new process standing in for a cold serverless instance: imports the entry
+    # point, then serves a single request through the WSGI app and reports when the
+    # first byte of the body came out.
+    install_youtube_redirect(args.upstream)
+    started = time.perf_counter()
+    module = importlib.import_module(args.entry)
+    imported = time.perf_counter()
+    loaded_at_import = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    response = module.app.test_client().get(ROUTES[args.route], buffered=False)
+    body = iter(response.response)
+    first = next(body, b'')
+    first_byte = time.perf_counter()
+    first_byte_at = time.time()
+    size = len(first) + sum(len(chunk) for chunk in body)
+    response.close()
+    print(json.dumps({
+        "status": response.status_code,
+        "bytes": size,
+        "import_seconds": imported - started,
+        "request_ttfb_seconds": first_byte - imported,
+        "first_byte_at": first_byte_at,
+        "modules_at_import": loaded_at_import,
+        "modules_after_request": [name for name in HEAVY_MODULES if name in sys.modules],
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def run_child(upstream, entry, route):
+    # Each run gets an empty temporary directory, like a fresh instance: no media,
+    # manifest-free player cache and job database.
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env.update({
+            'TMPDIR': tmp,
+            'YOUTUBE_API_KEY': 'bench',
+            'YOUTUBE_API_ENDPOINT': upstream.base_url,
+            'LOG_LEVEL': 'WARNING',
+        })
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+        spawned = time.time()
+        output = subprocess.run(
+            [sys.executable, '-m', 'bench.bench_cold_start', '--child', '--entry', entry, '--route', route,
+             '--upstream', upstream.base_url],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True
+        ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["cold_ttfb_seconds"] = result.pop("first_byte_at") - spawned
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and cold-start TTFB per route, one new process per request")
+    parser.add_argument('--entries', nargs='+', default=['api.index', 'app'], help="modules exposing the WSGI `app`")
+    parser.add_argument('--routes', nargs='+', choices=list(ROUTES), default=list(ROUTES))
+    parser.add_argument('--repeat', type=int, default=3, help="cold starts per entry and route (median reported)")
+    parser.add_argument('--size-kib', type=int, default=2048, help="size of the fake media stream")
+    parser.add_argument('--output', help="also write the results as JSON")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--entry', help=argparse.SUPPRESS)
+    parser.add_argument('--route', help=argparse.SUPPRESS)
+    parser.add_argument('--upstream', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    results = []
+    with FakeUpstream(player_js=True, default_size=args.size_kib * 1024, player_latency=0.05,
+                      api_latency=0.03) as upstream:
+        print(f"{'entry':>10} {'route':>10} {'status':>6} {'import_s':>9} {'req_ttfb_s':>10} {'cold_ttfb_s':>11} "
+              f"{'rss_MiB':>8}  modules after request", file=sys.stderr)
+        for entry in args.entries:
+            for route in args.routes:
+                runs = [run_child(upstream, entry, route) for _ in range(args.repeat)]
+                result = {
+                    "entry": entry,
+                    "route": route,
+                    "statuses": sorted({run["status"] for run in runs}),
+                    "import_seconds": round(median(run["import_seconds"] for run in runs), 3),
+                    "request_ttfb_seconds": round(median(run["request_ttfb_seconds"] for run in runs), 3),
+                    "cold_ttfb_seconds": round(median(run["cold_ttfb_seconds"] for run in runs), 3),
+                    "max_rss_mib": round(median(run["max_rss_kib"] for run in runs) / 1024, 1),
+                    "modules_at_import": runs[-1]["modules_at_import"],
+                    "modules_after_request": runs[-1]["modules_after_request"],
+                }
+                results.append(result)
+                print(f"{entry:>10} {route:>10} {','.join(map(str, result['statuses'])):>6} "
+                      f"{result['import_seconds']:>9.3f} {result['request_ttfb_seconds']:>10.3f} "
+                      f"{result['cold_ttfb_seconds']:>11.3f} {result['max_rss_mib']:>8}  "
+                      f"{' '.join(result['modules_after_request'])}", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"config": {"repeat": args.repeat, "size_kib": args.size_kib}, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import time
+
+from bench.fake_upstream import FakeUpstream, payload
+from fetcher import Fetcher
+
+
+def run_once(fetcher, url, size):
+    start = time.perf_counter()
+    first_byte = None
+    received = 0
+    for chunk in fetcher.stream(url, size=size):
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+        received += len(chunk)
+    elapsed = time.perf_counter() - start
+    if received != size:
+        raise AssertionError(f"Expected {size} bytes, received {received}")
+    return {"seconds": elapsed, "ttfb": first_byte, "mib_per_s": size / elapsed / (1024 * 1024)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-connection vs segmented fetch throughput")
+    parser.add_argument('--size-mib', type=float, default=16)
+    parser.add_argument('--bandwidth-mib', type=float, default=4, help="per-connection cap of the fake upstream")
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--segments', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--segment-size-kib', type=int, default=1024)
+    parser.add_argument('--chunk-size', type=int, default=65536)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    size = int(args.size_mib * 1024 * 1024)
+    with FakeUpstream(bandwidth=int(args.bandwidth_mib * 1024 * 1024), latency=args.latency) as upstream:
+        upstream.payload(size)
+        url = upstream.media_url(size)
+        expected = payload(size)
+
+        print(f"{'segments':>8} {'seconds':>8} {'ttfb_ms':>8} {'MiB/s':>8}")
+        for segments in args.segments:
+            fetcher = Fetcher(
+                chunk_size=args.chunk_size,
+                segments=segments,
+                segment_size=args.segment_size_kib * 1024,
+            )
+            assert b''.join(fetcher.stream(url, size=size)) == expected
+            runs = [run_once(fetcher, url, size) for _ in range(args.repeat)]
+            best = min(runs, key=lambda r: r["seconds"])
+            print(f"{segments:>8} {best['seconds']:>8.2f} {best['ttfb'] * 1000:>8.1f} {best['mib_per_s']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
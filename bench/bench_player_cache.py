@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.fake_upstream import FakeUpstream, fake_video_id, install_youtube_redirect
+from bench.stats import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(args):
+    # Child process: resolves --videos videos one after another and reports the time
+    # of each, so the first one shows the cold start of this process.
+    import requests
+    install_youtube_redirect(args.upstream)
+    if args.mode == 'cached':
+        from player_cache import PlayerCache
+        cache = PlayerCache(args.db)
+        cache.install()
+        create = cache.youtube
+    else:
+        from pytubefix import YouTube
+        create = YouTube
+
+    timings = []
+    for index in range(args.videos):
+        started = time.perf_counter()
+        yt = create(f"https://www.youtube.com/watch?v={fake_video_id(index)}", args.client)
+        stream = yt.streams.get_by_itag(18)
+        timings.append(time.perf_counter() - started)
+        # The fake upstream answers 403 unless the signature and n were deciphered
+        status = requests.get(stream.url, headers={'Range': 'bytes=0-0'}).status_code
+        if status != 206:
+            raise SystemExit(f"Deciphered URL rejected with {status}")
+    print(json.dumps(timings))
+
+
+def run_child(upstream, args, mode, db):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    output = subprocess.run(
+        [sys.executable, '-m', 'bench.bench_player_cache', '--measure', mode, '--db', db,
+         '--upstream', upstream.base_url, '--videos', str(args.videos), '--client', args.client],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Player script / cipher cache: cold vs warm resolution time")
+    parser.add_argument('--videos', type=int, default=5, help="videos resolved per process")
+    parser.add_argument('--client', default='TV', help="a client type that deciphers with the player script")
+    parser.add_argument('--player-kib', type=int, default=2560, help="size of the fake player script")
+    parser.add_argument('--player-latency', type=float, default=0.05)
+    parser.add_argument('--output', help="also write the results as JSON")
+    parser.add_argument('--measure', choices=['baseline', 'cached'], help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--upstream', help=argparse.SUPPRESS)
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        args.mode = args.measure
+        measure(args)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, FakeUpstream(
+        player_js=True, player_js_size=args.player_kib * 1024, player_latency=args.player_latency,
+        default_size=65536
+    ) as upstream:
+        db = os.path.join(tmp, 'players.sqlite3')
+        # Each scenario is a new process: "cold" starts with an empty cache file,
+        # "warm" reuses the file left by the cold run, as a new worker would.
+        for name, mode in (('no cache', 'baseline'), ('cold', 'cached'), ('warm', 'cached')):
+            timings = run_child(upstream, args, mode, db)
+            results.append({
+                "scenario": name,
+                "first_seconds": round(timings[0], 3),
+                "next_seconds": summarize(timings[1:]),
+                "timings": [round(t, 4) for t in timings],
+            })
+
+    print(f"{'scenario':>9} {'first_s':>8} {'next_p50':>9} {'next_max':>9}")
+    for r in results:
+        print(f"{r['scenario']:>9} {r['first_seconds']:>8.3f} {r['next_seconds']['p50']:>9.3f} "
+              f"{r['next_seconds']['max']:>9.3f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k in ('videos', 'client', 'player_kib', 'player_latency')},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import requests
+
+from bench.fake_upstream import FakeUpstream, fake_video_id
+from bench.stats import summarize
+
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+
+
+def make_thumbnail(path, size):
+    # A 1280x720 JPEG standing in for an original thumbnail
+    if not os.path.exists(path):
+        subprocess.run([FFMPEG_BIN, '-y', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', f'testsrc2=s={size}', '-frames:v', '1', '-q:v', '2', path], check=True)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def timed(fetch, count):
+    timings, sizes = [], []
+    for index in range(count):
+        started = time.perf_counter()
+        status, size = fetch(index)
+        timings.append(time.perf_counter() - started)
+        sizes.append(size)
+    return {"status": status, "bytes_per_image": round(sum(sizes) / count), "ms": summarize(timings, 1000)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Thumbnail proxy: original vs resized, cold vs cached vs 304")
+    parser.add_argument('--images', type=int, default=50, help="distinct videos (one search page)")
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--source-size', default='1280x720')
+    parser.add_argument('--latency', type=float, default=0.02, help="latency of the fake thumbnail host")
+    parser.add_argument('--output', help="also write the results as JSON")
+    args = parser.parse_args()
+
+    source = make_thumbnail(os.path.join(tempfile.gettempdir(), f'bench-thumb-{args.source_size}.jpg'),
+                            args.source_size)
+    with tempfile.TemporaryDirectory() as cache_dir, FakeUpstream(thumbnail=source, latency=args.latency) as upstream:
+        os.environ.update({'THUMB_UPSTREAM': upstream.base_url, 'THUMB_CACHE_DIR': cache_dir, 'LOG_LEVEL': 'WARNING'})
+        import app as core
+        client = core.app.test_client()
+        session = requests.Session()
+
+        def direct(index):
+            r = session.get(f"{upstream.base_url}/vi/{fake_video_id(index)}/hqdefault.jpg")
+            return r.status_code, len(r.content)
+
+        def proxied(accept, etags=None):
+            def fetch(index):
+                headers = {'Accept': accept}
+                if etags is not None:
+                    headers['If-None-Match'] = etags[index]
+                r = client.get(f"/thumb/{fake_video_id(index)}?width={args.width}", headers=headers)
+                if etags is not None and r.status_code == 200:
+                    etags[index] = r.headers['ETag']
+                return r.status_code, len(r.data)
+            return fetch
+
+        etags = {index: '' for index in range(args.images)}
+        results = {
+            "upstream original": timed(direct, args.images),
+            "proxy webp, cold": timed(proxied('image/webp,*/*', etags), args.images),
+            "proxy webp, cached": timed(proxied('image/webp,*/*'), args.images),
+            "proxy jpeg, cold": timed(proxied('image/jpeg'), args.images),
+            "proxy webp, 304": timed(proxied('image/webp,*/*', etags), args.images),
+        }
+
+    print(f"{'scenario':>20} {'status':>6} {'bytes':>7} {'p50_ms':>7} {'p99_ms':>7}")
+    for name, result in results.items():
+        print(f"{name:>20} {result['status']:>6} {result['bytes_per_image']:>7} "
+              f"{result['ms']['p50']:>7.1f} {result['ms']['p99']:>7.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != 'output'}, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
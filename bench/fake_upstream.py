@@ -0,0 +1,413 @@
+import json
+import random
+import re
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse, urlsplit, urlunsplit
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'youtube.googleapis.com')
+VISITOR_DATA = 'CgtGYWtlVmlzaXRvcg%3D%3D'
+
+# A minimal player script in the shape pytubefix parses: a signature function built
+# from split/join helpers, an n-parameter function referenced from an array, and a
+# signatureTimestamp. decipher_signature/transform_n are their Python equivalents.
+PLAYER_JS = r'''var _yt_player={};(function(g){var window=this;
+var Xy={ab:function(a,b){a.splice(0,b)},cd:function(a){a.reverse()},ef:function(a,b){var c=a[0];a[0]=a[b%a.length];a[b%a.length]=c}};
+var Qz=function(a){a=a.split("");Xy.cd(a,1);Xy.ef(a,7);Xy.ab(a,2);return a.join("")};
+var Nf=function(a){var b=a.split(""),c=b.length;try{for(var d=0;d<c;d++){var e=b[d].charCodeAt(0);b[d]=String.fromCharCode(e>=97&&e<=122?(e-97+13)%26+97:e)}b.reverse()}catch(f){return"enhanced_except_"+a}return b.join("")};
+var nq=[Nf];
+g.cfg={signatureTimestamp:20000};
+/*PADDING*/
+})(_yt_player);
+'''
+
+
+def decipher_signature(s):
+    chars = list(s)[::-1]
+    swap = 7 % len(chars)
+    chars[0], chars[swap] = chars[swap], chars[0]
+    return ''.join(chars[2:])
+
+
+def transform_n(n):
+    rotated = [chr((ord(c) - 97 + 13) % 26 + 97) if 'a' <= c <= 'z' else c for c in n]
+    return ''.join(reversed(rotated))
+
+
+def payload(size):
+    block = bytes(range(256))
+    return (block * (size // len(block) + 1))[:size]
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeGoogleVideo/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        if parsed.path == '/videoplayback':
+            self._videoplayback(params)
+        elif parsed.path == '/watch':
+            self._watch(params.get('v', [''])[0])
+        elif self.server.player_js and parsed.path == self.server.player_js_path:
+            self._player_js()
+        elif parsed.path.startswith('/vi/'):
+            self._thumbnail(parsed.path.rsplit('/', 1)[-1])
+        elif parsed.path == '/youtube/v3/search':
+            self._search(params)
+        elif parsed.path == '/youtube/v3/videos':
+            self._videos(params)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if parsed.path == '/youtubei/v1/player':
+            self._player(json.loads(body or b'{}'))
+        else:
+            self.send_error(404)
+
+    def _send_json(self, document, status=200):
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _watch(self, video_id):
+        # Just enough of a watch page for pytubefix: ytInitialData carries the
+        # visitorData that every player request must echo.
+        time.sleep(self.server.player_latency)
+        initial_data = {"responseContext": {"serviceTrackingParams": [
+            {"service": "GFEEDBACK", "params": [{"key": "visitor_data", "value": VISITOR_DATA}]}
+        ]}}
+        player = f'<script src="{self.server.player_js_path}"></script>' if self.server.player_js else ''
+        body = (
+            f"<html><head><title>{video_id} - YouTube</title>{player}</head><body>"
+            f"<script>var ytInitialData = {json.dumps(initial_data)};</script></body></html>"
+        ).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _player(self, request):
+        time.sleep(self.server.player_latency)
+        if self.server.inject_429():
+            self._send_json({"error": {"code": 429, "message": "Too Many Requests"}}, status=429)
+            return
+        # pytubefix sends a signatureTimestamp only for clients that decipher with the player script
+        ciphered = self.server.player_js and 'playbackContext' in request
+        self._send_json(self.server.player_response(request.get('videoId', ''), ciphered))
+
+    def _player_js(self):
+        time.sleep(self.server.player_latency)
+        body = self.server.player_script().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/javascript')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _thumbnail(self, name):
+        # Like i.ytimg.com: no maxresdefault for most videos
+        time.sleep(self.server.latency)
+        if self.server.thumbnail is None or name == 'maxresdefault.jpg':
+            self.send_error(404)
+            return
+        self.server.count_sent(len(self.server.thumbnail))
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.server.thumbnail)))
+        self.end_headers()
+        self._write_throttled(self.server.thumbnail)
+
+    def _search(self, params):
+        time.sleep(self.server.api_latency)
+        count = min(int(params.get('maxResults', ['5'])[0]), 50)
+        offset = int(params.get('pageToken', ['0'])[0])
+        items = [
+            {"kind": "youtube#searchResult", "id": {"kind": "youtube#video", "videoId": fake_video_id(offset + n)}}
+            for n in range(count)
+        ]
+        document = {"kind": "youtube#searchListResponse", "items": items}
+        if offset + count < self.server.search_results:
+            document["nextPageToken"] = str(offset + count)
+        self._send_json(document)
+
+    def _videos(self, params):
+        time.sleep(self.server.api_latency)
+        ids = [video_id for video_id in params.get('id', [''])[0].split(',') if video_id]
+        self._send_json({"kind": "youtube#videoListResponse", "items": [
+            {
+                "kind": "youtube#video",
+                "id": video_id,
+                "snippet": {
+                    "title": f"Fake video {video_id}",
+                    "channelTitle": "Fake channel",
+                    "thumbnails": {"high": {"url": f"{self.server.base_url}/vi/{video_id}/hqdefault.jpg"}},
+                },
+                "contentDetails": {"duration": "PT3M20S", "definition": "hd"},
+                "statistics": {"viewCount": "1000"},
+            }
+            for video_id in ids
+        ]})
+
+    def _videoplayback(self, params):
+        media = self.server.media.get(int(params.get('itag', ['0'])[0]))
+        size = len(media) if media is not None else int(params.get('size', [self.server.default_size])[0])
+        data = media if media is not None else self.server.payload(size)
+
+        time.sleep(self.server.latency)
+        if self.server.inject_429():
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        # Ciphered URLs carry what the deciphered values must be; a wrong one is a 403
+        expected_sig = params.get('expected_sig', [None])[0]
+        expected_n = params.get('expected_n', [None])[0]
+        if ((expected_sig and params.get('sig', [None])[0] != expected_sig)
+                or (expected_n and params.get('n', [None])[0] != expected_n)):
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header:
+            match = RANGE_RE.match(range_header)
+            if not match or (not match.group(1) and not match.group(2)):
+                self.send_error(416)
+                return
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        self.server.count_sent(end - start + 1)
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        self._write_throttled(data[start:end + 1])
+
+    def _write_throttled(self, body):
+        # Per-connection bandwidth cap, the way googlevideo throttles a single socket
+        bandwidth = self.server.bandwidth
+        step = 16384
+        began = time.monotonic()
+        try:
+            for offset in range(0, len(body), step):
+                self.wfile.write(body[offset:offset + step])
+                if bandwidth:
+                    expected = (offset + step) / bandwidth
+                    elapsed = time.monotonic() - began
+                    if expected > elapsed:
+                        time.sleep(expected - elapsed)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Stands in for googlevideo (/videoplayback), the InnerTube player API and watch
+    # page, and the Data API v3 search/videos endpoints. `error_rate` is the fraction
+    # of player and media requests answered with 429.
+
+    def __init__(self, host='127.0.0.1', port=0, bandwidth=0, latency=0.0, default_size=8 * 1024 * 1024,
+                 player_latency=0.0, api_latency=0.0, error_rate=0.0, search_results=500, seed=None,
+                 player_js=False, player_version='fake0001', player_js_size=0, media=None, length_seconds=200,
+                 thumbnail=None):
+        super().__init__((host, port), FakeUpstreamHandler)
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.default_size = default_size
+        self.player_latency = player_latency
+        self.api_latency = api_latency
+        self.error_rate = error_rate
+        self.search_results = search_results
+        # Serve PLAYER_JS and ciphered stream URLs (signatureCipher + n) to clients
+        # that use the player script; player_js_size pads it to a realistic size.
+        self.player_js = player_js
+        self.player_version = player_version
+        self.player_js_size = player_js_size
+        # Real media bytes served for these itags (e.g. {18: ..., 137: ..., 140: ...,
+        # 251: ...}) instead of the synthetic payload; 251 is only listed when given.
+        self.media = media or {}
+        self.length_seconds = length_seconds
+        # JPEG served for /vi/<id>/<name>.jpg (404 when None)
+        self.thumbnail = thumbnail
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._payloads = {}
+        self._thread = None
+
+    def inject_429(self):
+        if not self.error_rate:
+            return False
+        with self._random_lock:
+            return self._random.random() < self.error_rate
+
+    def count_sent(self, size):
+        with self._random_lock:
+            self.bytes_sent += size
+
+    def payload(self, size):
+        data = self._payloads.get(size)
+        if data is None:
+            data = self._payloads[size] = payload(size)
+        return data
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def media_url(self, size=None):
+        size = size or self.default_size
+        return f"{self.base_url}/videoplayback?size={size}&expire={int(time.time()) + 21600}"
+
+    @property
+    def player_js_path(self):
+        return f"/s/player/{self.player_version}/player_ias.vflset/en_US/base.js"
+
+    def player_script(self):
+        # Padded with short statements: pytubefix's regexes are quadratic on long runs
+        # of identifier characters, which a real player never has.
+        filler = 'var p{0}=function(a){{return a+{0}}};\n'
+        padding = []
+        size = len(PLAYER_JS)
+        while size < self.player_js_size:
+            padding.append(filler.format(len(padding)))
+            size += len(padding[-1])
+        return PLAYER_JS.replace('/*PADDING*/', ''.join(padding))
+
+    def player_response(self, video_id, ciphered=False):
+        size = self.default_size
+        audio_size = max(size // 4, 1)
+
+        def stream(itag, mime_type, filesize, **extra):
+            if itag in self.media:
+                filesize = len(self.media[itag])
+            url = f"{self.media_url(filesize)}&itag={itag}&id={video_id}"
+            if ciphered:
+                scrambled = f"{video_id}{itag:03d}SIGNATURE0123456789abcdef"
+                n = f"{video_id.lower()}nparam"
+                url += f"&n={n}&expected_n={transform_n(n)}&expected_sig={decipher_signature(scrambled)}"
+                location = {"signatureCipher": urlencode({"s": scrambled, "sp": "sig", "url": url})}
+            else:
+                location = {"url": url}
+            return {
+                "itag": itag,
+                **location,
+                "mimeType": mime_type,
+                "bitrate": filesize * 8 // 200,
+                "contentLength": str(filesize),
+                "lastModified": "1700000000000000",
+                "approxDurationMs": str(self.length_seconds * 1000),
+                **extra,
+            }
+
+        adaptive = [
+            stream(137, 'video/mp4; codecs="avc1.640028"', size,
+                   width=1920, height=1080, quality="hd1080", qualityLabel="1080p", fps=30),
+            stream(140, 'audio/mp4; codecs="mp4a.40.2"', audio_size, averageBitrate=129000,
+                   audioQuality="AUDIO_QUALITY_MEDIUM", audioSampleRate="44100", audioChannels=2),
+        ]
+        if 251 in self.media:
+            adaptive.append(stream(251, 'audio/webm; codecs="opus"', audio_size, averageBitrate=140000,
+                                   audioQuality="AUDIO_QUALITY_MEDIUM", audioSampleRate="48000", audioChannels=2))
+        return {
+            "responseContext": {"visitorData": VISITOR_DATA},
+            "playabilityStatus": {"status": "OK", "playableInEmbed": True},
+            "playerConfig": {"mediaCommonConfig": {"mediaUstreamerRequestConfig": {
+                "videoPlaybackUstreamerConfig": ""
+            }}},
+            "streamingData": {
+                "expiresInSeconds": "21540",
+                "formats": [stream(18, 'video/mp4; codecs="avc1.42001E, mp4a.40.2"', size,
+                                   width=640, height=360, quality="medium", qualityLabel="360p", fps=30,
+                                   audioQuality="AUDIO_QUALITY_LOW", audioSampleRate="44100", audioChannels=2)],
+                "adaptiveFormats": adaptive,
+            },
+            "videoDetails": {
+                "videoId": video_id,
+                "title": f"Fake video {video_id}",
+                "lengthSeconds": str(self.length_seconds),
+                "channelId": "UCfakechannel000000000000",
+                "author": "Fake channel",
+                "viewCount": "1000",
+                "shortDescription": "",
+                "keywords": [],
+                "isLiveContent": False,
+                "thumbnail": {"thumbnails": [{"url": f"{self.base_url}/vi/{video_id}/hqdefault.jpg",
+                                              "width": 480, "height": 360}]},
+            },
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def fake_video_id(index):
+    return f"fake{index:07d}"
+
+
+class _RedirectHandler(urllib.request.BaseHandler):
+    # Runs before the stock HTTP(S) handlers and sends requests for YouTube hosts to
+    # the fake server instead; pytubefix does all of its I/O through urlopen.
+    handler_order = 100
+
+    def __init__(self, base_url):
+        self.base = urlsplit(base_url)
+
+    def _redirect(self, request):
+        parts = urlsplit(request.full_url)
+        if parts.hostname in YOUTUBE_HOSTS:
+            request.full_url = urlunsplit((self.base.scheme, self.base.netloc, parts.path, parts.query, ''))
+        return request
+
+    http_request = _redirect
+    https_request = _redirect
+
+
+def install_youtube_redirect(base_url):
+    urllib.request.install_opener(urllib.request.build_opener(_RedirectHandler(base_url)))
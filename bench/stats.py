@@ -0,0 +1,15 @@
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(values, scale=1.0):
+    # p50/p99/max of a list of samples, scaled (e.g. 1000 for seconds -> ms)
+    return {
+        "p50": round(percentile(values, 50) * scale, 3),
+        "p99": round(percentile(values, 99) * scale, 3),
+        "max": round(max(values) * scale, 3) if values else 0.0,
+    }
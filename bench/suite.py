@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from itertools import count
+from urllib.parse import quote
+
+import aiohttp
+
+from bench.fake_upstream import FakeUpstream, fake_video_id, install_youtube_redirect
+from bench.stats import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def watch_url(n):
+    return quote(f"https://www.youtube.com/watch?v={fake_video_id(n)}", safe='')
+
+
+# Request path for the n-th request of each scenario. Every request uses a new video
+# ID or query unless --warm is given, so the resolution and search paths are measured
+# rather than the manifest and search caches.
+ENDPOINTS = {
+    'info': lambda n: f"/info?video_url={watch_url(n)}",
+    'download': lambda n: f"/download?video_url={watch_url(n)}&qualite=360p",
+    'download_adaptive': lambda n: f"/download?video_url={watch_url(n)}&qualite=1080p",
+    'recherche': lambda n: f"/recherche?video=bench+{n}&max_results=50",
+}
+
+# The suite measures the service, not the production upstream budgets; any of these
+# can still be overridden from the environment.
+SERVER_ENV = {
+    'MEDIA_CACHE_MAX_BYTES': '0',
+    'PLAYER_API_RATE': '100000',
+    'PLAYER_API_BURST': '100000',
+    'DATA_API_RATE': '100000',
+    'DATA_API_BURST': '100000',
+    'CDN_RATE': '100000',
+    'CDN_BURST': '100000',
+    'YOUTUBE_API_KEY': 'bench',
+    'LOG_LEVEL': 'WARNING',
+}
+
+
+def serve(args):
+    # Child process: the app under test, with pytubefix and the Data API client
+    # pointed at the fake upstream. Prints its base URL, then runs until stdin closes.
+    install_youtube_redirect(args.upstream)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    from bench import bench_async
+
+    bench_async.core.client_preferences.remember(None, args.client)
+    if args.serve == 'async':
+        stop, base_url = bench_async.start_async_server()
+    else:
+        server, base_url = bench_async.start_sync_server(args.sync_workers)
+        stop = server.shutdown
+    print(base_url, flush=True)
+    sys.stdin.read()
+    stop()
+
+
+def read_status_kib(pid, field):
+    # VmHWM is the peak resident set size of the process; Linux only.
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def mib(kib):
+    return round(kib / 1024, 1) if kib is not None else None
+
+
+class ServerProcess:
+    def __init__(self, kind, upstream, args):
+        env = dict(os.environ)
+        for key, value in SERVER_ENV.items():
+            env.setdefault(key, value)
+        env['YOUTUBE_API_ENDPOINT'] = upstream.base_url
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'bench.suite', '--serve', kind, '--upstream', upstream.base_url,
+             '--client', args.client, '--sync-workers', str(args.sync_workers)],
+            cwd=ROOT, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+        self.base_url = self.process.stdout.readline().strip()
+        if not self.base_url:
+            self.process.wait()
+            raise RuntimeError(f"Benchmark server exited with status {self.process.returncode}")
+
+    def rss_kib(self, field='VmRSS'):
+        return read_status_kib(self.process.pid, field)
+
+    def stop(self):
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+async def fetch(session, url):
+    start = time.perf_counter()
+    ttfb = None
+    received = 0
+    try:
+        async with session.get(url) as response:
+            async for chunk in response.content.iter_chunked(65536):
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                received += len(chunk)
+            status = response.status
+    except Exception as e:
+        return {"status": type(e).__name__, "bytes": received}
+    elapsed = time.perf_counter() - start
+    return {"status": status, "ttfb": ttfb if ttfb is not None else elapsed, "seconds": elapsed, "bytes": received}
+
+
+async def run_load(base_url, paths, concurrency, timeout):
+    # `concurrency` clients share one list of request paths, each sending its next
+    # request as soon as the previous response has been read in full.
+    pending = iter(paths)
+    results = []
+
+    async def client(session):
+        for path in pending:
+            results.append(await fetch(session, base_url + path))
+
+    connector = aiohttp.TCPConnector(limit=0)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        began = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        wall = time.perf_counter() - began
+    return results, wall
+
+
+def scenario_paths(endpoint, requests, warm, ids):
+    make_path = ENDPOINTS[endpoint]
+    if warm:
+        path = make_path(next(ids))
+        return [path] * requests
+    return [make_path(next(ids)) for _ in range(requests)]
+
+
+def run_scenario(upstream, args, server_kind, endpoint, concurrency, ids):
+    paths = scenario_paths(endpoint, args.requests, args.warm, ids)
+    with ServerProcess(server_kind, upstream, args) as server:
+        if args.warm:
+            asyncio.run(run_load(server.base_url, paths[:1], 1, args.timeout))
+        rss_idle = server.rss_kib()
+        results, wall = asyncio.run(run_load(server.base_url, paths, concurrency, args.timeout))
+        rss_peak = server.rss_kib('VmHWM')
+
+    ok = [r for r in results if r["status"] == 200]
+    statuses = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    total_bytes = sum(r["bytes"] for r in ok)
+    return {
+        "endpoint": endpoint,
+        "server": server_kind,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "statuses": statuses,
+        "latency_ms": summarize([r["seconds"] for r in ok], 1000),
+        "ttfb_ms": summarize([r["ttfb"] for r in ok], 1000),
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(ok) / wall, 2) if wall else 0.0,
+        "throughput_mib_per_second": round(total_bytes / wall / (1024 * 1024), 2) if wall else 0.0,
+        "bytes": total_bytes,
+        "rss_idle_mib": mib(rss_idle),
+        "rss_peak_mib": mib(rss_peak),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return result["endpoint"], result["server"], result["concurrency"]
+
+
+def print_result(result, baseline=None):
+    line = (f"{result['endpoint']:>17} {result['server']:>5} {result['concurrency']:>4} "
+            f"{result['ok']:>5} {result['errors']:>4} "
+            f"{result['latency_ms']['p50']:>9.1f} {result['latency_ms']['p99']:>9.1f} "
+            f"{result['ttfb_ms']['p50']:>9.1f} {result['ttfb_ms']['p99']:>9.1f} "
+            f"{result['requests_per_second']:>8.1f} {result['throughput_mib_per_second']:>8.2f} "
+            f"{result['rss_peak_mib'] if result['rss_peak_mib'] is not None else '-':>8}")
+    if baseline:
+        before = baseline["latency_ms"]["p50"]
+        if before:
+            line += f"  p50 {(result['latency_ms']['p50'] - before) / before * 100:+.1f}%"
+    print(line, file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Per-endpoint latency, TTFB, throughput and peak RSS against a local fake YouTube"
+    )
+    parser.add_argument('--endpoints', nargs='+', choices=sorted(ENDPOINTS), default=['info', 'download', 'recherche'])
+    parser.add_argument('--servers', nargs='+', choices=['sync', 'async'], default=['sync'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=64, help="requests per endpoint and concurrency level")
+    parser.add_argument('--warm', action='store_true', help="repeat one video/query so caches are hit")
+    parser.add_argument('--sync-workers', type=int, default=8, help="size of the emulated sync worker pool")
+    parser.add_argument('--client', default='IOS', help="client type tried first when resolving")
+    parser.add_argument('--size-kib', type=int, default=2048, help="size of each fake media stream")
+    parser.add_argument('--bandwidth-kib', type=int, default=0, help="per-connection cap of the fake upstream, 0 = none")
+    parser.add_argument('--latency', type=float, default=0.01, help="fake googlevideo response latency (s)")
+    parser.add_argument('--player-latency', type=float, default=0.05, help="fake player API latency (s)")
+    parser.add_argument('--api-latency', type=float, default=0.03, help="fake Data API latency (s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of player/media requests answered 429")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output', default='-', help="JSON results file, '-' for stdout")
+    parser.add_argument('--baseline', help="earlier JSON results to compare p50 latency against")
+    parser.add_argument('--serve', choices=['sync', 'async'], help=argparse.SUPPRESS)
+    parser.add_argument('--upstream', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result_key(r): r for r in json.load(f)["results"]}
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    ids = count()
+    results = []
+    with FakeUpstream(bandwidth=args.bandwidth_kib * 1024, latency=args.latency,
+                      default_size=args.size_kib * 1024, player_latency=args.player_latency,
+                      api_latency=args.api_latency, error_rate=args.error_rate, seed=args.seed) as upstream:
+        print(f"{'endpoint':>17} {'srv':>5} {'conc':>4} {'ok':>5} {'err':>4} {'lat_p50':>9} {'lat_p99':>9} "
+              f"{'ttfb_p50':>9} {'ttfb_p99':>9} {'req/s':>8} {'MiB/s':>8} {'rss_MiB':>8}", file=sys.stderr)
+        for endpoint in args.endpoints:
+            for server_kind in args.servers:
+                for concurrency in args.concurrency:
+                    result = run_scenario(upstream, args, server_kind, endpoint, concurrency, ids)
+                    results.append(result)
+                    print_result(result, baseline.get(result_key(result)))
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'serve', 'upstream')}
+    document = {
+        "started_at": started_at,
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+    if args.output == '-':
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
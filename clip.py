@@ -0,0 +1,579 @@
+import bisect
+import logging
+import math
+import struct
+import sys
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# First request on a stream: enough for ftyp + moov + sidx of a DASH stream, or the
+# WebM header, seek head and (front) cues. Anything beyond is fetched on demand.
+HEAD_SIZE = 64 * 1024
+
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+MKV_SEGMENT = 0x18538067
+MKV_SEEK_HEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POSITION = 0x53AC
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_CUES = 0x1C53BB6B
+MKV_CUE_POINT = 0xBB
+MKV_CUE_TIME = 0xB3
+MKV_CUE_TRACK_POSITIONS = 0xB7
+MKV_CUE_CLUSTER_POSITION = 0xF1
+MKV_CLUSTER = 0x1F43B675
+MKV_VOID = 0xEC
+
+TFHD_BASE_DATA_OFFSET = 0x1
+
+
+class ClipError(ValueError):
+    pass
+
+
+class IndexUnavailable(Exception):
+    # The stream has no index this module can use; the caller falls back to the
+    # whole stream.
+    pass
+
+
+def parse_timestamp(value):
+    # "90", "90.5", "1:30" or "1:02:03.5" -> seconds; None when absent
+    if value is None or str(value).strip() == '':
+        return None
+    parts = str(value).strip().split(':')
+    if len(parts) > 3:
+        raise ValueError(f"Invalid timestamp: {value}")
+    seconds = 0.0
+    for index, part in enumerate(parts):
+        number = float(part)
+        if not math.isfinite(number) or number < 0 or (index and number >= 60):
+            raise ValueError(f"Invalid timestamp: {value}")
+        seconds = seconds * 60 + number
+    return seconds
+
+
+def clip_bounds(start, end, length_seconds):
+    # Validates a requested [start, end) span against the video length
+    start = start or 0.0
+    if length_seconds:
+        if start >= length_seconds:
+            raise ClipError("Le début de l'extrait dépasse la durée de la vidéo")
+        end = min(end, float(length_seconds)) if end is not None else float(length_seconds)
+    elif end is None:
+        raise ClipError("Paramètre 'end' requis: la durée de la vidéo est inconnue")
+    if end <= start:
+        raise ClipError("La fin de l'extrait doit être après son début")
+    return start, end
+
+
+class RangeReader:
+    # Byte ranges of one upstream stream through `open_range(byte_range)`, which
+    # returns a streamed requests response (Fetcher.open). Small reads are kept as
+    # `pieces` so they can be written back at their offsets.
+
+    def __init__(self, open_range, size=None):
+        self.open_range = open_range
+        self.size = size
+        self.pieces = []
+        self.requests = 0
+        self.bytes_read = 0
+
+    def read(self, start, end):
+        if self.size is not None:
+            end = min(end, self.size - 1)
+        with self.open_range((start, end)) as r:
+            data = r.content
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            status = r.status_code
+        if total.isdigit():
+            self.size = int(total)
+        elif status == 200:
+            # Range ignored by the server: the body is the whole stream
+            self.size = len(data)
+            data = data[start:end + 1]
+        self.requests += 1
+        self.bytes_read += len(data)
+        self.pieces.append((start, data))
+        return data
+
+    def get(self, offset, length):
+        # `length` bytes at `offset`, from earlier reads when they cover it; when a
+        # read covers only the beginning, just the rest is fetched.
+        if self.size is not None:
+            length = max(0, min(length, self.size - offset))
+        end = offset + length
+        for start, data in self.pieces:
+            if start <= offset < start + len(data):
+                if end <= start + len(data):
+                    return data[offset - start:end - start]
+                head = data[offset - start:]
+                return head + self.read(start + len(data), end - 1)
+        return self.read(offset, end - 1)
+
+
+def locate_clip(reader, start, end):
+    # Works out which bytes of a stream cover [start, end) seconds. Returns the
+    # stream size, the media `ranges` (inclusive) to fetch and `seek`, the time of
+    # the first keyframe/fragment included, with the layout to rebuild them in:
+    # - "sparse": the index `pieces` already read and the ranges are written back at
+    #   their offsets in a file of the real size (progressive MP4, whose sample
+    #   tables point into the file);
+    # - "compact": the init `header` followed by the ranges (DASH MP4 and WebM,
+    #   whose fragments/clusters are self-contained). Timestamps keep their
+    #   original values, so the cut is made at absolute times in both layouts.
+    head = reader.get(0, HEAD_SIZE)
+    try:
+        if head[4:8] == b'ftyp':
+            seek, ranges, header = _locate_mp4(reader, start, end)
+        elif head[:4] == EBML_MAGIC:
+            seek, ranges, header = _locate_webm(reader, start, end)
+        else:
+            raise IndexUnavailable("unknown container")
+    except (IndexUnavailable, struct.error, IndexError) as e:
+        logger.warning(f"No usable index ({e}), clipping from the whole stream")
+        seek, ranges, header = 0.0, [(0, reader.size - 1)], None
+        _count('fallbacks')
+    return {
+        "size": reader.size,
+        "layout": "sparse" if header is None else "compact",
+        "header": header,
+        "pieces": list(reader.pieces) if header is None else [],
+        "ranges": ranges,
+        "seek": seek,
+        "index_requests": reader.requests,
+        "index_bytes": reader.bytes_read,
+    }
+
+
+def write_clip(path, clip, fetch_range):
+    # Writes the located bytes to `path`; `fetch_range(byte_range)` yields the
+    # bytes of a range. Sparse files keep their real size, the bytes not needed
+    # being a hole, so every offset in the index stays valid.
+    with open(path, 'wb') as f:
+        if clip["layout"] == "compact":
+            f.write(clip["header"])
+            for byte_range in clip["ranges"]:
+                for chunk in fetch_range(byte_range):
+                    f.write(chunk)
+            return
+        f.truncate(clip["size"])
+        for offset, data in clip["pieces"]:
+            f.seek(offset)
+            f.write(data)
+        for start, end in clip["ranges"]:
+            f.seek(start)
+            for chunk in fetch_range((start, end)):
+                f.write(chunk)
+
+
+# --- MP4 -------------------------------------------------------------------------
+
+def _boxes(data, start=0, end=None):
+    # (type, payload start, payload end) of the boxes in data[start:end]
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            raise IndexUnavailable("invalid box size")
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+def _child(data, start, end, *path):
+    for kind in path:
+        for child_kind, child_start, child_end in _boxes(data, start, end):
+            if child_kind == kind:
+                start, end = child_start, child_end
+                break
+        else:
+            return None
+    return start, end
+
+
+def _top_level_boxes(reader):
+    offset = 0
+    while offset < reader.size:
+        header = reader.get(offset, 16)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = reader.size - offset
+        if size < header_size:
+            raise IndexUnavailable("invalid box size")
+        yield kind, offset, size
+        offset += size
+
+
+def _locate_mp4(reader, start, end):
+    moov = sidx = None
+    init = []
+    for kind, offset, size in _top_level_boxes(reader):
+        if kind == b'moov':
+            moov = reader.get(offset, size)
+        elif kind == b'sidx' and sidx is None:
+            sidx = (reader.get(offset, size), offset + size)
+        elif kind in (b'moof', b'mdat') and moov is not None:
+            break
+        if kind != b'sidx':
+            init.append((offset, size))
+    if moov is None:
+        raise IndexUnavailable("no moov box")
+    if _child(moov, 8, len(moov), b'mvex'):
+        if sidx is None:
+            raise IndexUnavailable("fragmented MP4 without sidx")
+        seek, ranges = _locate_fragments(sidx[0], sidx[1], start, end)
+        _check_relocatable(reader.get(ranges[0][0], 64))
+        # ftyp + moov; the sidx is left out since its offsets no longer hold
+        return seek, ranges, b''.join(reader.get(offset, size) for offset, size in init)
+    return _locate_samples(moov, start, end) + (None,)
+
+
+def _check_relocatable(moof):
+    # Fragments can only be moved next to the init segment when their sample
+    # offsets are relative to their own moof rather than to the file
+    traf = _child(moof, 8, len(moof), b'traf')
+    tfhd = traf and _child(moof, traf[0], min(traf[1], len(moof)), b'tfhd')
+    if not tfhd:
+        raise IndexUnavailable("no tfhd in the first fragment")
+    if struct.unpack_from('>I', moof, tfhd[0])[0] & TFHD_BASE_DATA_OFFSET:
+        raise IndexUnavailable("fragments with absolute data offsets")
+
+
+def _locate_fragments(box, anchor, start, end):
+    # DASH streams: the sidx lists every fragment (moof + mdat) with its duration
+    # and size, so the span is the run of fragments overlapping [start, end).
+    payload = memoryview(box)[8:]
+    version = payload[0]
+    timescale = struct.unpack_from('>I', payload, 8)[0]
+    if version == 0:
+        earliest, first_offset = struct.unpack_from('>II', payload, 12)
+        position = 20
+    else:
+        earliest, first_offset = struct.unpack_from('>QQ', payload, 12)
+        position = 28
+    count = struct.unpack_from('>H', payload, position + 2)[0]
+    position += 4
+    times, offsets, sizes = [], [], []
+    time, offset = earliest, anchor + first_offset
+    for index in range(count):
+        reference, duration = struct.unpack_from('>II', payload, position + index * 12)
+        if reference >> 31:
+            raise IndexUnavailable("hierarchical sidx")
+        times.append(time / timescale)
+        offsets.append(offset)
+        sizes.append(reference & 0x7FFFFFFF)
+        time += duration
+        offset += reference & 0x7FFFFFFF
+    if not count:
+        raise IndexUnavailable("empty sidx")
+    first = max(0, bisect.bisect_right(times, start) - 1)
+    last = max(first, bisect.bisect_left(times, end) - 1)
+    return times[first], [(offsets[first], offsets[last] + sizes[last] - 1)]
+
+
+def _uint32_array(data, start, count):
+    values = array('I', bytes(data[start:start + 4 * count]))
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+class _Track:
+    # Sample tables of one track of a non-fragmented MP4
+
+    def __init__(self, moov, start, end):
+        mdia = _child(moov, start, end, b'mdia')
+        mdhd = _child(moov, *mdia, b'mdhd')
+        hdlr = _child(moov, *mdia, b'hdlr')
+        stbl = _child(moov, *mdia, b'minf', b'stbl')
+        if not (mdhd and hdlr and stbl):
+            raise IndexUnavailable("incomplete track")
+        version = moov[mdhd[0]]
+        self.timescale = struct.unpack_from('>I', moov, mdhd[0] + (20 if version == 1 else 12))[0]
+        self.handler = bytes(moov[hdlr[0] + 8:hdlr[0] + 12])
+
+        stts = _child(moov, *stbl, b'stts')
+        count = struct.unpack_from('>I', moov, stts[0] + 4)[0]
+        table = _uint32_array(moov, stts[0] + 8, 2 * count)
+        self.stts = list(zip(table[0::2], table[1::2]))
+
+        stss = _child(moov, *stbl, b'stss')
+        if stss:
+            count = struct.unpack_from('>I', moov, stss[0] + 4)[0]
+            self.sync = _uint32_array(moov, stss[0] + 8, count)
+        else:
+            self.sync = None
+
+        stsc = _child(moov, *stbl, b'stsc')
+        count = struct.unpack_from('>I', moov, stsc[0] + 4)[0]
+        table = _uint32_array(moov, stsc[0] + 8, 3 * count)
+        self.stsc = list(zip(table[0::3], table[1::3]))
+
+        stsz = _child(moov, *stbl, b'stsz')
+        if not stsz:
+            raise IndexUnavailable("no stsz box")
+        self.sample_size, self.sample_count = struct.unpack_from('>II', moov, stsz[0] + 4)
+        self.sizes = _uint32_array(moov, stsz[0] + 12, self.sample_count) if not self.sample_size else None
+
+        stco = _child(moov, *stbl, b'stco')
+        co64 = _child(moov, *stbl, b'co64')
+        if stco:
+            count = struct.unpack_from('>I', moov, stco[0] + 4)[0]
+            self.chunks = _uint32_array(moov, stco[0] + 8, count)
+        elif co64:
+            count = struct.unpack_from('>I', moov, co64[0] + 4)[0]
+            self.chunks = struct.unpack_from(f'>{count}Q', moov, co64[0] + 8)
+        else:
+            raise IndexUnavailable("no chunk offsets")
+
+    def sample_at(self, seconds):
+        # (index, time) of the last sample decoded at or before `seconds`
+        target = seconds * self.timescale
+        index, time = 0, 0
+        for count, delta in self.stts:
+            if delta and time + count * delta > target:
+                steps = int((target - time) // delta)
+                return index + steps, (time + steps * delta) / self.timescale
+            index += count
+            time += count * delta
+        return max(0, index - 1), time / self.timescale
+
+    def sync_before(self, index):
+        # Index of the last keyframe at or before sample `index`
+        if self.sync is None:
+            return index
+        position = bisect.bisect_right(self.sync, index + 1) - 1
+        return self.sync[max(0, position)] - 1
+
+    def byte_range(self, index):
+        # (offset, size) of sample `index`, through the sample-to-chunk runs
+        index = min(index, self.sample_count - 1)
+        first_sample = 0
+        for run, (first_chunk, per_chunk) in enumerate(self.stsc):
+            next_chunk = self.stsc[run + 1][0] if run + 1 < len(self.stsc) else len(self.chunks) + 1
+            run_samples = (next_chunk - first_chunk) * per_chunk
+            if index < first_sample + run_samples:
+                chunk = first_chunk - 1 + (index - first_sample) // per_chunk
+                in_chunk = (index - first_sample) % per_chunk
+                if self.sizes is None:
+                    return self.chunks[chunk] + in_chunk * self.sample_size, self.sample_size
+                chunk_start = index - in_chunk
+                return self.chunks[chunk] + sum(self.sizes[chunk_start:index]), self.sizes[index]
+            first_sample += run_samples
+        raise IndexUnavailable("sample outside the chunk table")
+
+
+def _locate_samples(moov, start, end):
+    # Progressive MP4: the moov sample tables give the offset of every sample. The
+    # span runs from the keyframe before `start` (and the audio from that time) to
+    # the last samples before `end`; tracks are interleaved, so it is contiguous.
+    tracks = [_Track(moov, *trak) for kind, *trak in _boxes(moov, 8) if kind == b'trak']
+    if not tracks:
+        raise IndexUnavailable("no tracks")
+    reference = next((t for t in tracks if t.handler == b'vide'), tracks[0])
+    index, _ = reference.sample_at(start)
+    seek = _sample_time(reference, reference.sync_before(index))
+    first, last = None, None
+    for track in tracks:
+        first_index, _ = track.sample_at(seek)
+        last_index, _ = track.sample_at(end)
+        offset, _ = track.byte_range(first_index)
+        end_offset, size = track.byte_range(last_index + 1)
+        first = offset if first is None else min(first, offset)
+        last = end_offset + size - 1 if last is None else max(last, end_offset + size - 1)
+    return seek, [(first, last)]
+
+
+def _sample_time(track, index):
+    time = 0
+    for count, delta in track.stts:
+        if index < count:
+            return (time + index * delta) / track.timescale
+        index -= count
+        time += count * delta
+    return time / track.timescale
+
+
+# --- WebM ------------------------------------------------------------------------
+
+def _vint(data, position, marker=False):
+    # EBML variable-length integer: (value, length, all ones). Element IDs keep
+    # their length marker, sizes do not.
+    first = data[position]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise IndexUnavailable("invalid EBML integer")
+    value = first if marker else first & (mask - 1)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+    return value, length, not marker and value == (1 << (7 * length)) - 1
+
+
+def _element_header(data, position):
+    element_id, id_length, _ = _vint(data, position, marker=True)
+    size, size_length, unknown = _vint(data, position + id_length)
+    return element_id, position + id_length + size_length, None if unknown else size
+
+
+def _elements(data, start, end):
+    position = start
+    while position < end:
+        element_id, payload, size = _element_header(data, position)
+        payload_end = end if size is None else payload + size
+        yield element_id, payload, payload_end
+        position = payload_end
+
+
+def _uint(data, start, end):
+    return int.from_bytes(data[start:end], 'big')
+
+
+def _locate_webm(reader, start, end):
+    # DASH WebM: clusters start on keyframes and the cues give the time and
+    # position of each, so the span is the run of clusters overlapping [start, end).
+    head = reader.get(0, 64)
+    _, payload, size = _element_header(head, 0)
+    segment_offset = payload + size
+    header = reader.get(segment_offset, 12)
+    element_id, segment_start, segment_size = _element_header(header, 0)
+    if element_id != MKV_SEGMENT:
+        raise IndexUnavailable("no segment")
+    segment_start += segment_offset
+    segment_end = reader.size if segment_size is None else min(reader.size, segment_start + segment_size)
+
+    timecode_scale = 1000000
+    cues = cues_position = first_cluster = None
+    voided = []
+    position = segment_start
+    while position < segment_end:
+        header = reader.get(position, 12)
+        element_id, payload, size = _element_header(header, 0)
+        payload += position
+        if element_id == MKV_CLUSTER or size is None:
+            first_cluster = position
+            break
+        if element_id == MKV_INFO:
+            info = reader.get(payload, size)
+            for child_id, child_start, child_end in _elements(info, 0, len(info)):
+                if child_id == MKV_TIMECODE_SCALE:
+                    timecode_scale = _uint(info, child_start, child_end)
+        elif element_id == MKV_SEEK_HEAD:
+            voided.append((position, payload + size))
+            seek_head = reader.get(payload, size)
+            for seek_id, seek_start, seek_end in _elements(seek_head, 0, len(seek_head)):
+                if seek_id != MKV_SEEK:
+                    continue
+                target = target_position = None
+                for child_id, child_start, child_end in _elements(seek_head, seek_start, seek_end):
+                    if child_id == MKV_SEEK_ID:
+                        target = _uint(seek_head, child_start, child_end)
+                    elif child_id == MKV_SEEK_POSITION:
+                        target_position = _uint(seek_head, child_start, child_end)
+                if target == MKV_CUES and target_position is not None:
+                    cues_position = segment_start + target_position
+        elif element_id == MKV_CUES:
+            voided.append((position, payload + size))
+            cues = reader.get(payload, size)
+        position = payload + size
+    if first_cluster is None:
+        raise IndexUnavailable("no cluster")
+    if cues is None:
+        if cues_position is None:
+            raise IndexUnavailable("no cues")
+        header = reader.get(cues_position, 12)
+        element_id, payload, size = _element_header(header, 0)
+        if element_id != MKV_CUES or size is None:
+            raise IndexUnavailable("seek head does not point to the cues")
+        cues = reader.get(cues_position + payload, size)
+    # The header and tracks are needed by the demuxer
+    header = _webm_header(reader.get(0, first_cluster), segment_offset, voided)
+
+    points = []
+    for point_id, point_start, point_end in _elements(cues, 0, len(cues)):
+        if point_id != MKV_CUE_POINT:
+            continue
+        time = cluster = None
+        for child_id, child_start, child_end in _elements(cues, point_start, point_end):
+            if child_id == MKV_CUE_TIME:
+                time = _uint(cues, child_start, child_end)
+            elif child_id == MKV_CUE_TRACK_POSITIONS and cluster is None:
+                for field_id, field_start, field_end in _elements(cues, child_start, child_end):
+                    if field_id == MKV_CUE_CLUSTER_POSITION:
+                        cluster = _uint(cues, field_start, field_end)
+        if time is not None and cluster is not None:
+            points.append((time * timecode_scale / 1e9, segment_start + cluster))
+    if not points:
+        raise IndexUnavailable("empty cues")
+    points.sort()
+    times = [time for time, _ in points]
+    first = max(0, bisect.bisect_right(times, start) - 1)
+    following = bisect.bisect_left(times, end)
+    # Several cue points can share a cluster; the span ends at the next cluster after `end`
+    stop = next((cluster for _, cluster in points[following:] if cluster > points[first][1]), segment_end)
+    return times[first], [(points[first][1], stop - 1)], header
+
+
+def _webm_header(data, segment_offset, voided):
+    # Everything before the first cluster, made valid for the clusters that follow
+    # it directly: the segment size becomes unknown, and the seek head and cues,
+    # whose positions no longer hold, become Void elements of the same length.
+    header = bytearray(data)
+    _, id_length, _ = _vint(header, segment_offset, marker=True)
+    _, size_length, _ = _vint(header, segment_offset + id_length)
+    position = segment_offset + id_length
+    header[position:position + size_length] = ((1 << (8 * size_length - size_length + 1)) - 1).to_bytes(size_length, 'big')
+    for start, end in voided:
+        if end > len(header):
+            continue
+        size_length = 8 if end - start >= 9 else 1
+        size = end - start - 1 - size_length
+        header[start] = MKV_VOID
+        header[start + 1:start + 1 + size_length] = ((1 << (7 * size_length)) | size).to_bytes(size_length, 'big')
+        header[start + 1 + size_length:end] = bytes(size)
+    return bytes(header)
+
+
+_stats = dict.fromkeys(('clips', 'fallbacks', 'index_requests', 'index_bytes', 'media_bytes', 'full_bytes'), 0)
+_stats_lock = threading.Lock()
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def record_clip(clip):
+    with _stats_lock:
+        _stats['clips'] += 1
+        _stats['index_requests'] += clip["index_requests"]
+        _stats['index_bytes'] += clip["index_bytes"]
+        _stats['media_bytes'] += sum(end - start + 1 for start, end in clip["ranges"])
+        _stats['full_bytes'] += clip["size"] or 0
+
+
+def clip_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["bytes_avoided"] = max(0, stats["full_bytes"] - stats["index_bytes"] - stats["media_bytes"])
+    return stats
@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import stage_seconds
+from ranges import format_range_header
+from ratelimit import get_limiter, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': '*/*',
+    'Accept-Encoding': 'identity',
+    'Connection': 'keep-alive',
+}
+
+
+class Fetcher:
+    def __init__(self, chunk_size=65536, segments=1, segment_size=2 * 1024 * 1024,
+                 buffer_segments=None, pool_size=32, timeout=300, limiter=None):
+        self.chunk_size = chunk_size
+        self.segments = max(1, segments)
+        self.segment_size = segment_size
+        self.buffer_segments = max(self.segments, buffer_segments or self.segments * 2)
+        self.timeout = timeout
+        self.limiter = limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(UPSTREAM_HEADERS)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='fetcher')
+        self._lock = threading.Lock()
+        self.segments_fetched = 0
+        self.segment_retries = 0
+
+    def open(self, url, byte_range=None):
+        headers = {}
+        if byte_range:
+            headers['Range'] = format_range_header(byte_range)
+        if self.limiter:
+            self.limiter.acquire()
+        start = time.monotonic()
+        r = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+        stage_seconds.labels('upstream_connect').observe(time.monotonic() - start)
+        try:
+            if r.status_code in (403, 429) and self.limiter:
+                self.limiter.penalize(parse_retry_after(r.headers.get('Retry-After')))
+            r.raise_for_status()
+        except requests.HTTPError:
+            r.close()
+            raise
+        if self.limiter:
+            self.limiter.record_success()
+        return r
+
+    def relay(self, r, chunk_size=None):
+        try:
+            with r:
+                for chunk in r.iter_content(chunk_size=chunk_size or self.chunk_size):
+                    if chunk:
+                        yield chunk
+        except Exception as e:
+            logger.error(f"Stream error: {e}")
+            raise
+
+    def iter_content(self, url, byte_range=None):
+        yield from self.relay(self.open(url, byte_range))
+
+    def _fetch_segment(self, url, start, end, attempts=2):
+        for attempt in range(attempts):
+            try:
+                with self.open(url, (start, end)) as r:
+                    data = r.content
+                if len(data) != end - start + 1:
+                    raise IOError(f"Short segment {start}-{end}: got {len(data)} bytes")
+                with self._lock:
+                    self.segments_fetched += 1
+                return data
+            except requests.HTTPError:
+                raise
+            except Exception as e:
+                if attempt + 1 >= attempts:
+                    raise
+                logger.warning(f"Segment {start}-{end} failed ({e}), retrying")
+                with self._lock:
+                    self.segment_retries += 1
+
+    def iter_segmented(self, url, start, end):
+        # Fetches [start, end] as fixed-size byte-range segments on up to `segments`
+        # connections and yields them in order. The deque of futures is the reorder
+        # buffer: at most `buffer_segments` segments are in flight or waiting to be
+        # emitted, so memory stays bounded by buffer_segments * segment_size.
+        bounds = deque(
+            (offset, min(offset + self.segment_size - 1, end))
+            for offset in range(start, end + 1, self.segment_size)
+        )
+        window = deque()
+        try:
+            while bounds or window:
+                running = [f for f in window if not f.done()]
+                while bounds and len(window) < self.buffer_segments and len(running) < self.segments:
+                    seg_start, seg_end = bounds.popleft()
+                    future = self._executor.submit(self._fetch_segment, url, seg_start, seg_end)
+                    window.append(future)
+                    running.append(future)
+                if not window[0].done():
+                    wait(running, return_when=FIRST_COMPLETED)
+                    continue
+                data = window.popleft().result()
+                for offset in range(0, len(data), self.chunk_size):
+                    yield data[offset:offset + self.chunk_size]
+        finally:
+            for future in window:
+                future.cancel()
+
+    def segment_span(self, byte_range=None, size=None):
+        # Segmented mode needs an absolute range, so it only applies when the size is known.
+        if self.segments <= 1 or not size:
+            return None
+        start, end = byte_range if byte_range else (0, size - 1)
+        if start is None or end is None or end - start + 1 <= self.segment_size:
+            return None
+        return start, end
+
+    def stream(self, url, byte_range=None, size=None):
+        span = self.segment_span(byte_range, size)
+        if span:
+            return self.iter_segmented(url, *span)
+        return self.iter_content(url, byte_range)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chunk_size": self.chunk_size,
+                "segments": self.segments,
+                "segment_size": self.segment_size,
+                "buffer_segments": self.buffer_segments,
+                "segments_fetched": self.segments_fetched,
+                "segment_retries": self.segment_retries,
+            }
+
+
+def fetcher_from_env(limiter=None):
+    return Fetcher(
+        chunk_size=int(os.environ.get('FETCH_CHUNK_SIZE', 65536)),
+        segments=int(os.environ.get('FETCH_SEGMENTS', 1)),
+        segment_size=int(os.environ.get('FETCH_SEGMENT_SIZE', 2 * 1024 * 1024)),
+        buffer_segments=int(os.environ.get('FETCH_BUFFER_SEGMENTS', 0)) or None,
+        pool_size=int(os.environ.get('FETCH_POOL_SIZE', 32)),
+        timeout=float(os.environ.get('FETCH_TIMEOUT', 300)),
+        limiter=limiter if limiter is not None else get_limiter('cdn'),
+    )
@@ -0,0 +1,341 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    client TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    bytes_done INTEGER NOT NULL DEFAULT 0,
+    bytes_total INTEGER,
+    filename TEXT,
+    mime_type TEXT,
+    artifact TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created_at);
+"""
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+EXPIRED = 'expired'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobLost(Exception):
+    # The job was requeued by another process while this worker was running it
+    pass
+
+
+class JobQueue:
+    # The queue lives in SQLite rather than in memory: every worker process sharing the
+    # database claims jobs with an atomic UPDATE, so jobs survive restarts and a job
+    # submitted to one gunicorn worker can run in another. A running job whose heartbeat
+    # stops (crash, restart) is put back in the queue after `stale_seconds`; a live job
+    # refreshes it every `heartbeat_interval` seconds from its own thread, whether or not
+    # chunks are flowing, and only the worker that still owns a job may complete it.
+    #
+    # `runner(params)` returns a dict with "filename", "mime_type", "chunks" (an
+    # iterable of bytes) and "total" (expected size, or None); the queue writes the
+    # chunks to the artifact file and records progress.
+
+    def __init__(self, db_path, artifact_dir, runner, workers=2, max_queued=100, per_client=1,
+                 ttl=24 * 3600, stale_seconds=300, max_attempts=3, poll_interval=1.0, progress_interval=1.0,
+                 heartbeat_interval=None):
+        self.db_path = db_path
+        self.artifact_dir = artifact_dir
+        self.runner = runner
+        self.workers = workers
+        self.max_queued = max_queued
+        self.per_client = per_client
+        self.ttl = ttl
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.heartbeat_interval = heartbeat_interval or max(1.0, stale_seconds / 5)
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._ready = False
+
+    def _db(self):
+        # The database and artifact folder are created on first use, not at import
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            if not self._ready:
+                os.makedirs(self.artifact_dir, exist_ok=True)
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if not self._ready:
+                conn.executescript(SCHEMA)
+                self._ready = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def start(self):
+        # Idempotent, and fork-aware: threads started before a pre-fork do not survive
+        # in the children, so each process starts its own workers on first use.
+        pid = os.getpid()
+        if self._started_pid == pid or self.workers <= 0:
+            return
+        with self._start_lock:
+            if self._started_pid == pid:
+                return
+            self._started_pid = pid
+            for index in range(self.workers):
+                threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True).start()
+
+    def submit(self, client, params, priority=0):
+        self.start()
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull(queued)
+            db.execute(
+                "INSERT INTO jobs (id, client, priority, params, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, client, priority, json.dumps(params), QUEUED, now)
+            )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        with self._wakeup:
+            self._wakeup.notify()
+        return self.get(job_id)
+
+    def get(self, job_id):
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        if job["status"] == QUEUED:
+            job["position"] = self._db().execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND (priority > ? OR (priority = ? AND created_at < ?))",
+                (QUEUED, job["priority"], job["priority"], job["created_at"])
+            ).fetchone()[0] + 1
+        return job
+
+    def _claim(self):
+        # Unique per attempt, so a requeued job claimed again by the same thread is
+        # still told apart from the earlier run
+        owner = f"{os.getpid()}:{threading.get_ident()}:{uuid.uuid4().hex[:8]}"
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                """
+                SELECT id FROM jobs
+                WHERE status = ? AND client NOT IN (
+                    SELECT client FROM jobs WHERE status = ? GROUP BY client HAVING COUNT(*) >= ?
+                )
+                ORDER BY priority DESC, created_at
+                LIMIT 1
+                """,
+                (QUEUED, RUNNING, self.per_client)
+            ).fetchone()
+            if row is None:
+                db.execute('COMMIT')
+                return None
+            db.execute(
+                "UPDATE jobs SET status = ?, owner = ?, started_at = ?, heartbeat_at = ?, bytes_done = 0,"
+                " attempts = attempts + 1 WHERE id = ?",
+                (RUNNING, owner, now, now, row["id"])
+            )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return self.get(row["id"])
+
+    def _work(self):
+        while True:
+            try:
+                self._sweep()
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Job queue error: {e}")
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+            try:
+                self._run(job)
+            except Exception as e:
+                logger.error(f"Job {job['id']} could not be recorded: {e}")
+
+    def _heartbeat(self, job_id, owner, stop, lost):
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                updated = self._db().execute(
+                    "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND owner = ? AND status = ?",
+                    (time.time(), job_id, owner, RUNNING)
+                ).rowcount
+            except Exception as e:
+                logger.warning(f"Job {job_id} heartbeat failed: {e}")
+                continue
+            if not updated:
+                lost.set()
+                return
+
+    def _finish(self, job_id, owner, status, complete=None, **fields):
+        # Records the outcome only if this worker still owns the job; `complete` (the
+        # artifact rename) runs inside the same write transaction
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute("SELECT owner, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row["owner"] != owner or row["status"] != RUNNING:
+                db.execute('ROLLBACK')
+                return False
+            if complete:
+                complete()
+            assignments = ', '.join(f"{name} = ?" for name in fields)
+            db.execute(
+                f"UPDATE jobs SET status = ?, finished_at = ?, {assignments} WHERE id = ?",
+                (status, time.time(), *fields.values(), job_id)
+            )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return True
+
+    def _run(self, job):
+        job_id = job["id"]
+        owner = job["owner"]
+        path = os.path.join(self.artifact_dir, job_id)
+        part_path = f"{path}.{owner.rsplit(':', 1)[-1]}.part"
+        db = self._db()
+        result = None
+        stop, lost = threading.Event(), threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job_id, owner, stop, lost),
+                         name=f"job-heartbeat-{job_id[:8]}", daemon=True).start()
+        try:
+            try:
+                result = self.runner(job["params"])
+                if lost.is_set():
+                    raise JobLost(job_id)
+                db.execute(
+                    "UPDATE jobs SET filename = ?, mime_type = ?, bytes_total = ? WHERE id = ? AND owner = ?",
+                    (result["filename"], result["mime_type"], result.get("total"), job_id, owner)
+                )
+                written = 0
+                reported = time.monotonic()
+                with open(part_path, 'wb') as f:
+                    for chunk in result["chunks"]:
+                        if lost.is_set():
+                            raise JobLost(job_id)
+                        f.write(chunk)
+                        written += len(chunk)
+                        if time.monotonic() - reported >= self.progress_interval:
+                            reported = time.monotonic()
+                            db.execute(
+                                "UPDATE jobs SET bytes_done = ?, heartbeat_at = ? WHERE id = ? AND owner = ?",
+                                (written, time.time(), job_id, owner)
+                            )
+            except Exception as e:
+                close = getattr(result.get("chunks") if result else None, 'close', None)
+                if close:
+                    close()
+                try:
+                    os.unlink(part_path)
+                except FileNotFoundError:
+                    pass
+                if isinstance(e, JobLost):
+                    logger.warning(f"Job {job_id} was requeued while running; discarding this attempt")
+                    return
+                logger.error(f"Job {job_id} failed: {e}")
+                self._finish(job_id, owner, FAILED, error=str(e))
+                return
+            completed = self._finish(
+                job_id, owner, DONE, complete=lambda: os.replace(part_path, path),
+                artifact=path, bytes_done=written, bytes_total=written
+            )
+            if not completed:
+                logger.warning(f"Job {job_id} was requeued while running; discarding this attempt")
+                try:
+                    os.unlink(part_path)
+                except FileNotFoundError:
+                    pass
+        finally:
+            stop.set()
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _sweep(self):
+        # Requeues jobs abandoned by a dead worker and deletes expired artifacts.
+        # Runs at most once per poll interval per process.
+        now = time.time()
+        if now - self._last_sweep < max(self.poll_interval, 1.0):
+            return
+        self._last_sweep = now
+        db = self._db()
+        stale = now - self.stale_seconds
+        requeued = db.execute(
+            "UPDATE jobs SET status = ?, owner = NULL WHERE status = ? AND heartbeat_at < ? AND attempts < ?",
+            (QUEUED, RUNNING, stale, self.max_attempts)
+        ).rowcount
+        abandoned = db.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status = ? AND heartbeat_at < ?",
+            (FAILED, "Job abandoned after repeated worker failures", now, RUNNING, stale)
+        ).rowcount
+        if requeued or abandoned:
+            logger.warning(f"Requeued {requeued} stalled job(s), abandoned {abandoned}")
+        expired = db.execute(
+            "SELECT id, artifact FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+            (DONE, FAILED, now - self.ttl)
+        ).fetchall()
+        for row in expired:
+            if row["artifact"]:
+                try:
+                    os.unlink(row["artifact"])
+                except FileNotFoundError:
+                    pass
+            db.execute("UPDATE jobs SET status = ?, artifact = NULL WHERE id = ?", (EXPIRED, row["id"]))
+
+    def stats(self):
+        counts = dict(self._db().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {
+            "workers": self.workers,
+            "max_queued": self.max_queued,
+            "per_client": self.per_client,
+            "queued": counts.get(QUEUED, 0),
+            "running": counts.get(RUNNING, 0),
+            "done": counts.get(DONE, 0),
+            "failed": counts.get(FAILED, 0),
+            "expired": counts.get(EXPIRED, 0),
+        }
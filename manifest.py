@@ -0,0 +1,177 @@
+import re
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+from cache import TTLCache
+
+VIDEO_ID_RE = re.compile(r'(?:v=|/shorts/|youtu\.be/|/embed/|/live/|/v/)([A-Za-z0-9_-]{11})')
+BARE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+# Safety margin before googlevideo signed URLs expire
+EXPIRY_MARGIN = 120
+
+
+def extract_video_id(video_url):
+    if not video_url:
+        return None
+    video_url = video_url.strip()
+    if BARE_ID_RE.match(video_url):
+        return video_url
+    match = VIDEO_ID_RE.search(video_url)
+    return match.group(1) if match else None
+
+
+def url_expiry(stream_url):
+    try:
+        expire = parse_qs(urlparse(stream_url).query).get('expire')
+        return int(expire[0]) if expire else None
+    except (ValueError, TypeError):
+        return None
+
+
+def _resolution_value(resolution):
+    digits = re.sub(r'\D', '', resolution or '')
+    return int(digits) if digits else 0
+
+
+def _abr_value(abr):
+    digits = re.sub(r'\D', '', abr or '')
+    return int(digits) if digits else 0
+
+
+def _stream_filesize(stream):
+    # Only progressive streams are worth a HEAD request when contentLength is missing
+    if stream.is_progressive:
+        try:
+            return stream.filesize or None
+        except Exception:
+            return None
+    return getattr(stream, '_filesize', 0) or None
+
+
+def build_manifest(yt):
+    streams = []
+    for stream in yt.streams:
+        streams.append({
+            "itag": stream.itag,
+            "mime_type": stream.mime_type,
+            "subtype": stream.subtype,
+            "codecs": list(stream.codecs),
+            "progressive": stream.is_progressive,
+            "only_audio": stream.type == 'audio' and not stream.is_progressive,
+            "only_video": stream.type == 'video' and not stream.is_progressive,
+            "resolution": stream.resolution,
+            "fps": getattr(stream, 'fps', None),
+            "abr": stream.abr,
+            "filesize": _stream_filesize(stream),
+            "duration_ms": getattr(stream, 'durationMs', None),
+            "last_modified": getattr(stream, 'last_Modified', None),
+            "url": stream.url,
+            "expire": url_expiry(stream.url),
+        })
+
+    expiries = [s["expire"] for s in streams if s["expire"]]
+    return {
+        "video_id": yt.video_id,
+        "title": yt.title,
+        "author": yt.author,
+        "length_seconds": yt.length,
+        "views": yt.views,
+        "thumbnail_url": yt.thumbnail_url,
+        "streams": streams,
+        "expire": min(expiries) if expiries else None,
+    }
+
+
+def manifest_ttl(manifest, default_ttl):
+    if not manifest.get("expire"):
+        return default_ttl
+    return min(default_ttl, manifest["expire"] - time.time() - EXPIRY_MARGIN)
+
+
+def progressive_streams(manifest, subtype='mp4'):
+    return [s for s in manifest["streams"] if s["progressive"] and s["subtype"] == subtype]
+
+
+def select_progressive(manifest, resolution=None, subtype='mp4'):
+    candidates = progressive_streams(manifest, subtype)
+    if resolution:
+        for stream in candidates:
+            if stream["resolution"] == resolution:
+                return stream
+    if not candidates:
+        return None
+    return max(candidates, key=lambda s: _resolution_value(s["resolution"]))
+
+
+def select_audio(manifest, subtype=None):
+    candidates = [s for s in manifest["streams"] if s["only_audio"]]
+    if subtype:
+        # Fall back to any container rather than failing outright
+        candidates = [s for s in candidates if s["subtype"] == subtype] or candidates
+    if not candidates:
+        return None
+    return max(candidates, key=lambda s: _abr_value(s["abr"]))
+
+
+def select_adaptive(manifest, resolution):
+    # Prefer H.264/MP4 (most compatible once muxed), then the highest frame rate
+    candidates = [
+        s for s in manifest["streams"]
+        if s["only_video"] and s["resolution"] == resolution
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda s: (s["subtype"] == 'mp4', s["fps"] or 0))
+
+
+def adaptive_resolutions(manifest):
+    audio = select_audio(manifest, subtype='mp4')
+    resolutions = {s["resolution"] for s in manifest["streams"] if s["only_video"] and s["resolution"]}
+    entries = []
+    for resolution in sorted(resolutions, key=_resolution_value, reverse=True):
+        video = select_adaptive(manifest, resolution)
+        if video["filesize"] and audio and audio["filesize"]:
+            size = video["filesize"] + audio["filesize"]
+        else:
+            size = None
+        entries.append((video, audio, size))
+    return entries
+
+
+class ManifestCache:
+    def __init__(self, max_entries=256, default_ttl=3600):
+        self.default_ttl = default_ttl
+        self._cache = TTLCache(max_entries=max_entries, default_ttl=default_ttl)
+        self._lock = threading.Lock()
+        self.resolutions = 0
+        self.resolve_seconds = 0.0
+
+    def get(self, video_id):
+        return self._cache.get(video_id)
+
+    def put(self, video_id, manifest):
+        self._cache.put(video_id, manifest, ttl=manifest_ttl(manifest, self.default_ttl))
+
+    def invalidate(self, video_id):
+        self._cache.pop(video_id)
+
+    def __contains__(self, video_id):
+        return video_id in self._cache
+
+    def record_resolution(self, elapsed):
+        with self._lock:
+            self.resolutions += 1
+            self.resolve_seconds += elapsed
+
+    def stats(self):
+        stats = self._cache.stats()
+        with self._lock:
+            avg = self.resolve_seconds / self.resolutions if self.resolutions else 0.0
+            stats.update({
+                "upstream_resolutions": self.resolutions,
+                "avg_resolve_seconds": round(avg, 3),
+                "estimated_seconds_saved": round(avg * stats["hits"], 3),
+            })
+        return stats
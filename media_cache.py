@@ -0,0 +1,336 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Fill:
+    def __init__(self, key, part_path, final_path):
+        self.key = key
+        self.part_path = part_path
+        self.final_path = final_path
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def advance(self, size):
+        with self.condition:
+            self.written += size
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.error = error
+            self.done = True
+            self.condition.notify_all()
+
+
+class _Reader:
+    # Iterator over an entry's bytes that tells the cache when its consumer goes away,
+    # including when it is closed before the first read
+
+    def __init__(self, chunks, on_close):
+        self.chunks = chunks
+        self.on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        on_close, self.on_close = self.on_close, None
+        if on_close is None:
+            return
+        try:
+            self.chunks.close()
+        finally:
+            on_close()
+
+    def __del__(self):
+        self.close()
+
+
+class MediaCache:
+    # Files are named after a hash of their key, e.g. "<video_id>:<itag>", so every
+    # worker process sharing the directory agrees on where an entry lives. A fill
+    # writes to "<hash>.part" (created with O_EXCL, which doubles as a cross-process
+    # lock) and is renamed into place once complete. Readers tail the .part file while
+    # it grows, so concurrent requests for the same key cost a single upstream fetch.
+    # A fill stops, and its .part file is removed, once every reader in this process
+    # has gone away; readers tailing it from another process then fail like on an
+    # upstream error.
+
+    def __init__(self, root, max_bytes, max_entry_bytes=None, stale_seconds=120, poll_interval=0.05,
+                 chunk_size=65536):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 4 if max_entry_bytes is None else max_entry_bytes
+        self.stale_seconds = stale_seconds
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._fills = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.fills_completed = 0
+        self.fills_failed = 0
+        self.fills_cancelled = 0
+        self.skipped = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def admits(self, size):
+        # Entries of unknown size, larger than `max_entry_bytes` or than the free disk
+        # space are streamed without being staged: a fill that runs out of space fails
+        # the response partway through
+        if not self.enabled:
+            return False
+        if size and size <= self.max_entry_bytes:
+            try:
+                if size < shutil.disk_usage(self.root).free:
+                    return True
+            except OSError:
+                pass
+        with self._lock:
+            self.skipped += 1
+        return False
+
+    def _paths(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        final_path = os.path.join(self.root, digest)
+        return final_path, final_path + '.part'
+
+    def get(self, key):
+        final_path, _ = self._paths(key)
+        try:
+            os.utime(final_path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self.hits += 1
+        return final_path
+
+    def stream(self, key, producer):
+        # Returns an iterator over the entry's bytes: served from a fill started here,
+        # joined from a fill already running in this or another process, or started fresh.
+        final_path, part_path = self._paths(key)
+        with self._lock:
+            fill = self._fills.get(key)
+            if fill is not None:
+                self.coalesced += 1
+                fill.readers += 1
+                return self._tail(part_path, final_path, fill)
+            if os.path.exists(final_path):
+                self.hits += 1
+                return self._tail(part_path, final_path, None)
+            self.misses += 1
+            fd = self._claim(part_path)
+            if fd is None:
+                self.coalesced += 1
+                return self._tail(part_path, final_path, None)
+            fill = _Fill(key, part_path, final_path)
+            fill.readers = 1
+            self._fills[key] = fill
+        # The producer is called here so that errors opening the upstream surface in
+        # the request thread, before any response headers are sent.
+        try:
+            chunks = producer()
+        except Exception as e:
+            os.close(fd)
+            self._abort(fill, e)
+            raise
+        threading.Thread(target=self._run_fill, args=(fill, fd, chunks), daemon=True).start()
+        return self._tail(part_path, final_path, fill)
+
+    def _claim(self, part_path):
+        for _ in range(2):
+            try:
+                return os.open(part_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                try:
+                    age = time.time() - os.path.getmtime(part_path)
+                except FileNotFoundError:
+                    continue
+                if age < self.stale_seconds:
+                    return None
+                logger.warning(f"Taking over stale cache fill {part_path}")
+                try:
+                    os.unlink(part_path)
+                except FileNotFoundError:
+                    pass
+        return None
+
+    def _abort(self, fill, error):
+        logger.error(f"Media cache fill failed for {fill.key}: {error}")
+        try:
+            os.unlink(fill.part_path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._fills.pop(fill.key, None)
+            self.fills_failed += 1
+        fill.finish(error)
+
+    def _leave(self, fill):
+        with self._lock:
+            fill.readers -= 1
+            if fill.readers or fill.done or self._fills.get(fill.key) is not fill:
+                return
+            # The last reader is gone: nobody is waiting for the rest of this entry.
+            # The key and the .part name are released now, so a new request starts a
+            # fresh fill instead of joining one that is being torn down.
+            fill.cancelled = True
+            self._fills.pop(fill.key, None)
+            self.fills_cancelled += 1
+            try:
+                os.unlink(fill.part_path)
+            except FileNotFoundError:
+                pass
+        logger.info(f"Media cache fill cancelled for {fill.key}: no readers left")
+
+    def _run_fill(self, fill, fd, chunks):
+        try:
+            with os.fdopen(fd, 'wb', buffering=0) as f:
+                for chunk in chunks:
+                    if fill.cancelled:
+                        break
+                    f.write(chunk)
+                    fill.advance(len(chunk))
+            with self._lock:
+                if not fill.cancelled:
+                    os.replace(fill.part_path, fill.final_path)
+                    self._fills.pop(fill.key, None)
+                    self.fills_completed += 1
+        except Exception as e:
+            if not fill.cancelled:
+                self._abort(fill, e)
+                return
+        if fill.cancelled:
+            # Closing the producer closes the upstream connection or stops ffmpeg
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+            fill.finish(IOError("Media cache fill cancelled"))
+            return
+        fill.finish()
+        self.evict()
+
+    def _finished(self, part_path, final_path, fill):
+        if fill is not None:
+            if fill.error:
+                raise IOError(f"Media cache fill failed: {fill.error}")
+            return fill.done
+        if os.path.exists(final_path):
+            return True
+        try:
+            age = time.time() - os.path.getmtime(part_path)
+        except FileNotFoundError:
+            if os.path.exists(final_path):
+                return True
+            raise IOError("Media cache fill aborted by its owner")
+        if age > self.stale_seconds:
+            raise IOError("Media cache fill stalled")
+        return False
+
+    def _open_for_tail(self, part_path, final_path):
+        for path in (part_path, final_path):
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                continue
+        raise IOError("Media cache entry disappeared")
+
+    def _tail(self, part_path, final_path, fill):
+        # The file is opened now rather than on first read, so an entry evicted before
+        # the caller starts reading stays readable. The descriptor also stays valid
+        # after the rename, so a reader that opened the .part file keeps reading the
+        # same inode until the end.
+        try:
+            f = self._open_for_tail(part_path, final_path)
+        except Exception:
+            if fill is not None:
+                self._leave(fill)
+            raise
+        chunks = self._read_tail(f, part_path, final_path, fill)
+        if fill is None:
+            return chunks
+        return _Reader(chunks, lambda: self._leave(fill))
+
+    def _read_tail(self, f, part_path, final_path, fill):
+        with f:
+            while True:
+                data = f.read(self.chunk_size)
+                if data:
+                    yield data
+                    continue
+                if self._finished(part_path, final_path, fill):
+                    data = f.read()
+                    if not data:
+                        return
+                    for offset in range(0, len(data), self.chunk_size):
+                        yield data[offset:offset + self.chunk_size]
+                    return
+                if fill is not None:
+                    with fill.condition:
+                        if not fill.done and fill.written <= f.tell():
+                            fill.condition.wait(self.poll_interval * 10)
+                else:
+                    time.sleep(self.poll_interval)
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.part') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            return {
+                "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "fills_in_progress": len(self._fills),
+                "fills_completed": self.fills_completed,
+                "fills_failed": self.fills_failed,
+                "fills_cancelled": self.fills_cancelled,
+                "skipped": self.skipped,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,251 @@
+import bisect
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+THROUGHPUT_BUCKETS = tuple(kib * 1024 for kib in (64, 256, 1024, 4096, 16384, 65536))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative = {}
+        running = 0
+        for bound, n in zip(self.buckets, counts):
+            running += n
+            cumulative[str(bound)] = running
+        cumulative["+Inf"] = count
+        return {"count": count, "sum": round(total, 6), "buckets": cumulative}
+
+
+class Counter:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Gauge(Counter):
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+
+class _Family:
+    def __init__(self, name, kind, help_text, labelnames, factory):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            yield dict(zip(self.labelnames, values)), child
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels.items()) + list((extra or {}).items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in items) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def render_histogram(name, labels, snapshot):
+    lines = []
+    for bound, count in snapshot["buckets"].items():
+        lines.append(f"{name}_bucket{_format_labels(labels, {'le': bound})} {count}")
+    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(float(snapshot['sum']))}")
+    lines.append(f"{name}_count{_format_labels(labels)} {snapshot['count']}")
+    return lines
+
+
+class Registry:
+    # Prometheus text exposition (version 0.0.4) without the client library. Hot paths
+    # only touch a counter or histogram under a short lock; everything derived from the
+    # existing /stats objects is computed by collectors at scrape time.
+
+    def __init__(self):
+        self._families = []
+        self._collectors = []
+
+    def _register(self, family):
+        self._families.append(family)
+        return family
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(_Family(name, 'counter', help_text, labelnames, Counter))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(_Family(name, 'gauge', help_text, labelnames, Gauge))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(_Family(name, 'histogram', help_text, labelnames, lambda: Histogram(buckets)))
+
+    def collector(self, func):
+        # func() yields (name, kind, help, [(labels, value)]); histogram values are
+        # Histogram.snapshot() dicts.
+        self._collectors.append(func)
+        return func
+
+    def render(self):
+        lines = []
+
+        def emit(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if kind == 'histogram':
+                    lines.extend(render_histogram(name, labels, value))
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for family in self._families:
+            samples = [
+                (labels, child.snapshot() if family.kind == 'histogram' else child.value)
+                for labels, child in family.samples()
+            ]
+            emit(family.name, family.kind, family.help, samples)
+        for collect in self._collectors:
+            for name, kind, help_text, samples in collect():
+                emit(name, kind, help_text, samples)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'ytdl_stage_duration_seconds',
+    "Latency of each download pipeline stage",
+    ('stage',)
+)
+relayed_bytes = registry.counter(
+    'ytdl_relayed_bytes_total',
+    "Bytes sent to clients from upstream, transcoder or cache fills",
+    ('kind',)
+)
+download_throughput = registry.histogram(
+    'ytdl_download_throughput_bytes_per_second',
+    "Average throughput of each completed download response",
+    ('kind',),
+    buckets=THROUGHPUT_BUCKETS
+)
+active_streams = registry.gauge(
+    'ytdl_active_streams',
+    "Download responses currently streaming",
+    ('kind',)
+)
+resolve_retries = registry.counter(
+    'ytdl_resolve_retries_total',
+    "Resolution attempts made after an earlier attempt failed, by the client type retried",
+    ('client_type',)
+)
+admission_wait_seconds = registry.histogram(
+    'ytdl_admission_wait_seconds',
+    "Time /download requests waited for a slot, by outcome",
+    ('result',)
+)
+
+
+class StreamTimer:
+    # Per-response bookkeeping. Byte counts stay local until the stream ends, so the
+    # per-chunk cost is an addition and a comparison.
+
+    def __init__(self, kind, started=None):
+        self.kind = kind
+        self.started = started if started is not None else time.monotonic()
+        self.bytes = 0
+        self._first = False
+        active_streams.labels(kind).inc()
+
+    def chunk(self, size):
+        if not self._first:
+            self._first = True
+            stage_seconds.labels('ttfb').observe(time.monotonic() - self.started)
+        self.bytes += size
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        active_streams.labels(self.kind).dec()
+        stage_seconds.labels('transfer').observe(elapsed)
+        relayed_bytes.labels(self.kind).inc(self.bytes)
+        if self.bytes and elapsed > 0:
+            download_throughput.labels(self.kind).observe(self.bytes / elapsed)
+
+
+def observe_stream(chunks, kind, started=None):
+    timer = StreamTimer(kind, started)
+    try:
+        for chunk in chunks:
+            timer.chunk(len(chunk))
+            yield chunk
+    finally:
+        timer.finish()
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+
+def directory_bytes(path):
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_bytes(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            continue
+    return total
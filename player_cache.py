@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+PLAYER_ID_RE = re.compile(r'/s/player/([\w-]+)/')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    js_url TEXT PRIMARY KEY,
+    player_id TEXT,
+    js BLOB NOT NULL,
+    signature_timestamp TEXT,
+    transforms TEXT,
+    fetched_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+"""
+
+
+def player_id(js_url):
+    match = PLAYER_ID_RE.search(js_url or '')
+    return match.group(1) if match else None
+
+
+class PlayerCache:
+    # Player JavaScript and what pytubefix derives from it (signature timestamp,
+    # signature and n-parameter function names and control parameters), keyed by the
+    # player URL, which changes with every player version. The SQLite file is shared
+    # by all workers on the host, so only the first process to see a new version
+    # downloads and parses it; others load it from disk. Old versions are dropped
+    # once more than `versions` have been seen.
+
+    def __init__(self, db_path, versions=4):
+        self.db_path = db_path
+        self.versions = versions
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._ciphers = OrderedDict()
+        self._installed = False
+        self._counts = dict.fromkeys(('memory_hits', 'disk_hits', 'fetches', 'parses', 'transform_hits', 'invalidations'), 0)
+        self._seconds = dict.fromkeys(('fetch', 'disk', 'parse', 'cipher_from_cache'), 0.0)
+        self._ready = False
+
+    def _db(self):
+        # The database is created on first use, not at import: a cold instance that
+        # never resolves a video does not touch the disk
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            if not self._ready:
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if not self._ready:
+                conn.executescript(SCHEMA)
+                self._ready = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, key, seconds_key=None, started=None):
+        with self._lock:
+            self._counts[key] += 1
+            if seconds_key:
+                self._seconds[seconds_key] += time.monotonic() - started
+
+    def _remember(self, js_url, entry):
+        with self._lock:
+            self._memory[js_url] = entry
+            self._memory.move_to_end(js_url)
+            while len(self._memory) > self.versions:
+                self._memory.popitem(last=False)
+
+    def entry(self, js_url, fetch):
+        # {"js", "signature_timestamp"} for js_url: from memory, then disk, then fetch()
+        with self._lock:
+            entry = self._memory.get(js_url)
+        if entry is not None:
+            self._count('memory_hits')
+            return entry
+        started = time.monotonic()
+        row = self._db().execute(
+            "SELECT js, signature_timestamp FROM players WHERE js_url = ?", (js_url,)
+        ).fetchone()
+        if row is not None:
+            entry = {"js": zlib.decompress(row["js"]).decode('utf-8'), "signature_timestamp": row["signature_timestamp"]}
+            self._db().execute("UPDATE players SET used_at = ? WHERE js_url = ?", (time.time(), js_url))
+            self._count('disk_hits', 'disk', started)
+        else:
+            from pytubefix import extract
+            js = fetch()
+            entry = {"js": js, "signature_timestamp": extract.signature_timestamp(js)}
+            self._store(js_url, entry)
+            self._count('fetches', 'fetch', started)
+        self._remember(js_url, entry)
+        return entry
+
+    def _store(self, js_url, entry):
+        now = time.time()
+        db = self._db()
+        db.execute(
+            "INSERT INTO players (js_url, player_id, js, signature_timestamp, fetched_at, used_at) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(js_url) DO UPDATE SET js = excluded.js, signature_timestamp = excluded.signature_timestamp,"
+            " used_at = excluded.used_at",
+            (js_url, player_id(js_url), zlib.compress(entry["js"].encode('utf-8'), 6), entry["signature_timestamp"], now, now)
+        )
+        db.execute(
+            "DELETE FROM players WHERE js_url NOT IN (SELECT js_url FROM players ORDER BY used_at DESC LIMIT ?)",
+            (self.versions,)
+        )
+        logger.info("Cached player %s", player_id(js_url) or js_url)
+
+    def _load_transforms(self, js_url):
+        row = self._db().execute("SELECT transforms FROM players WHERE js_url = ?", (js_url,)).fetchone()
+        return json.loads(row["transforms"]) if row is not None and row["transforms"] else None
+
+    def save_transforms(self, cipher):
+        self._db().execute(
+            "UPDATE players SET transforms = ? WHERE js_url = ?", (json.dumps(cipher.transforms()), cipher.js_url)
+        )
+
+    def cipher(self, js, js_url):
+        # Drop-in for pytubefix's Cipher(js=..., js_url=...), see install()
+        with self._lock:
+            cipher = self._ciphers.get(js_url)
+            if cipher is not None:
+                self._ciphers.move_to_end(js_url)
+                return cipher
+        from player_cipher import SharedCipher
+        started = time.monotonic()
+        transforms = self._load_transforms(js_url)
+        cipher = SharedCipher(js, js_url, transforms, on_change=self.save_transforms,
+                              on_error=lambda failed: self.invalidate(failed.js_url))
+        if transforms is not None:
+            self._count('transform_hits', 'cipher_from_cache', started)
+        else:
+            self._count('parses', 'parse', started)
+            self.save_transforms(cipher)
+        with self._lock:
+            existing = self._ciphers.get(js_url)
+            if existing is not None:
+                cipher.shutdown()
+                return existing
+            self._ciphers[js_url] = cipher
+            evicted = []
+            while len(self._ciphers) > self.versions:
+                evicted.append(self._ciphers.popitem(last=False)[1])
+        for old in evicted:
+            old.shutdown()
+        return cipher
+
+    def invalidate(self, js_url):
+        # Called when deciphering fails: forget the derived transforms so the next
+        # resolution parses the player again. The script itself is immutable per URL.
+        # The failed cipher's runners are left to the garbage collector, since the
+        # failing call may still be using them.
+        with self._lock:
+            self._ciphers.pop(js_url, None)
+            self._counts['invalidations'] += 1
+        self._db().execute("UPDATE players SET transforms = NULL WHERE js_url = ?", (js_url,))
+
+    def install(self):
+        # pytubefix builds a Cipher per video inside extract.apply_signature; route
+        # that through the shared ciphers. Done on the first resolution rather than at
+        # start-up, so that processes which never resolve a video skip pytubefix.
+        if self._installed:
+            return
+        from pytubefix import extract
+        from player_cipher import SHARED_CIPHER_SUPPORTED
+        if SHARED_CIPHER_SUPPORTED:
+            extract.Cipher = self.cipher
+        else:
+            logger.warning("Unsupported pytubefix Cipher internals, signatures are deciphered without the shared cipher")
+        self._installed = True
+
+    def youtube(self, url, client):
+        from player_cipher import CACHED_PLAYER_SUPPORTED, CachedPlayerYouTube
+        self.install()
+        if not CACHED_PLAYER_SUPPORTED:
+            from pytubefix import YouTube
+            return YouTube(url, client)
+        return CachedPlayerYouTube(url, client, player_cache=self)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+            seconds = {key: round(value, 3) for key, value in self._seconds.items()}
+            ciphers = list(self._ciphers)
+        if self._ready or os.path.exists(self.db_path):
+            row = self._db().execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(js)), 0) FROM players").fetchone()
+        else:
+            row = (0, 0)
+        return {
+            "versions_on_disk": row[0],
+            "bytes_on_disk": row[1],
+            "loaded_players": [player_id(js_url) for js_url in ciphers],
+            **counts,
+            "seconds": seconds,
+        }
+
+
+def player_cache_from_env():
+    return PlayerCache(
+        os.environ.get('PLAYER_CACHE_DB', os.path.join(tempfile.gettempdir(), 'youtube-player-cache.sqlite3')),
+        versions=int(os.environ.get('PLAYER_CACHE_VERSIONS', 4)),
+    )
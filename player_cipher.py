@@ -0,0 +1,157 @@
+import threading
+
+import pytubefix
+from pytubefix import YouTube, request as pytubefix_request
+from pytubefix.cipher import Cipher
+from pytubefix.exceptions import InterpretationError
+from pytubefix.jsinterp import JSInterpreter
+from pytubefix.sig_nsig.node_runner import NodeRunner
+
+# pytubefix subclasses behind player_cache.PlayerCache. Kept apart so that importing
+# player_cache (and the app) does not load pytubefix; this module is imported on the
+# first video resolution.
+
+# Both subclasses reach into pytubefix internals: SharedCipher mirrors Cipher.__init__
+# and its control parameters, CachedPlayerYouTube fills the attributes behind the js
+# and signature_timestamp properties. These match pytubefix 10.3.5 through 11.x; when
+# a release changes them, the stock classes are used instead, so a mismatch costs the
+# caching rather than breaking signature deciphering.
+_CIPHER_INIT_NAMES = frozenset({
+    'js_url', 'js', '_sig_param_val', '_nsig_param_val', 'get_sig_function_name', 'sig_function_name',
+    'get_nsig_function_name', 'nsig_function_name', 'NodeRunner', 'runner_sig', 'load_function',
+    'runner_nsig', 'calculated_n', 'JSInterpreter', 'js_interpreter',
+})
+
+
+def _code_names(func):
+    code = getattr(func, '__code__', None)
+    return frozenset(code.co_names) if code else frozenset()
+
+
+SHARED_CIPHER_SUPPORTED = (
+    _code_names(Cipher.__init__) == _CIPHER_INIT_NAMES
+    and '_sig_param_val' in _code_names(getattr(Cipher, 'get_sig', None))
+    and '_nsig_param_val' in _code_names(getattr(Cipher, 'get_nsig', None))
+    and callable(getattr(NodeRunner, 'close', None))
+)
+
+CACHED_PLAYER_SUPPORTED = (
+    {'_js', '_signature_timestamp'} <= _code_names(YouTube.__init__)
+    and isinstance(getattr(YouTube, 'js', None), property)
+    and isinstance(getattr(YouTube, 'signature_timestamp', None), property)
+)
+
+
+class _PersistentRunner(NodeRunner):
+    # pytubefix closes both node runners at the end of every apply_signature call.
+    # A shared cipher keeps its runners for the lifetime of the player version
+    # instead, and shuts them down itself when the version is evicted.
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        NodeRunner.close(self)
+
+
+class SharedCipher(Cipher):
+    # Cipher for one player version, reused by every resolution in the process. It
+    # mirrors Cipher.__init__, except that the function names and control parameters
+    # come from `transforms` when the version was parsed before (by any process), and
+    # calls are serialized because each node runner is a single pipe.
+
+    def __init__(self, js, js_url, transforms=None, on_change=None, on_error=None):
+        self.js_url = js_url
+        self.js = js
+        self._sig_param_val = None
+        self._nsig_param_val = None
+        self.from_cache = transforms is not None
+        if transforms is not None:
+            self.sig_function_name = transforms["sig_function"]
+            self._sig_param_val = transforms["sig_param"]
+            self.nsig_function_name = transforms["nsig_function"]
+            self._nsig_param_val = transforms["nsig_param"]
+        else:
+            self.sig_function_name = self.get_sig_function_name(js, js_url)
+            self.nsig_function_name = self.get_nsig_function_name(js, js_url)
+        self.runner_sig = _PersistentRunner(js)
+        self.runner_sig.load_function(self.sig_function_name)
+        self.runner_nsig = _PersistentRunner(js)
+        self.runner_nsig.load_function(self.nsig_function_name)
+        self.calculated_n = None
+        self.js_interpreter = JSInterpreter(js)
+        self.on_change = on_change
+        self.on_error = on_error
+        self._lock = threading.Lock()
+
+    def transforms(self):
+        return {
+            "sig_function": self.sig_function_name,
+            "sig_param": self._sig_param_val,
+            "nsig_function": self.nsig_function_name,
+            "nsig_param": self._nsig_param_val,
+        }
+
+    def _failed(self):
+        if self.on_error:
+            self.on_error(self)
+
+    def get_sig(self, ciphered_signature):
+        with self._lock:
+            try:
+                return super().get_sig(ciphered_signature)
+            except InterpretationError:
+                self._failed()
+                raise
+
+    def get_nsig(self, n):
+        # get_nsig may discover working control parameters by probing; those are
+        # written back so other processes skip the probing.
+        with self._lock:
+            before = self._nsig_param_val
+            try:
+                return super().get_nsig(n)
+            except InterpretationError:
+                self._failed()
+                raise
+            finally:
+                if self._nsig_param_val != before and self.on_change:
+                    self.on_change(self)
+
+    def shutdown(self):
+        self.runner_sig.shutdown()
+        self.runner_nsig.shutdown()
+
+
+class CachedPlayerYouTube(YouTube):
+    # YouTube whose player script and signature timestamp come from a PlayerCache
+    # rather than a download and a regex scan per process.
+
+    def __init__(self, *args, player_cache, **kwargs):
+        self.player_cache = player_cache
+        super().__init__(*args, **kwargs)
+
+    def _player_entry(self):
+        js_url = self.js_url
+        return self.player_cache.entry(js_url, lambda: pytubefix_request.get(js_url))
+
+    @property
+    def js(self):
+        if self._js:
+            return self._js
+        self._js = self._player_entry()["js"]
+        pytubefix.__js__ = self._js
+        pytubefix.__js_url__ = self.js_url
+        return self._js
+
+    @property
+    def signature_timestamp(self):
+        if not self._signature_timestamp:
+            self._signature_timestamp = {
+                'playbackContext': {
+                    'contentPlaybackContext': {
+                        'signatureTimestamp': self._player_entry()["signature_timestamp"]
+                    }
+                }
+            }
+        return self._signature_timestamp
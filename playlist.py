@@ -0,0 +1,170 @@
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from manifest import extract_video_id
+from ratelimit import TokenBucket
+
+CHANNEL_RE = re.compile(r'youtube\.com/(?:@|channel/|c/|user/)')
+
+playlist_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('PLAYLIST_WORKERS', 8)),
+    thread_name_prefix='playlist'
+)
+
+# Shared by every archive being built in this process. 0 disables the cap.
+PLAYLIST_BANDWIDTH = float(os.environ.get('PLAYLIST_BANDWIDTH', 0))
+bandwidth = TokenBucket('playlist_bandwidth', rate=PLAYLIST_BANDWIDTH, burst=PLAYLIST_BANDWIDTH) if PLAYLIST_BANDWIDTH > 0 else None
+
+# Bytes of each upcoming member read ahead in memory when it does not go through the
+# media cache. 0 disables it.
+PLAYLIST_READ_AHEAD_BYTES = int(os.environ.get('PLAYLIST_READ_AHEAD_BYTES', 16 * 1024 * 1024))
+
+
+def is_channel_url(url):
+    return bool(CHANNEL_RE.search(url or ''))
+
+
+def playlist_source(url):
+    # pytubefix is imported on first use so that start-up does not pay for it
+    from pytubefix import Channel, Playlist
+    return Channel(url) if is_channel_url(url) else Playlist(url)
+
+
+def source_title(source):
+    from pytubefix import Channel
+    return source.channel_name if isinstance(source, Channel) else source.title
+
+
+def iter_playlist_entries(source, limit=None):
+    # url_generator() pages through the listing one continuation at a time, so
+    # entries are yielded before the whole playlist has been fetched.
+    urls = source.url_generator()
+    for index, video_url in enumerate(islice(urls, limit) if limit else urls, start=1):
+        yield {"index": index, "video_url": video_url, "video_id": extract_video_id(video_url)}
+
+
+def throttled(chunks, bucket=None):
+    bucket = bucket or bandwidth
+    if bucket is None:
+        yield from chunks
+        return
+    for chunk in chunks:
+        bucket.acquire(len(chunk))
+        yield chunk
+
+
+class ReadAhead:
+    # Reads a member's body on its own thread into a buffer of up to `max_bytes`, so
+    # the members waiting their turn in the archive keep transferring while an earlier
+    # one is written. Past `max_bytes` the reader blocks, which pauses the upstream.
+
+    def __init__(self, chunks, max_bytes):
+        self.chunks = chunks
+        self.max_bytes = max_bytes
+        self.buffer = deque()
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        threading.Thread(target=self._produce, name='playlist-read-ahead', daemon=True).start()
+
+    def _produce(self):
+        try:
+            for chunk in self.chunks:
+                with self.condition:
+                    while self.size >= self.max_bytes and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        break
+                    self.buffer.append(chunk)
+                    self.size += len(chunk)
+                    self.condition.notify_all()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+            close = getattr(self.chunks, 'close', None)
+            if close:
+                close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.condition:
+            while not self.buffer and not self.done:
+                self.condition.wait()
+            if self.buffer:
+                chunk = self.buffer.popleft()
+                self.size -= len(chunk)
+                self.condition.notify_all()
+                return chunk
+            if self.error:
+                raise self.error
+            raise StopIteration
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.buffer.clear()
+            self.size = 0
+            self.condition.notify_all()
+
+
+def read_ahead(chunks):
+    return ReadAhead(chunks, PLAYLIST_READ_AHEAD_BYTES) if PLAYLIST_READ_AHEAD_BYTES > 0 else chunks
+
+
+def iter_pipelined(items, start, window, discard=None):
+    # Runs start(item) on the playlist pool with up to `window` items in flight and
+    # yields (item, result, error) in input order. While the caller consumes one
+    # result, the following items are already being prepared. Results that are never
+    # yielded, because the caller stopped early, are passed to `discard`.
+    items = iter(items)
+    pending = deque()
+    try:
+        for item in islice(items, window):
+            pending.append((item, playlist_executor.submit(start, item)))
+        while pending:
+            item, future = pending.popleft()
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = None, e
+            yield item, result, error
+            for item in islice(items, 1):
+                pending.append((item, playlist_executor.submit(start, item)))
+    finally:
+        for _, future in pending:
+            if not future.cancel() and discard:
+                future.add_done_callback(lambda done: done.exception() is None and discard(done.result()))
+
+
+def archive_name(index, filename, used):
+    name = f"{index:03d} - {filename}"
+    stem, dot, extension = name.rpartition('.')
+    suffix = 2
+    while name in used:
+        name = f"{stem} ({suffix}){dot}{extension}"
+        suffix += 1
+    used.add(name)
+    return name
+
+
+def bandwidth_stats():
+    if bandwidth is None:
+        return {"bytes_per_second": None}
+    stats = bandwidth.stats()
+    return {
+        "bytes_per_second": PLAYLIST_BANDWIDTH,
+        "waits": stats["waits"],
+        "wait_seconds_total": stats["wait_seconds_total"],
+    }
@@ -0,0 +1,153 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from cache import TTLCache
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+OUTCOMES = (
+    'submitted', 'cached', 'over_budget', 'queue_full', 'limiter_busy',
+    'resolved', 'failed', 'joined', 'preempted', 'used',
+)
+
+
+class Prefetcher:
+    # Resolves manifests for videos the user is likely to pick next (the top search
+    # results) on a small pool of its own, so a later /download finds the manifest
+    # cached. Prefetching is strictly best effort and never waits for a budget:
+    # each video costs a token from `budget`, and a queued video is skipped when the
+    # foreground `limiter` has fewer than `headroom` spare tokens, is backing off or
+    # is still recovering from a 429.
+    #
+    # `resolve(video_id)` returns the manifest and stores it in the cache;
+    # `is_cached(video_id)` checks the cache without counting a lookup.
+
+    def __init__(self, resolve, is_cached, top_k=3, workers=1, max_pending=32,
+                 budget=None, limiter=None, headroom=2, used_ttl=3600):
+        self.resolve = resolve
+        self.is_cached = is_cached
+        self.top_k = top_k
+        self.max_pending = max_pending
+        self.budget = budget
+        self.limiter = limiter
+        self.headroom = headroom
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='prefetch')
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Videos prefetched and not yet requested, to measure how many were used
+        self._unused = TTLCache(max_entries=4096, default_ttl=used_ttl)
+        self._counts = dict.fromkeys(OUTCOMES, 0)
+
+    @property
+    def enabled(self):
+        return self.top_k > 0
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def submit(self, video_ids):
+        # Queues the first top_k of `video_ids`, in order. Returns the number queued.
+        if not self.enabled:
+            return 0
+        queued = 0
+        seen = set()
+        for video_id in video_ids:
+            if len(seen) >= self.top_k:
+                break
+            if not video_id or video_id in seen:
+                continue
+            seen.add(video_id)
+            if self.is_cached(video_id):
+                self._count('cached')
+                continue
+            with self._lock:
+                if video_id in self._pending:
+                    continue
+                if len(self._pending) >= self.max_pending:
+                    self._counts['queue_full'] += 1
+                    continue
+            if self.budget is not None and not self.budget.try_acquire():
+                self._count('over_budget')
+                break
+            with self._lock:
+                self._counts['submitted'] += 1
+                self._pending[video_id] = self._executor.submit(self._run, video_id)
+            queued += 1
+        return queued
+
+    def _run(self, video_id):
+        try:
+            if self.is_cached(video_id):
+                self._count('cached')
+                return None
+            if self.limiter is not None and self.limiter.spare() < self.headroom:
+                self._count('limiter_busy')
+                return None
+            try:
+                manifest = self.resolve(video_id)
+            except Exception as e:
+                logger.info("Prefetch of %s failed: %s", video_id, e)
+                self._count('failed')
+                return None
+            self._count('resolved')
+            self._unused.put(video_id, True)
+            return manifest
+        finally:
+            with self._lock:
+                self._pending.pop(video_id, None)
+
+    def join(self, video_id, timeout=None):
+        # For a foreground request about to resolve `video_id` itself: a queued
+        # prefetch is cancelled, a running one is waited for so the video is not
+        # resolved twice. Returns the prefetched manifest, or None.
+        with self._lock:
+            future = self._pending.get(video_id)
+            if future is None:
+                return None
+            if future.cancel():
+                self._pending.pop(video_id, None)
+                self._counts['preempted'] += 1
+                return None
+            self._counts['joined'] += 1
+        try:
+            manifest = future.result(timeout=timeout)
+        except FutureTimeout:
+            return None
+        if manifest is not None:
+            self.used(video_id)
+        return manifest
+
+    def used(self, video_id):
+        # Called on a manifest cache hit: counts it if the manifest was prefetched
+        if self.enabled and self._unused.pop(video_id):
+            self._count('used')
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+            pending = len(self._pending)
+        return {
+            "enabled": self.enabled,
+            "top_k": self.top_k,
+            "pending": pending,
+            "budget": self.budget.stats() if self.budget is not None else None,
+            **counts,
+        }
+
+
+def prefetcher_from_env(resolve, is_cached, limiter=None):
+    rate = float(os.environ.get('PREFETCH_RATE', 0.5))
+    return Prefetcher(
+        resolve,
+        is_cached,
+        top_k=int(os.environ.get('PREFETCH_TOP_K', 0)),
+        workers=int(os.environ.get('PREFETCH_WORKERS', 1)),
+        max_pending=int(os.environ.get('PREFETCH_MAX_PENDING', 32)),
+        budget=TokenBucket('prefetch', rate=rate, burst=float(os.environ.get('PREFETCH_BURST', 5))) if rate > 0 else None,
+        limiter=limiter,
+        headroom=float(os.environ.get('PREFETCH_HEADROOM', 2)),
+    )
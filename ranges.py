@@ -0,0 +1,109 @@
+from email.utils import formatdate, parsedate_to_datetime
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class MultipleRangesNotSupported(Exception):
+    pass
+
+
+def parse_range_header(header, size=None):
+    # Returns (start, end) with an inclusive end, or None when the header is absent or
+    # syntactically invalid (RFC 9110 says such headers are ignored). With an unknown
+    # size, open-ended and suffix ranges are kept as-is: start=None means "last `end`
+    # bytes" and end=None means "until the end".
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    spec = spec.strip()
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    if ',' in spec:
+        raise MultipleRangesNotSupported(spec)
+    start_str, sep, end_str = spec.partition('-')
+    if not sep:
+        return None
+    try:
+        start = int(start_str) if start_str.strip() else None
+        end = int(end_str) if end_str.strip() else None
+    except ValueError:
+        return None
+    if start is None and end is None:
+        return None
+    if (start is not None and start < 0) or (end is not None and end < 0):
+        return None
+    if start is not None and end is not None and end < start:
+        return None
+
+    if start is None:
+        if end == 0:
+            raise RangeNotSatisfiable(spec)
+        if size is None:
+            return (None, end)
+        return (max(0, size - end), size - 1)
+
+    if size is not None:
+        if start >= size:
+            raise RangeNotSatisfiable(spec)
+        end = size - 1 if end is None else min(end, size - 1)
+    return (start, end)
+
+
+def format_range_header(byte_range):
+    start, end = byte_range
+    if start is None:
+        return f"bytes=-{end}"
+    return f"bytes={start}-{'' if end is None else end}"
+
+
+def content_range(byte_range, size):
+    start, end = byte_range
+    return f"bytes {start}-{end}/{size if size is not None else '*'}"
+
+
+def apply_range_headers(headers, byte_range, size, upstream_status, upstream_headers=None):
+    # Fills Content-Range/Content-Length for a proxied response and returns its status.
+    # A known size wins over upstream values so the client always sees a consistent total.
+    upstream_headers = upstream_headers or {}
+    if byte_range and upstream_status == 206:
+        if byte_range[0] is not None and byte_range[1] is not None and size:
+            headers['Content-Range'] = content_range(byte_range, size)
+            headers['Content-Length'] = str(byte_range[1] - byte_range[0] + 1)
+        elif upstream_headers.get('Content-Range'):
+            headers['Content-Range'] = upstream_headers['Content-Range']
+            if upstream_headers.get('Content-Length'):
+                headers['Content-Length'] = upstream_headers['Content-Length']
+        return 206
+    if size:
+        headers['Content-Length'] = str(size)
+    elif upstream_headers.get('Content-Length'):
+        headers['Content-Length'] = upstream_headers['Content-Length']
+    return 200
+
+
+def http_date(last_modified_us):
+    if not last_modified_us:
+        return None
+    return formatdate(int(last_modified_us) / 1_000_000, usegmt=True)
+
+
+def stream_etag(video_id, stream):
+    return f'"{video_id}-{stream["itag"]}-{stream.get("last_modified") or 0}"'
+
+
+def if_range_matches(if_range, etag, last_modified=None):
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('W/'):
+        return False
+    if if_range.startswith('"'):
+        return bool(etag) and if_range == etag
+    if not last_modified:
+        return False
+    try:
+        return parsedate_to_datetime(if_range) == parsedate_to_datetime(last_modified)
+    except (TypeError, ValueError):
+        return False
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return float(default)
+
+
+def parse_retry_after(value, default=0.0):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def error_status(error):
+    error_str = str(error).lower()
+    if '429' in error_str or 'too many requests' in error_str:
+        return 429
+    if '403' in error_str:
+        return 403
+    return None
+
+
+class TokenBucket:
+    def __init__(self, name, rate, burst, min_rate=None, recovery_factor=1.1):
+        self.name = name
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate if min_rate is not None else rate / 8
+        self.recovery_factor = recovery_factor
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.penalties = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens=1):
+        # Tokens may go negative: concurrent callers queue up behind each other
+        # instead of all waking at once when the bucket refills.
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= tokens
+            self.acquired += 1
+            delay = max(0.0, -self.tokens / self.rate, self.blocked_until - now)
+            if delay > 0:
+                self.waits += 1
+                self.wait_seconds += delay
+                self.max_wait = max(self.max_wait, delay)
+            return delay
+
+    def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def try_acquire(self, tokens=1):
+        # Non-blocking: takes the tokens only if they are available right now
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.blocked_until > now or self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            self.acquired += 1
+            return True
+
+    def spare(self):
+        # Tokens available right now; none while backing off or recovering from a
+        # penalty, so optional work never eats into a reduced budget.
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.blocked_until > now or self.rate < self.base_rate:
+                return 0.0
+            return max(0.0, self.tokens)
+
+    def penalize(self, cooldown=0.0):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.blocked_until = max(self.blocked_until, now + cooldown)
+            self.penalties += 1
+
+    def record_success(self):
+        if self.rate >= self.base_rate:
+            return
+        with self._lock:
+            self.rate = min(self.base_rate, self.rate * self.recovery_factor)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": round(self.rate, 3),
+                "base_rate": self.base_rate,
+                "burst": self.burst,
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "wait_seconds_total": round(self.wait_seconds, 3),
+                "max_wait_seconds": round(self.max_wait, 3),
+                "penalties": self.penalties,
+            }
+
+
+def _bucket_from_env(name, prefix, rate, burst):
+    return TokenBucket(
+        name,
+        rate=_env_float(f"{prefix}_RATE", rate),
+        burst=_env_float(f"{prefix}_BURST", burst),
+    )
+
+
+# One budget per upstream: the player API (pytubefix resolution), the Data API v3
+# (search) and the googlevideo CDN (media bytes).
+LIMITERS = {
+    'player': _bucket_from_env('player', 'PLAYER_API', 2, 5),
+    'data_api': _bucket_from_env('data_api', 'DATA_API', 5, 10),
+    'cdn': _bucket_from_env('cdn', 'CDN', 10, 20),
+}
+
+
+def get_limiter(name):
+    return LIMITERS[name]
+
+
+def limiter_stats():
+    return {name: bucket.stats() for name, bucket in LIMITERS.items()}
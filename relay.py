@@ -0,0 +1,262 @@
+import itertools
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_ids = itertools.count(1)
+
+
+class RelayAborted(IOError):
+    pass
+
+
+class RingBuffer:
+    # Fixed-capacity byte ring allocated once, so a stream's memory does not grow
+    # with upstream bursts. Not thread-safe on its own; StreamRelay holds the lock.
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._start = 0
+        self.size = 0
+
+    @property
+    def free(self):
+        return self.capacity - self.size
+
+    def write(self, data):
+        count = min(len(data), self.free)
+        end = (self._start + self.size) % self.capacity
+        first = min(count, self.capacity - end)
+        self._buffer[end:end + first] = data[:first]
+        if count > first:
+            self._buffer[:count - first] = data[first:count]
+        self.size += count
+        return count
+
+    def read(self, limit):
+        count = min(limit, self.size)
+        first = min(count, self.capacity - self._start)
+        data = bytes(self._buffer[self._start:self._start + first])
+        if count > first:
+            data += bytes(self._buffer[:count - first])
+        self._start = (self._start + count) % self.capacity
+        self.size -= count
+        return data
+
+
+class StreamRelay:
+    # Decouples the upstream read from the client write. A producer thread fills the
+    # ring buffer and blocks while it is full, which pushes backpressure to the
+    # upstream connection instead of queueing in memory. The producer also watches the
+    # client: when the buffer stays full because the client is not reading, the
+    # stream is aborted after `idle_timeout` with no reads at all, or after
+    # `slow_grace` seconds below `min_rate` bytes/s. Aborting (or the client going
+    # away) closes the upstream right away through `closer`, e.g. Response.close,
+    # rather than at the next chunk boundary.
+
+    def __init__(self, chunks, capacity=1024 * 1024, read_size=65536, min_rate=16384,
+                 slow_grace=30, idle_timeout=60, closer=None):
+        self.id = next(_ids)
+        self.chunks = chunks
+        self.read_size = read_size
+        self.min_rate = min_rate
+        self.slow_grace = slow_grace
+        self.idle_timeout = idle_timeout
+        self.closer = closer
+        self.ring = RingBuffer(capacity)
+        self.condition = threading.Condition()
+        self.started = time.monotonic()
+        self.last_read = self.started
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.eof = False
+        self.error = None
+        self.closed = False
+        self.abort_reason = None
+        # Start of the current period where the client, not upstream, is the bottleneck
+        self._backlog_since = None
+        self._backlog_delivered = 0
+
+    def __iter__(self):
+        with _registry_lock:
+            _active[self.id] = self
+        threading.Thread(target=self._produce, name=f"relay-{self.id}", daemon=True).start()
+        try:
+            while True:
+                with self.condition:
+                    while not self.ring.size and not self.eof and not self.closed:
+                        if not self.condition.wait(self.idle_timeout) and not self.ring.size and not self.eof:
+                            self._abort('upstream_idle')
+                    if self.closed:
+                        raise RelayAborted(f"Relay aborted: {self.abort_reason}")
+                    if self.ring.size:
+                        data = self.ring.read(self.read_size)
+                        self.bytes_out += len(data)
+                        self.last_read = time.monotonic()
+                        self.condition.notify_all()
+                    elif self.error:
+                        raise self.error
+                    else:
+                        return
+                yield data
+        except GeneratorExit:
+            self.close('client_disconnected')
+            raise
+        finally:
+            self.close()
+            with _registry_lock:
+                _active.pop(self.id, None)
+
+    def _produce(self):
+        try:
+            for chunk in self.chunks:
+                view = memoryview(chunk)
+                while view:
+                    with self.condition:
+                        written = self.ring.write(view)
+                        if written:
+                            self.bytes_in += written
+                            view = view[written:]
+                            if self.ring.size * 2 < self.ring.capacity:
+                                self._backlog_since = None
+                            self.condition.notify_all()
+                            continue
+                        self._wait_for_client()
+                        if self.closed:
+                            return
+                if self.closed:
+                    return
+        except Exception as e:
+            with self.condition:
+                if not self.closed:
+                    self.error = e
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.eof = True
+                self.condition.notify_all()
+            close = getattr(self.chunks, 'close', None)
+            if close:
+                close()
+
+    def _wait_for_client(self):
+        # Called with the condition held while the buffer is full. The backlog period
+        # lasts until the client drains the buffer below half, so reads that only free
+        # one chunk at a time do not restart the rate measurement.
+        if self._backlog_since is None:
+            self._backlog_since = time.monotonic()
+            self._backlog_delivered = self.bytes_out
+        while not self.ring.free and not self.closed:
+            self.condition.wait(1.0)
+            now = time.monotonic()
+            if now - self.last_read >= self.idle_timeout:
+                self._abort('client_idle')
+            elif now - self._backlog_since >= self.slow_grace:
+                elapsed = now - self._backlog_since
+                if (self.bytes_out - self._backlog_delivered) / elapsed < self.min_rate:
+                    self._abort('client_slow')
+                self._backlog_since, self._backlog_delivered = now, self.bytes_out
+
+    def _abort(self, reason):
+        # Called with the condition held.
+        if self.closed:
+            return
+        logger.warning(f"Relay {self.id} aborted: {reason}")
+        self.abort_reason = reason
+        self.closed = True
+        self.condition.notify_all()
+        _count_abort(reason)
+        self._close_upstream()
+
+    def _close_upstream(self):
+        if self.closer and not self.eof:
+            try:
+                self.closer()
+            except Exception:
+                pass
+
+    def close(self, reason=None):
+        with self.condition:
+            if self.closed:
+                return
+            if reason:
+                self.abort_reason = reason
+                _count_abort(reason)
+            self.closed = True
+            self.condition.notify_all()
+        self._close_upstream()
+
+    def stats(self):
+        with self.condition:
+            elapsed = time.monotonic() - self.started
+            return {
+                "id": self.id,
+                "buffered": self.ring.size,
+                "capacity": self.ring.capacity,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "age_seconds": round(elapsed, 1),
+                "client_bytes_per_second": round(self.bytes_out / elapsed) if elapsed else 0,
+            }
+
+
+_active = {}
+_aborts = {}
+_registry_lock = threading.Lock()
+
+
+def _count_abort(reason):
+    with _registry_lock:
+        _aborts[reason] = _aborts.get(reason, 0) + 1
+
+
+def relay_from_env(chunks, closer=None):
+    return StreamRelay(
+        chunks,
+        capacity=int(os.environ.get('RELAY_BUFFER_BYTES', 1024 * 1024)),
+        read_size=int(os.environ.get('FETCH_CHUNK_SIZE', 65536)),
+        min_rate=float(os.environ.get('RELAY_MIN_RATE', 16384)),
+        slow_grace=float(os.environ.get('RELAY_SLOW_GRACE', 30)),
+        idle_timeout=float(os.environ.get('RELAY_IDLE_TIMEOUT', 60)),
+        closer=closer,
+    )
+
+
+def limit_client_send(environ, seconds=None):
+    # Aborting a relay frees the upstream side, but a sync worker stays blocked in
+    # send() on a client that stopped reading until the kernel gives up. SO_SNDTIMEO
+    # on gunicorn's client socket bounds that wait; other servers are left alone.
+    sock = environ.get('gunicorn.socket')
+    if sock is None:
+        return False
+    if seconds is None:
+        seconds = float(os.environ.get('RELAY_SEND_TIMEOUT', os.environ.get('RELAY_IDLE_TIMEOUT', 60)))
+    if seconds <= 0:
+        return False
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                        struct.pack('ll', int(seconds), int(seconds % 1 * 1000000)))
+    except (OSError, AttributeError) as e:
+        logger.debug(f"Could not set a send timeout on the client socket: {e}")
+        return False
+    return True
+
+
+def relay_stats():
+    with _registry_lock:
+        relays = list(_active.values())
+        aborts = dict(_aborts)
+    streams = [relay.stats() for relay in relays]
+    return {
+        "active": len(streams),
+        "buffered_bytes": sum(s["buffered"] for s in streams),
+        "capacity_bytes": sum(s["capacity"] for s in streams),
+        "aborts": aborts,
+        "streams": streams,
+    }
@@ -0,0 +1,122 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from cache import TTLCache
+from metrics import Histogram
+
+REGION = os.environ.get('REGION') or os.environ.get('VERCEL_REGION') or 'default'
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('RESOLVER_WORKERS', 8)),
+    thread_name_prefix='resolver'
+)
+
+
+class ClientStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def _entry(self, client_type):
+        entry = self._clients.get(client_type)
+        if entry is None:
+            entry = {
+                "attempts": 0,
+                "successes": 0,
+                "failures": 0,
+                "rate_limited": 0,
+                "forbidden": 0,
+                "latency": Histogram(),
+            }
+            self._clients[client_type] = entry
+        return entry
+
+    def record(self, client_type, elapsed, success, status=None):
+        with self._lock:
+            entry = self._entry(client_type)
+            entry["attempts"] += 1
+            if success:
+                entry["successes"] += 1
+            else:
+                entry["failures"] += 1
+            if status == 429:
+                entry["rate_limited"] += 1
+            elif status == 403:
+                entry["forbidden"] += 1
+            histogram = entry["latency"]
+        histogram.observe(elapsed)
+
+    def stats(self):
+        with self._lock:
+            clients = dict(self._clients)
+        result = {}
+        for client_type, entry in clients.items():
+            attempts = entry["attempts"]
+            result[client_type] = {
+                "attempts": attempts,
+                "successes": entry["successes"],
+                "failures": entry["failures"],
+                "rate_limited": entry["rate_limited"],
+                "forbidden": entry["forbidden"],
+                "success_rate": round(entry["successes"] / attempts, 4) if attempts else 0.0,
+                "latency_seconds": entry["latency"].snapshot(),
+            }
+        return result
+
+
+class ClientPreferences:
+    def __init__(self, max_entries=2048, ttl=6 * 3600):
+        self._videos = TTLCache(max_entries=max_entries, default_ttl=ttl)
+        self._regions = {}
+
+    def remember(self, video_id, client_type, region=REGION):
+        if video_id:
+            self._videos.put(f"{region}:{video_id}", client_type)
+        self._regions[region] = client_type
+
+    def order(self, client_types, video_id=None, region=REGION):
+        preferred = []
+        if video_id:
+            preferred.append(self._videos.get(f"{region}:{video_id}"))
+        preferred.append(self._regions.get(region))
+        ordered = []
+        for client_type in preferred + list(client_types):
+            if client_type and client_type not in ordered:
+                ordered.append(client_type)
+        return ordered
+
+
+def hedged_resolve(attempt, client_types, width, timeout=None):
+    # Runs `attempt(client_type)` for up to `width` client types at once and returns
+    # (client_type, result) for the first success. A failed attempt is replaced by the
+    # next client type in line. Attempts that lose the race cannot be interrupted once
+    # started; their results are simply discarded.
+    remaining = list(client_types)
+    pending = {}
+    last_exception: Exception = Exception("Failed to connect to YouTube")
+
+    def launch():
+        client_type = remaining.pop(0)
+        pending[_executor.submit(attempt, client_type)] = client_type
+
+    while remaining and len(pending) < max(1, width):
+        launch()
+
+    try:
+        while pending:
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError(f"No client type resolved within {timeout}s")
+            for future in done:
+                client_type = pending.pop(future)
+                try:
+                    return client_type, future.result()
+                except Exception as e:
+                    last_exception = e
+                    if remaining:
+                        launch()
+        raise last_exception
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,312 @@
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import unicodedata
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+from cache import TTLCache
+from ratelimit import error_status, get_limiter
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 50
+
+# Data API v3 quota cost per call, see https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = {
+    'search.list': 100,
+    'videos.list': 1,
+}
+
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+except Exception:
+    QUOTA_TIMEZONE = timezone(timedelta(hours=-8))
+
+search_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SEARCH_WORKERS', 4)),
+    thread_name_prefix='search'
+)
+
+# Overrides the Data API base URL (an API gateway, or the local fake server used by
+# the benchmarks); unset means the discovery document's default endpoint.
+YOUTUBE_API_ENDPOINT = os.environ.get('YOUTUBE_API_ENDPOINT')
+
+_clients = {}
+_clients_lock = threading.Lock()
+_thread_http = threading.local()
+
+
+def get_youtube_client(youtube_api_key):
+    # One discovery-based client per process and key; building it parses the
+    # (static) discovery document, which is too costly to repeat per request.
+    # googleapiclient is imported here, not at start-up: only the search routes use it.
+    from googleapiclient.discovery import build
+    with _clients_lock:
+        client = _clients.get(youtube_api_key)
+        if client is None:
+            client_options = {'api_endpoint': YOUTUBE_API_ENDPOINT} if YOUTUBE_API_ENDPOINT else None
+            client = build('youtube', 'v3', developerKey=youtube_api_key, cache_discovery=False,
+                           static_discovery=True, client_options=client_options)
+            _clients[youtube_api_key] = client
+        return client
+
+
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', query)).strip().casefold()
+
+
+def search_cost(max_results):
+    pages = math.ceil(max_results / PAGE_SIZE)
+    return pages * (QUOTA_COSTS['search.list'] + QUOTA_COSTS['videos.list'])
+
+
+class QuotaTracker:
+    # The daily quota resets at midnight Pacific time, so "today" follows that clock.
+
+    def __init__(self, daily_limit=10000):
+        self.daily_limit = daily_limit
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._units = {}
+        self._day = None
+        self.units_today = 0
+        self.units_saved = 0
+
+    def _roll(self):
+        day = datetime.now(QUOTA_TIMEZONE).date()
+        if day != self._day:
+            self._day = day
+            self.units_today = 0
+
+    def record(self, endpoint):
+        units = QUOTA_COSTS.get(endpoint, 1)
+        with self._lock:
+            self._roll()
+            self._calls[endpoint] = self._calls.get(endpoint, 0) + 1
+            self._units[endpoint] = self._units.get(endpoint, 0) + units
+            self.units_today += units
+
+    def record_saved(self, units):
+        with self._lock:
+            self.units_saved += units
+
+    def stats(self):
+        with self._lock:
+            self._roll()
+            return {
+                "day": self._day.isoformat(),
+                "daily_limit": self.daily_limit,
+                "units_today": self.units_today,
+                "remaining_today": max(0, self.daily_limit - self.units_today),
+                "units_saved": self.units_saved,
+                "endpoints": {
+                    endpoint: {"calls": self._calls[endpoint], "units": self._units[endpoint]}
+                    for endpoint in sorted(self._calls)
+                },
+            }
+
+
+class SearchCache:
+    # Entries are keyed by the normalized query alone and remember how many results
+    # were asked for, so a smaller request is answered by slicing a larger result set.
+
+    def __init__(self, max_entries=512, default_ttl=1800):
+        self._cache = TTLCache(max_entries=max_entries, default_ttl=default_ttl)
+        self._lock = threading.Lock()
+        self.undersized = 0
+
+    def get(self, query, max_results):
+        entry = self._cache.get(normalize_query(query))
+        if entry is None:
+            return None
+        requested, videos = entry
+        if requested < max_results:
+            with self._lock:
+                self.undersized += 1
+            return None
+        return videos[:max_results]
+
+    def put(self, query, max_results, videos):
+        self._cache.put(normalize_query(query), (max_results, videos))
+
+    def stats(self):
+        # An entry too small for the request is a miss, not a hit
+        stats = self._cache.stats()
+        with self._lock:
+            stats["hits"] -= self.undersized
+            stats["misses"] += self.undersized
+            stats["undersized"] = self.undersized
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+quota = QuotaTracker(daily_limit=int(os.environ.get('YOUTUBE_API_DAILY_QUOTA', 10000)))
+
+search_cache = SearchCache(
+    max_entries=int(os.environ.get('SEARCH_CACHE_SIZE', 512)),
+    default_ttl=int(os.environ.get('SEARCH_CACHE_TTL', 1800))
+)
+
+
+def _http():
+    # httplib2.Http is not thread-safe, so the shared client executes each request
+    # with a connection owned by the calling thread.
+    http = getattr(_thread_http, 'http', None)
+    if http is None:
+        import httplib2
+        http = _thread_http.http = httplib2.Http(timeout=30)
+    return http
+
+
+def _execute(request, endpoint):
+    get_limiter('data_api').acquire()
+    quota.record(endpoint)
+    try:
+        return request.execute(http=_http())
+    except Exception as e:
+        if error_status(e):
+            get_limiter('data_api').penalize(random.uniform(1, 3))
+        raise
+
+
+def format_search_video(video):
+    video_id = video['id']
+    snippet = video['snippet']
+    content_details = video['contentDetails']
+
+    duration_iso = content_details.get('duration', 'PT0S')
+    duration_str = duration_iso.replace('PT', '').replace('H', 'h ').replace('M', 'm ').replace('S', 's')
+
+    video_url = f"https://www.youtube.com/watch?v={video_id}"
+
+    definition = content_details.get('definition', 'sd').upper()
+
+    thumbnails = snippet.get('thumbnails', {})
+    image_url = thumbnails.get('maxres', thumbnails.get('high', thumbnails.get('medium', {}))).get('url', '')
+
+    return {
+        "titre": snippet.get('title', ''),
+        "duree": duration_str.strip(),
+        "qualite": definition,
+        "lien": video_url,
+        "image_url": image_url,
+        "auteur": snippet.get('channelTitle', ''),
+        "vues": video.get('statistics', {}).get('viewCount', 'N/A')
+    }
+
+
+def fetch_video_details(youtube, video_ids):
+    videos_response = _execute(youtube.videos().list(
+        id=','.join(video_ids),
+        part='snippet,contentDetails,statistics'
+    ), 'videos.list')
+    return [format_search_video(video) for video in videos_response.get('items', [])]
+
+
+def iter_search_batches(query, max_results, youtube_api_key):
+    # Paging is inherently serial (each page needs the previous nextPageToken), but
+    # each page's videos().list enrichment is submitted as soon as the page arrives,
+    # so enrichment overlaps with paging. Yields (page_index, videos) as batches finish.
+    youtube = get_youtube_client(youtube_api_key)
+    pending = {}
+    collected = 0
+    next_page_token = None
+    page_index = 0
+
+    try:
+        while collected < max_results:
+            search_params = {
+                'q': query,
+                'part': 'id',
+                'type': 'video',
+                'maxResults': min(PAGE_SIZE, max_results - collected)
+            }
+            if next_page_token:
+                search_params['pageToken'] = next_page_token
+
+            search_response = _execute(youtube.search().list(**search_params), 'search.list')
+
+            video_ids = [item['id']['videoId'] for item in search_response.get('items', [])]
+            video_ids = video_ids[:max_results - collected]
+            collected += len(video_ids)
+            if video_ids:
+                future = search_executor.submit(fetch_video_details, youtube, video_ids)
+                pending[future] = page_index
+                page_index += 1
+
+            done = [f for f in pending if f.done()]
+            for future in done:
+                yield pending.pop(future), future.result()
+
+            next_page_token = search_response.get('nextPageToken')
+            if not next_page_token:
+                break
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _cached(query, max_results):
+    videos = search_cache.get(query, max_results)
+    if videos is not None:
+        quota.record_saved(search_cost(max_results))
+    return videos
+
+
+def _in_page_order(batches):
+    return [video for _, page in sorted(batches, key=lambda batch: batch[0]) for video in page]
+
+
+def search_youtube(query, max_results, youtube_api_key):
+    videos = _cached(query, max_results)
+    if videos is None:
+        videos = _in_page_order(iter_search_batches(query, max_results, youtube_api_key))
+        search_cache.put(query, max_results, videos)
+    return videos
+
+
+def iter_search_ndjson(query, max_results, youtube_api_key, on_videos=None, rewrite=None):
+    # on_videos(videos) is called once, with the first results sent to the client;
+    # rewrite(videos) transforms what is sent, not what is cached
+    rewrite = rewrite or (lambda videos: videos)
+    count = 0
+    videos = _cached(query, max_results)
+    try:
+        if videos is not None:
+            if on_videos:
+                on_videos(videos)
+            for video in rewrite(videos):
+                count += 1
+                yield json.dumps(video) + '\n'
+        else:
+            batches = []
+            for batch in iter_search_batches(query, max_results, youtube_api_key):
+                if on_videos and not batches:
+                    on_videos(batch[1])
+                batches.append(batch)
+                for video in rewrite(batch[1]):
+                    count += 1
+                    yield json.dumps(video) + '\n'
+            search_cache.put(query, max_results, _in_page_order(batches))
+    except Exception as e:
+        logger.error(f"Search stream error: {e}")
+        yield json.dumps({"error": str(e)}) + '\n'
+        return
+    yield json.dumps({
+        "recherche": query,
+        "nombre_resultats": count,
+        "max_demande": max_results,
+        "termine": True
+    }) + '\n'
@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fetcher import UPSTREAM_HEADERS
+from manifest import extract_video_id
+from media_cache import MediaCache
+from transcode import TranscodeError, ffmpeg_available, resize_image
+
+logger = logging.getLogger(__name__)
+
+VIDEO_ID_RE = re.compile(r'^[\w-]{11}$')
+
+# Tried in order: maxresdefault only exists for HD uploads (404 otherwise)
+SOURCES = ('maxresdefault.jpg', 'sddefault.jpg', 'hqdefault.jpg')
+
+# Requested widths are rounded up to one of these, which bounds the number of
+# variants cached per video
+WIDTHS = (120, 240, 320, 480, 640, 960, 1280)
+
+MIME_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+class ThumbnailNotFound(LookupError):
+    pass
+
+
+def parse_width(value):
+    # None when absent; ValueError when not a positive integer
+    if value is None or value == '':
+        return None
+    width = int(value)
+    if width <= 0:
+        raise ValueError(f"Invalid width: {value}")
+    return next((allowed for allowed in WIDTHS if allowed >= width), WIDTHS[-1])
+
+
+def negotiate_format(accept):
+    # WebP only for clients that list it explicitly (browsers that decode it do)
+    for part in (accept or '').split(','):
+        media_type, _, params = part.strip().partition(';')
+        if media_type.strip().lower() == 'image/webp':
+            quality = re.search(r'q=([^;]*)', params)
+            if not quality:
+                return 'webp'
+            try:
+                return 'webp' if float(quality.group(1)) > 0 else 'jpeg'
+            except ValueError:
+                # A malformed weight makes the range unacceptable, not the request
+                return 'jpeg'
+    return 'jpeg'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison, as for If-None-Match
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return etag.removeprefix('W/') in tags
+
+
+def proxied_thumbnails(videos, base_url, width=None):
+    # Copies of search results whose image_url points at /thumb on this service
+    query = f"?width={width}" if width else ''
+    proxied = []
+    for video in videos:
+        video_id = extract_video_id(video.get("lien", ''))
+        if video_id:
+            video = {**video, "image_url": f"{base_url.rstrip('/')}/thumb/{video_id}{query}"}
+        proxied.append(video)
+    return proxied
+
+
+class ThumbnailService:
+    # Originals are fetched from the thumbnail host once and kept in `originals`;
+    # resized/re-encoded variants are derived from them and kept in `variants`. Both
+    # are MediaCache directories, so concurrent requests for the same image share a
+    # single fetch or resize and the least recently used files are evicted first.
+
+    def __init__(self, originals, variants, upstream='https://i.ytimg.com', pool_size=8, timeout=15):
+        self.originals = originals
+        self.variants = variants
+        self.upstream = upstream.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({**UPSTREAM_HEADERS, 'Accept': 'image/jpeg,image/*'})
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(('served', 'not_modified', 'upstream_fetches', 'upstream_bytes', 'resizes',
+                                      'resize_failures'), 0)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._counts[key] += amount
+
+    def _fetch(self, video_id):
+        for name in SOURCES:
+            r = self.session.get(f"{self.upstream}/vi/{video_id}/{name}", timeout=self.timeout)
+            if r.status_code == 404:
+                continue
+            r.raise_for_status()
+            self._count('upstream_fetches')
+            self._count('upstream_bytes', len(r.content))
+            return r.content
+        raise ThumbnailNotFound(video_id)
+
+    @staticmethod
+    def _cached(cache, key, produce):
+        path = cache.get(key) if cache.enabled else None
+        if path:
+            with open(path, 'rb') as f:
+                return f.read()
+        if not cache.enabled:
+            return produce()
+        return b''.join(cache.stream(key, lambda: [produce()]))
+
+    def original(self, video_id):
+        if not VIDEO_ID_RE.match(video_id or ''):
+            raise ThumbnailNotFound(video_id)
+        return self._cached(self.originals, f"thumb:{video_id}", lambda: self._fetch(video_id))
+
+    def _resize(self, video_id, width, image_format):
+        data = resize_image(self.original(video_id), width, image_format)
+        self._count('resizes')
+        return data
+
+    def get(self, video_id, width=None, image_format='jpeg'):
+        # {"data", "mime_type", "etag"} of the thumbnail at `width` (None: original
+        # size) in `image_format`. Without ffmpeg, or if it fails, the original JPEG.
+        data = None
+        if (width or image_format != 'jpeg') and ffmpeg_available():
+            key = f"thumb:{video_id}:{width or 'original'}.{image_format}"
+            try:
+                data = self._cached(self.variants, key, lambda: self._resize(video_id, width, image_format))
+            except TranscodeError as e:
+                logger.warning(f"Thumbnail resize failed for {video_id}: {e}")
+                self._count('resize_failures')
+        if data is None:
+            data, image_format = self.original(video_id), 'jpeg'
+        self._count('served')
+        return {
+            "data": data,
+            "mime_type": MIME_TYPES[image_format],
+            "etag": f'"{hashlib.sha1(data).hexdigest()[:20]}"',
+        }
+
+    def record_not_modified(self):
+        self._count('not_modified')
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        return {**counts, "originals": self.originals.stats(), "variants": self.variants.stats()}
+
+
+def thumbnails_from_env():
+    root = os.environ.get('THUMB_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'youtube-thumbnails'))
+    return ThumbnailService(
+        MediaCache(os.path.join(root, 'originals'),
+                   max_bytes=int(os.environ.get('THUMB_CACHE_MAX_BYTES', 128 * 1024 ** 2))),
+        MediaCache(os.path.join(root, 'variants'),
+                   max_bytes=int(os.environ.get('THUMB_VARIANT_CACHE_MAX_BYTES', 128 * 1024 ** 2))),
+        upstream=os.environ.get('THUMB_UPSTREAM', 'https://i.ytimg.com'),
+        pool_size=int(os.environ.get('THUMB_POOL_SIZE', 8)),
+        timeout=float(os.environ.get('THUMB_TIMEOUT', 15)),
+    )
@@ -0,0 +1,169 @@
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+MP3_BITRATES = (64, 96, 128, 160, 192, 256, 320)
+DEFAULT_MP3_BITRATE = 192
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def ffmpeg_available():
+    return shutil.which(FFMPEG_BIN) is not None
+
+
+def parse_bitrate(value, default=DEFAULT_MP3_BITRATE):
+    if value is None or value == '':
+        return default
+    try:
+        bitrate = int(str(value).lower().rstrip('k'))
+    except ValueError:
+        return None
+    return bitrate if bitrate in MP3_BITRATES else None
+
+
+def _feed(pipe, chunks, stop):
+    # Writes block once the pipe is full, so a slow client (which stops draining
+    # stdout) stalls ffmpeg, which in turn stalls this writer and the upstream fetch.
+    try:
+        for chunk in chunks:
+            if stop.is_set():
+                break
+            pipe.write(chunk)
+    except (BrokenPipeError, ValueError, OSError):
+        pass
+    except Exception as e:
+        logger.error(f"Transcode input error: {e}")
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+
+def _ffmpeg_stream(inputs, output_args, read_size=16384, input_args=(), files=()):
+    # Each input iterable gets its own OS pipe and writer thread, so several upstream
+    # fetches progress concurrently; ffmpeg reads them as pipe:<fd>. Local `files`
+    # are read directly, which lets ffmpeg seek in them.
+    pipes = [os.pipe() for _ in inputs]
+    args = [FFMPEG_BIN, '-hide_banner', '-loglevel', 'error', '-nostdin']
+    for read_fd, _ in pipes:
+        args += [*input_args, '-i', f'pipe:{read_fd}']
+    for path in files:
+        args += [*input_args, '-i', path]
+    args += output_args + ['pipe:1']
+
+    errors = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=errors,
+            pass_fds=[read_fd for read_fd, _ in pipes],
+            bufsize=0,
+        )
+    except Exception:
+        for read_fd, write_fd in pipes:
+            os.close(read_fd)
+            os.close(write_fd)
+        errors.close()
+        raise
+
+    stop = threading.Event()
+    writers = []
+    for (read_fd, write_fd), chunks in zip(pipes, inputs):
+        os.close(read_fd)
+        writer = threading.Thread(
+            target=_feed,
+            args=(os.fdopen(write_fd, 'wb', buffering=0), chunks, stop),
+            daemon=True
+        )
+        writer.start()
+        writers.append(writer)
+
+    finished = False
+    try:
+        while True:
+            data = proc.stdout.read(read_size)
+            if not data:
+                break
+            yield data
+        finished = True
+    finally:
+        stop.set()
+        if proc.poll() is None and not finished:
+            proc.kill()
+        proc.stdout.close()
+        returncode = proc.wait()
+        for writer in writers:
+            writer.join(timeout=5)
+        errors.seek(0)
+        stderr = errors.read(4096).decode('utf-8', 'replace').strip()
+        errors.close()
+        if finished and returncode != 0:
+            raise TranscodeError(stderr or f"ffmpeg exited with code {returncode}")
+
+
+def transcode_mp3(chunks, bitrate=DEFAULT_MP3_BITRATE, read_size=16384):
+    return _ffmpeg_stream(
+        [chunks],
+        ['-vn', '-codec:a', 'libmp3lame', '-b:a', f'{bitrate}k', '-f', 'mp3'],
+        read_size=read_size
+    )
+
+
+def remux_fmp4(video_chunks, audio_chunks, read_size=65536):
+    # Stream copy (no re-encode) into fragmented MP4, which needs no seekable output.
+    return _ffmpeg_stream(
+        [video_chunks, audio_chunks],
+        [
+            '-map', '0:v:0', '-map', '1:a:0', '-c', 'copy',
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            '-f', 'mp4',
+        ],
+        read_size=read_size
+    )
+
+
+def extract_clip(paths, start, duration, bitrate=None, read_size=65536):
+    # Cuts [start, start + duration) out of local files holding the needed parts of
+    # each stream (see clip.py). Timestamps are absolute, as in the original streams.
+    # Video is stream copied, so the clip begins at the keyframe before `start`;
+    # with a bitrate the audio is encoded to MP3 instead.
+    if bitrate:
+        output_args = ['-vn', '-codec:a', 'libmp3lame', '-b:a', f'{bitrate}k', '-f', 'mp3']
+    else:
+        maps = ['-map', '0:v:0', '-map', '1:a:0'] if len(paths) > 1 else ['-map', '0:v?', '-map', '0:a?']
+        output_args = maps + ['-c', 'copy', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4']
+    return _ffmpeg_stream(
+        [],
+        output_args,
+        read_size=read_size,
+        input_args=['-seek_timestamp', '1', '-ss', f'{start:.3f}', '-t', f'{duration:.3f}'],
+        files=paths
+    )
+
+
+def resize_image(data, width=None, image_format='jpeg'):
+    # One image (e.g. a JPEG thumbnail) scaled down to `width` pixels, never up, and
+    # encoded as WebP or JPEG
+    output_args = ['-frames:v', '1']
+    if width:
+        output_args += ['-vf', f"scale='min({width},iw)':-2"]
+    if image_format == 'webp':
+        output_args += ['-c:v', 'libwebp', '-quality', '80', '-f', 'webp']
+    else:
+        output_args += ['-c:v', 'mjpeg', '-q:v', '4', '-f', 'mjpeg']
+    return b''.join(_ffmpeg_stream([[data]], output_args, read_size=65536))